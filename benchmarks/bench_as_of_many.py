@@ -0,0 +1,43 @@
+"""The state of a table at every day of a year, with a query per day or with
+a single as_of_many.
+
+Usage: python bench_as_of_many.py [keys [days]]
+
+Every key has a version for each month of two years.
+"""
+import sys
+import datetime
+
+from common import test_database, timed, report
+
+KEYS = 500
+DAYS = 365
+
+
+def main():
+    keys = len(sys.argv) > 1 and int(sys.argv[1]) or KEYS
+    days = len(sys.argv) > 2 and int(sys.argv[2]) or DAYS
+    from temporal.models import DateMergeModelNull
+    instants = [datetime.date(2000, 1, 1) + datetime.timedelta(i) for i in range(days)]
+
+    def per_day():
+        return [(instant, row) for instant in instants for row in DateMergeModelNull.objects.as_of(instant)]
+
+    def at_once():
+        return list(DateMergeModelNull.objects.as_of_many(instants))
+
+    results = []
+    with test_database() as connection:
+        cur = connection.cursor()
+        cur.execute("INSERT INTO temporal_datemergemodelnull (k1, k2, c, valid) "
+            "SELECT 'key ' || k, NULL, m, daterange(('2000-01-01'::date + m * interval '1 month')::date, "
+            "('2000-02-01'::date + m * interval '1 month')::date) "
+            "FROM generate_series(1, %s) AS k, generate_series(0, 23) AS m", [keys])
+        cur.execute('ANALYZE temporal_datemergemodelnull')
+        for name, func in [('as_of per day', per_day), ('as_of_many', at_once)]:
+            elapsed, pairs = timed(func)
+            results.append((name, len(pairs), elapsed))
+    report('The state of %d keys at %d days' % (keys, days), ('query', 'pairs', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
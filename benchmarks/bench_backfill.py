@@ -0,0 +1,66 @@
+"""Building a history from daily snapshots, merging them one by one or with
+a single backfill.
+
+Usage: python bench_backfill.py [snapshots [rows]]
+
+Each snapshot changes 1% of the rows of the previous one, drops 0.5% and
+adds 0.5% new ones. Both ways must end with the same history.
+"""
+import csv
+import os
+import sys
+import tempfile
+import datetime
+
+from common import test_database, timed, report
+
+SNAPSHOTS = 30
+ROWS = 10000
+
+
+def write_snapshot(path, rows, day):
+    f = open(path, 'wb')
+    w = csv.writer(f)
+    w.writerow(['k1', 'k2', 'c'])
+    for key in xrange(rows // 200 * day, rows + rows // 200 * day):
+        # every day a different 1% of the rows change
+        w.writerow(['key %d' % key, key % 3 and 'x' or '', key + (day + 100 - key % 100) // 100])
+    f.close()
+
+
+def main():
+    snapshots = len(sys.argv) > 1 and int(sys.argv[1]) or SNAPSHOTS
+    rows = len(sys.argv) > 2 and int(sys.argv[2]) or ROWS
+    from django_temporal.utils import merge, backfill
+    from temporal.models import DateMergeModelNull
+    
+    tmpdir = tempfile.mkdtemp()
+    paths = [os.path.join(tmpdir, 'snapshot_%d.csv' % i) for i in range(snapshots)]
+    for day, path in enumerate(paths):
+        write_snapshot(path, rows, day)
+    pairs = [(datetime.date(2000, 1, 1) + datetime.timedelta(day), path) for day, path in enumerate(paths)]
+    
+    def merge_all():
+        for timestamp, path in pairs:
+            merge(path, DateMergeModelNull, timestamp, keys=['k1', 'k2'])
+    
+    results = []
+    histories = []
+    try:
+        with test_database() as connection:
+            cur = connection.cursor()
+            for name, func in [('merge', merge_all), ('backfill', lambda: backfill(pairs, DateMergeModelNull, keys=['k1', 'k2']))]:
+                cur.execute('TRUNCATE temporal_datemergemodelnull')
+                elapsed, retval = timed(func)
+                cur.execute('SELECT k1, k2, c, valid FROM temporal_datemergemodelnull ORDER BY k1, k2, valid')
+                histories.append(cur.fetchall())
+                results.append((name, len(histories[-1]), elapsed))
+    finally:
+        for path in paths:
+            os.remove(path)
+        os.rmdir(tmpdir)
+    assert histories[0] == histories[1]
+    report('Building history from %d snapshots of %d rows' % (snapshots, rows), ('method', 'versions', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
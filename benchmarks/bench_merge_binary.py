@@ -0,0 +1,73 @@
+"""Staging a feed of numbers and timestamps as CSV or in the binary COPY
+format.
+
+Usage: python bench_merge_binary.py [rows]
+
+Rows are generated in Python beforehand and encoded either as CSV, which the server
+parses from text, or by the types of their fields in the binary format.
+The same feed is also staged from files written by COPY ... TO, which
+leaves out encoding in Python and times the server alone.
+"""
+import datetime
+import os
+import sys
+import tempfile
+from decimal import Decimal
+
+from common import test_database, timed, report
+
+ROWS = 200000
+
+FIELDTYPES = [('k', 'integer'), ('amount', 'numeric(14, 4)'), ('price', 'double precision'),
+    ('seen', 'timestamp with time zone'), ('day', 'date')]
+
+
+def generate(rows):
+    yield [name for name, fieldtype in FIELDTYPES]
+    t = datetime.datetime(2000, 1, 1)
+    for i in xrange(rows):
+        yield (i, Decimal(i * 7919 % 1000003) / 100, i * 0.37, t + datetime.timedelta(seconds=i * 17),
+            datetime.date(2000, 1, 1) + datetime.timedelta(i % 3650))
+
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or ROWS
+    from django_temporal.utils import open_source, stage_records, BinaryRows, BinaryCopy
+    from temporal.models import DateMergeModelNull
+    fields = [name for name, fieldtype in FIELDTYPES]
+    fieldtypes = dict(FIELDTYPES)
+
+    tmpdir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmpdir, 'feed.csv')
+    binary_path = os.path.join(tmpdir, 'feed.bin')
+    results = []
+    try:
+        with test_database() as connection:
+            cur = connection.cursor()
+
+            def stage(name, source, reader):
+                table = 'bench_%s' % name
+                elapsed, count = timed(stage_records, cur, connection, source, fields, reader, table, ['k'], fieldtypes)
+                cur.execute('SELECT md5(string_agg(t::text, \',\' ORDER BY k)) FROM ' + table + ' AS t')
+                results.append((name, count, cur.fetchone()[0][:8], elapsed))
+                return table
+
+            feed = list(generate(rows))
+            stage('csv_rows', feed, open_source(feed, DateMergeModelNull)[1])
+            source = BinaryRows(feed)
+            table = stage('binary_rows', source, source.open(DateMergeModelNull, fieldtypes)[1])
+
+            cur.copy_expert('COPY ' + table + ' TO stdout WITH CSV HEADER', open(csv_path, 'wb'))
+            cur.copy_expert('COPY ' + table + ' TO stdout WITH BINARY', open(binary_path, 'wb'))
+            stage('csv_file', csv_path, open_source(csv_path, DateMergeModelNull)[1])
+            source = BinaryCopy(binary_path, fields)
+            stage('binary_file', source, source.open(DateMergeModelNull, fieldtypes)[1])
+    finally:
+        for path in (csv_path, binary_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(tmpdir)
+    report('Staging %d rows of numbers and timestamps' % rows, ('format', 'rows', 'digest', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Merging a snapshot into a wide table, comparing rows column by column or
+by digest.
+
+Usage: python bench_merge_digest.py [rows [columns]]
+
+A history is loaded with a first snapshot, then a second snapshot where 1%
+of the rows changed, 0.5% are gone and 0.5% are new is merged and timed.
+This is done for full snapshots, where merge indexes the keys of the new
+data, and for delta snapshots, where it does not. Keys are nullable.
+"""
+import csv
+import os
+import sys
+import tempfile
+import datetime
+
+from common import test_database, timed, report
+
+ROWS = 20000
+COLUMNS = 50
+
+
+def wide_model(columns):
+    from django_temporal.db import models
+    attrs = {
+        '__module__': 'temporal.models',
+        'Meta': type('Meta', (), {'app_label': 'temporal', 'db_table': 'bench_wide'}),
+        'key': models.IntegerField(null=True),
+        'valid': models.DateRangeField(),
+    }
+    for i in range(columns):
+        if i % 2:
+            attrs['c%d' % i] = models.IntegerField(null=True)
+        else:
+            attrs['c%d' % i] = models.CharField(max_length=50, null=True)
+    return type('WideMergeModel', (models.Model,), attrs)
+
+
+def write_snapshot(path, rows, columns, version):
+    f = open(path, 'wb')
+    w = csv.writer(f)
+    w.writerow(['key'] + ['c%d' % i for i in range(columns)])
+    for key in xrange(rows + rows // 200 * version):
+        if version and key % 200 == 1:
+            continue
+        changed = version and key % 100 == 2
+        w.writerow([key] + [
+            i % 2 and (key + i + changed) or ('value %d %d' % (key, i) if (key + i) % 7 else '')
+            for i in range(columns)])
+    f.close()
+
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or ROWS
+    columns = len(sys.argv) > 2 and int(sys.argv[2]) or COLUMNS
+    from django.core.management.color import no_style
+    from django_temporal.utils import merge
+    
+    tmpdir = tempfile.mkdtemp()
+    paths = [os.path.join(tmpdir, 'snapshot_%d.csv' % i) for i in range(2)]
+    for version, path in enumerate(paths):
+        write_snapshot(path, rows, columns, version)
+    
+    results = []
+    try:
+        with test_database() as connection:
+            cur = connection.cursor()
+            model = wide_model(columns)
+            sql, references = connection.creation.sql_create_model(model, no_style())
+            for snapshot, digest in [('full', False), ('full', True), ('delta', False), ('delta', True)]:
+                for statement in sql:
+                    cur.execute(statement)
+                merge(paths[0], model, datetime.date(2000, 1, 1), keys=['key'], digest=digest)
+                cur.execute('ANALYZE bench_wide')
+                elapsed, retval = timed(merge, paths[1], model, datetime.date(2000, 1, 2),
+                    keys=['key'], snapshot=snapshot, digest=digest)
+                cur.execute('SELECT count(*) FROM bench_wide')
+                results.append((snapshot, digest and 'digest' or 'columns', cur.fetchone()[0], elapsed))
+                cur.execute('DROP TABLE bench_wide')
+    finally:
+        for path in paths:
+            os.remove(path)
+        os.rmdir(tmpdir)
+    report('Merging %d rows of %d columns' % (rows, columns), ('snapshot', 'mode', 'rows after', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Merging a snapshot which is already in the database, through a CSV file
+or straight from the table.
+
+Usage: python bench_merge_sql.py [rows]
+
+The snapshot is a table in the same database. The CSV way copies it out to
+a file and merges the file, the SQL way merges the table itself. Staging
+includes copying the table out to the file.
+"""
+import os
+import sys
+import tempfile
+import datetime
+
+from common import test_database, timed, report
+
+ROWS = 200000
+
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or ROWS
+    from django_temporal.utils import merge, StagedRecords
+    from temporal.models import DateMergeModelNull
+    
+    def through_csv(cur):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            f = os.fdopen(fd, 'wb')
+            cur.copy_expert("COPY bench_source TO stdout WITH CSV HEADER NULL ''", f)
+            f.close()
+            return merge(path, DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'])
+        finally:
+            os.remove(path)
+    
+    def from_table(cur):
+        return merge(StagedRecords('bench_source'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'])
+    
+    results = []
+    with test_database() as connection:
+        cur = connection.cursor()
+        cur.execute("CREATE TABLE bench_source AS SELECT 'key ' || i AS k1, CASE WHEN i %% 3 > 0 THEN 'x' END AS k2, i AS c "
+            "FROM generate_series(1, %s) AS i", [rows])
+        for name, func in [('csv', through_csv), ('sql', from_table)]:
+            cur.execute('TRUNCATE temporal_datemergemodelnull')
+            merge(StagedRecords('bench_source', where='c % 100 > 0'), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+            elapsed, stats = timed(func, cur)
+            cur.execute('SELECT count(*) FROM temporal_datemergemodelnull')
+            results.append((name, cur.fetchone()[0], elapsed - stats.total + stats.phases['stage'], elapsed))
+    report('Merging %d rows from a table in the database' % rows, ('source', 'rows after', 'staging', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Merging a snapshot with merge and with parallel_merge on 1 to 4 workers.
+
+Usage: python bench_parallel_merge.py [rows]
+
+Wall clock time can only go down with workers while there are idle cores
+for the backends to run on.
+"""
+import csv
+import datetime
+import os
+import sys
+import tempfile
+
+from common import test_database, timed, report
+
+ROWS = 200000
+
+
+def write_snapshot(path, rows, version):
+    f = open(path, 'wb')
+    w = csv.writer(f)
+    w.writerow(['a', 'b'])
+    for a in xrange(rows + rows // 200 * version):
+        if version and a % 200 == 1:
+            continue
+        w.writerow([a, 'value %d %d' % (a, version and a % 100 == 2)])
+    f.close()
+
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or ROWS
+    from django_temporal.utils import merge, parallel_merge
+    
+    tmpdir = tempfile.mkdtemp()
+    paths = [os.path.join(tmpdir, 'snapshot_%d.csv' % i) for i in range(2)]
+    for version, path in enumerate(paths):
+        write_snapshot(path, rows, version)
+    
+    results = []
+    try:
+        with test_database() as connection:
+            from temporal.models import DateMergeModel
+            cases = [('merge', merge, {})] + [
+                ('parallel_merge, %d workers' % n, parallel_merge, {'workers': n}) for n in (1, 2, 4)]
+            for name, func, kwargs in cases:
+                DateMergeModel.objects.all().delete()
+                merge(paths[0], DateMergeModel, datetime.date(2000, 1, 1), keys=['a'])
+                connection.cursor().execute('ANALYZE ' + DateMergeModel._meta.db_table)
+                elapsed, retval = timed(func, paths[1], DateMergeModel, datetime.date(2000, 1, 2), keys=['a'], **kwargs)
+                results.append((name, elapsed))
+    finally:
+        for path in paths:
+            os.remove(path)
+        os.rmdir(tmpdir)
+    report('Merging %d rows, %d cores' % (rows, cpu_count()), ('case', 'seconds'), results)
+
+def cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+if __name__ == '__main__':
+    main()
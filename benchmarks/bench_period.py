@@ -0,0 +1,38 @@
+"""Construction cost of Period and DateRange values."""
+import datetime
+
+from common import best_of, report
+
+N = 100000
+
+
+def main():
+    from django_temporal.db.models.fields import Period, DateRange
+    
+    lower = datetime.datetime(2000, 1, 1, 12, 0, 0, 1)
+    upper = datetime.datetime(2000, 2, 1, 12, 0, 0, 1)
+    period_str = u'[2000-01-01 12:00:00.000000+0000,2000-02-01 12:00:00.000000+0000)'
+    period = Period(period_str)
+    date_lower = datetime.date(2000, 1, 1)
+    date_upper = datetime.date(2000, 2, 1)
+    date_str = u'[2000-01-01,2000-02-01)'
+    
+    cases = [
+        ('Period(lower, upper)', lambda: Period(lower=lower, upper=upper)),
+        ('Period(str)', lambda: Period(period_str)),
+        ('Period(Period)', lambda: Period(period)),
+        ('DateRange(lower, upper)', lambda: DateRange(lower=date_lower, upper=date_upper)),
+        ('DateRange(str)', lambda: DateRange(date_str)),
+    ]
+    
+    rows = []
+    for name, func in cases:
+        def run():
+            for i in xrange(N):
+                func()
+        elapsed = best_of(3, run)
+        rows.append((name, elapsed, elapsed / N * 1e6))
+    report('Constructing %d values' % N, ('case', 'seconds', 'us/value'), rows)
+
+if __name__ == '__main__':
+    main()
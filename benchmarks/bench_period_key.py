@@ -0,0 +1,49 @@
+"""Sorting, comparing and grouping Period values."""
+import datetime
+import random
+
+from common import best_of, report
+
+N = 100000
+
+
+def main():
+    from django_temporal.db.models.fields import Period
+    
+    rnd = random.Random(0)
+    start = datetime.datetime(2000, 1, 1)
+    periods = []
+    for i in xrange(N):
+        lower = start + datetime.timedelta(0, rnd.randint(0, 10 ** 7))
+        periods.append(Period(lower=lower, upper=lower + datetime.timedelta(0, rnd.randint(1, 10 ** 5))))
+    # a few duplicates, as versions of the same row
+    periods.extend(Period(p) for p in periods[:N // 10])
+    
+    def group():
+        groups = {}
+        for p in periods:
+            groups.setdefault(p, []).append(p)
+        return groups
+    
+    def group_by_string():
+        groups = {}
+        for p in periods:
+            groups.setdefault(unicode(p), []).append(p)
+        return groups
+    
+    cases = [
+        ('sorted()', lambda: sorted(periods)),
+        ('sorted(), fresh values', lambda: sorted([Period(p) for p in periods])),
+        ('compare neighbours', lambda: [a == b for a, b in zip(periods, periods[1:])]),
+        ('group by period', group),
+        ('group by unicode()', group_by_string),
+    ]
+    
+    rows = []
+    for name, func in cases:
+        elapsed = best_of(3, func)
+        rows.append((name, elapsed))
+    report('%d periods' % len(periods), ('case', 'seconds'), rows)
+
+if __name__ == '__main__':
+    main()
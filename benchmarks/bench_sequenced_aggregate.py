@@ -0,0 +1,62 @@
+"""The number of valid versions over time as a step function, swept in
+Python over every version or computed in the database.
+
+Usage: python bench_sequenced_aggregate.py [keys]
+
+Every key has a version for each month of two years.
+"""
+import sys
+import datetime
+from collections import defaultdict
+
+from common import test_database, timed, report
+
+KEYS = 2000
+
+
+def main():
+    keys = len(sys.argv) > 1 and int(sys.argv[1]) or KEYS
+    from temporal.models import DateMergeModelNull
+
+    def in_python():
+        events = defaultdict(int)
+        for valid in DateMergeModelNull.objects.values_list('valid', flat=True).iterator():
+            events[valid.lower] += 1
+            events[valid.upper] -= 1
+        steps, count = [], 0
+        bounds = sorted(events)
+        for lower, upper in zip(bounds, bounds[1:]):
+            count += events[lower]
+            if steps and steps[-1][2] == count:
+                steps[-1] = (steps[-1][0], upper, count)
+            else:
+                steps.append((lower, upper, count))
+        return steps
+
+    def in_database():
+        return [(p.lower, p.upper, count) for p, count in DateMergeModelNull.objects.sequenced_aggregate()]
+
+    def per_day():
+        return list(DateMergeModelNull.objects.sequenced_aggregate(start=datetime.date(2000, 1, 1),
+            end=datetime.date(2002, 1, 1), step=datetime.timedelta(1)))
+
+    results = []
+    with test_database() as connection:
+        cur = connection.cursor()
+        cur.execute("INSERT INTO temporal_datemergemodelnull (k1, k2, c, valid) "
+            "SELECT 'key ' || k, NULL, m, daterange(('2000-01-01'::date + m * interval '1 month' + k * interval '1 day')::date, "
+            "('2000-02-01'::date + m * interval '1 month' + k * interval '1 day')::date) "
+            "FROM generate_series(1, %s) AS k, generate_series(0, 23) AS m", [keys])
+        cur.execute('ANALYZE temporal_datemergemodelnull')
+        expected = None
+        for name, func in [('sweep in Python', in_python), ('sequenced_aggregate', in_database),
+                ('sequenced_aggregate per day', per_day)]:
+            elapsed, steps = timed(func)
+            if func is not per_day:
+                assert expected is None or steps == expected
+                expected = steps
+            results.append((name, len(steps), elapsed))
+    report('The count of %d versions over time' % (keys * 24), ('query', 'periods', 'seconds'), results)
+
+if __name__ == '__main__':
+    main()
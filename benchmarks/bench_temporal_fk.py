@@ -0,0 +1,43 @@
+"""Bulk loading rows into tables with temporal foreign keys.
+
+Each batch is loaded with a single INSERT into a table that keeps growing, so
+the time per row should stay flat if the foreign key triggers only check
+the rows that changed.
+"""
+from common import test_database, timed, report
+
+BATCHES = (1000, 2000, 4000, 8000, 16000)
+
+INSERT = '''INSERT INTO %(table)s (name, category_id%(valid)s)
+    SELECT 'row ' || i, %%s%(valid_value)s FROM generate_series(1, %%s) AS i;'''
+
+
+def load(connection, model, valid_field=None):
+    from temporal.models import Category
+    qn = connection.ops.quote_name
+    cur = connection.cursor()
+    info = {'table': qn(model._meta.db_table), 'valid': '', 'valid_value': ''}
+    if valid_field is not None:
+        info['valid'] = ', ' + qn(valid_field)
+        info['valid_value'] = ", '[2000-01-01 00:00:00+0000,9999-12-30 00:00:00+0000)'::tstzrange"
+    sql = INSERT % info
+    
+    category = Category.objects.get(pk=4)
+    rows = []
+    total = 0
+    for batch in BATCHES:
+        elapsed, retval = timed(cur.execute, sql, [category.pk, batch])
+        rows.append((batch, total, elapsed, elapsed / batch * 1e6))
+        total += batch
+    return rows
+
+
+def main():
+    with test_database() as connection:
+        from temporal.models import ReferencedTemporalFK, BothTemporalFK
+        header = ('rows', 'existing rows', 'seconds', 'us/row')
+        report('Referenced table temporal', header, load(connection, ReferencedTemporalFK))
+        report('Both tables temporal', header, load(connection, BothTemporalFK, 'validity_time'))
+
+if __name__ == '__main__':
+    main()
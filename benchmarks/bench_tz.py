@@ -0,0 +1,35 @@
+"""Parsing time stamps with offsets and converting them between time zones."""
+import datetime
+
+from common import best_of, report
+
+N = 100000
+
+
+def main():
+    from django_temporal.db.models.fields import TZDateTimeField, force_tz
+    
+    field = TZDateTimeField()
+    stamp = field.to_python('2009-06-04 12:00:00.000000+0000')
+    naive = datetime.datetime(2009, 6, 4, 12)
+    
+    cases = [
+        ('to_python(+0000)', lambda: field.to_python('2009-06-04 12:00:00.000000+0000')),
+        ('to_python( +0100)', lambda: field.to_python('2009-06-04 12:00:00 +0100')),
+        ('to_python(+01:00)', lambda: field.to_python('2009-06-04T12:00:00+01:00')),
+        ('to_python(naive)', lambda: field.to_python('2009-06-04 12:00:00')),
+        ('aslocaltimezone()', lambda: stamp.aslocaltimezone()),
+        ('force_tz(naive, name)', lambda: force_tz(naive, 'Europe/Ljubljana')),
+    ]
+    
+    rows = []
+    for name, func in cases:
+        def run():
+            for i in xrange(N):
+                func()
+        elapsed = best_of(3, run)
+        rows.append((name, elapsed, elapsed / N * 1e6))
+    report('%d calls' % N, ('case', 'seconds', 'us/call'), rows)
+
+if __name__ == '__main__':
+    main()
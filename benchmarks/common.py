@@ -0,0 +1,54 @@
+"""Helpers shared by the benchmark scripts.
+
+Benchmarks run against the test project in `temporal` and create (and
+afterwards destroy) their own test database, the same way the test suite
+does. Run them from the repository root, eg.
+
+    python benchmarks/bench_temporal_fk.py
+"""
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'temporal.settings')
+
+
+def timed(func, *args, **kwargs):
+    """Calls func and returns a tuple of (elapsed seconds, return value)."""
+    t1 = time.time()
+    retval = func(*args, **kwargs)
+    t2 = time.time()
+    return t2 - t1, retval
+
+
+def best_of(repeat, func, *args, **kwargs):
+    """Returns the best elapsed time out of `repeat` calls to func."""
+    return min([timed(func, *args, **kwargs)[0] for i in range(repeat)])
+
+
+def report(title, header, rows):
+    rows = [[isinstance(i, float) and '%.6f' % i or unicode(i) for i in row] for row in rows]
+    widths = [max([len(unicode(header[i]))] + [len(row[i]) for row in rows]) + 2 for i in range(len(header))]
+    print title
+    print '~' * sum(widths)
+    print ''.join([unicode(i).ljust(w) for i, w in zip(header, widths)])
+    for row in rows:
+        print ''.join([i.ljust(w) for i, w in zip(row, widths)])
+    print
+
+
+@contextmanager
+def test_database():
+    """Creates the test database, yields the connection and destroys it."""
+    from django.db import connection
+    logging.disable(logging.INFO)
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,95 @@
+from psycopg2 import extensions
+
+TSTZRANGE_OID = 3910
+TSTZRANGE_ARRAY_OID = 3911
+DATERANGE_OID = 3912
+DATERANGE_ARRAY_OID = 3913
+
+# psycopg2 < 2.7 casts timestamptz with PYDATETIME
+PYDATETIMETZ = getattr(extensions, 'PYDATETIMETZ', extensions.PYDATETIME)
+
+EMPTY = 'empty'
+
+
+class PeriodAdapter(object):
+    """Adapts a Period or DateRange to a range literal for psycopg2."""
+
+    def __init__(self, period):
+        self.period = period
+
+    def __conform__(self, proto):
+        if proto == extensions.ISQLQuote:
+            return self
+
+    def getquoted(self):
+        period = self.period
+        if period.empty:
+            return "'%s'::%s" % (EMPTY, period.pg_type)
+        lower, upper = period.lower, period.upper
+        if period.pg_type == 'tstzrange':
+            # bounds are naive and kept in UTC, the session time zone
+            lower = lower.isoformat(' ') + '+00'
+            upper = upper.isoformat(' ') + '+00'
+        else:
+            lower = lower is not None and lower.isoformat() or ''
+            upper = upper is not None and upper.isoformat() or ''
+        return "'%s%s,%s%s'::%s" % (
+            period.start_included and '[' or '(',
+            lower,
+            upper,
+            period.end_included and ']' or ')',
+            period.pg_type,
+            )
+
+
+def _range_caster(value_class, cast_bound, unbounded=False):
+    """Returns a typecaster function, building value_class from range text.
+    
+    Ranges value_class cannot hold, with infinite bounds or, unless
+    `unbounded`, missing ones, are returned as their text.
+    """
+    def cast(value, cur):
+        if value is None:
+            return None
+        if value == EMPTY:
+            return value_class(empty=True)
+        bounds = [i.strip('"') for i in value[1:-1].split(',')]
+        if [i for i in bounds if i.endswith('infinity') or not (i or unbounded)]:
+            return value
+        lower, upper = [i and cast_bound(i, cur) or None for i in bounds]
+        try:
+            return value_class._from_bounds(lower, upper, value[0] == '[', value[-1] == ']')
+        except OverflowError:
+            # an included bound at the end of the calendar
+            return value
+    return cast
+
+def _cast_utc(value, cur):
+    """Casts a timestamptz bound to a naive datetime in UTC, the way periods
+    keep their bounds, whatever the session time zone."""
+    value = PYDATETIMETZ(value, cur)
+    if value is not None and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+_casters = []
+
+def register_types(conn):
+    """Makes conn return Period and DateRange values for range columns."""
+    if not _casters:
+        # imported here, the backend is loaded before the models are
+        from django_temporal.db.models.fields import Period, DateRange
+        tstzrange = extensions.new_type((TSTZRANGE_OID,), 'TSTZRANGE',
+            _range_caster(Period, _cast_utc))
+        daterange = extensions.new_type((DATERANGE_OID,), 'DATERANGE',
+            _range_caster(DateRange, extensions.PYDATE, unbounded=True))
+        _casters.extend([
+            tstzrange,
+            extensions.new_array_type((TSTZRANGE_ARRAY_OID,), 'TSTZRANGEARRAY', tstzrange),
+            daterange,
+            extensions.new_array_type((DATERANGE_ARRAY_OID,), 'DATERANGEARRAY', daterange),
+            ])
+        extensions.register_adapter(Period, PeriodAdapter)
+        extensions.register_adapter(DateRange, PeriodAdapter)
+    for caster in _casters:
+        extensions.register_type(caster, conn)
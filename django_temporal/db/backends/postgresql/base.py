@@ -1,8 +1,10 @@
 #from django.db.backends.postgresql_psycopg2.base import *
 from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as Psycopg2DatabaseWrapper
+from django.db.backends.signals import connection_created
 
 from django_temporal.db.backends.postgresql.creation import PostgresTemporalCreation
 from django_temporal.db.backends.postgresql.operations import PostgresTemporalOperations
+from django_temporal.db.backends.postgresql.adapter import register_types
 
 class DatabaseWrapper(Psycopg2DatabaseWrapper):
     def __init__(self, *args, **kwargs):
@@ -10,4 +12,8 @@ class DatabaseWrapper(Psycopg2DatabaseWrapper):
         self.creation = PostgresTemporalCreation(self)
         self.ops = PostgresTemporalOperations(self)
 
+def register_temporal_types(sender, connection, **kwargs):
+    """Makes range columns come back as Period and DateRange values."""
+    register_types(connection.connection)
 
+connection_created.connect(register_temporal_types, sender=DatabaseWrapper)
@@ -2,6 +2,14 @@
 
 from django.db.backends.postgresql_psycopg2.creation import DatabaseCreation
 
+# Literal for TIME_CURRENT, quoted for use inside a plpgsql function body.
+TIME_CURRENT_SQL = "TIMESTAMP WITH TIME ZONE ''9999-12-30 00:00:00.000000+0000''"
+# Literals for DATE_CURRENT and TIME_CURRENT in index predicates.
+CURRENT_SQL = {
+    'daterange': "DATE '9999-12-30'",
+    'tstzrange': "TIMESTAMP WITH TIME ZONE '9999-12-30 00:00:00.000000+0000'",
+}
+
 class PostgresTemporalCreation(DatabaseCreation):
     def sql_indexes_for_field(self, model, f, style):
         from django.db.backends.util import truncate_name
@@ -22,7 +30,30 @@ class PostgresTemporalCreation(DatabaseCreation):
                     style.SQL_FIELD('%s' % qn(f.name)) + ') = ' +
                     style.SQL_KEYWORD('false') + ');'
                 )
-                
+
+            # serves current(), the predicate upper(field) = current, and
+            # holds the current records only
+            i_name = '%s_%s_current' % (db_table, f.column)
+            output.append(style.SQL_KEYWORD('CREATE INDEX') + ' ' +
+                style.SQL_TABLE(qn(truncate_name(i_name, self.connection.ops.max_name_length()))) + ' ' +
+                style.SQL_KEYWORD('ON') + ' ' +
+                style.SQL_TABLE(qn(db_table)) + ' ' +
+                '(' + style.SQL_FIELD(qn(model._meta.pk.column)) + ') ' +
+                style.SQL_KEYWORD('WHERE') + ' ' +
+                style.SQL_FIELD('upper(%s)' % qn(f.column)) + ' = ' + CURRENT_SQL[f.db_type(self.connection)] + ';'
+            )
+            # serves as_of(), the predicate field @> instant, unless the
+            # exclusion constraint of sequenced_unique builds one
+            if f.sequenced_unique is None:
+                i_name = '%s_%s_gist' % (db_table, f.column)
+                output.append(style.SQL_KEYWORD('CREATE INDEX') + ' ' +
+                    style.SQL_TABLE(qn(truncate_name(i_name, self.connection.ops.max_name_length()))) + ' ' +
+                    style.SQL_KEYWORD('ON') + ' ' +
+                    style.SQL_TABLE(qn(db_table)) + ' ' +
+                    style.SQL_KEYWORD('USING GIST') + ' ' +
+                    '(' + style.SQL_FIELD(qn(f.column)) + ');'
+                )
+
             if f.current_unique is not None:
                 columns = []
                 for curuniq in f.current_unique:
@@ -109,19 +140,29 @@ class PostgresTemporalCreation(DatabaseCreation):
                     related_validity_field = rmf
             
             
-            if this_temporal:
-                if related_temporal:
-                    func_template = '''\
+            if related_temporal:
+                # Both triggers are row level and only look at the row that
+                # changed, so the cost of a bulk load stays linear in the
+                # number of rows loaded instead of rescanning the whole
+                # referencing table for every row.
+                if this_temporal:
+                    referencing_current = "upper(NEW.%s) = %s AND " % (
+                        qn(this_validity_field.column), TIME_CURRENT_SQL)
+                    referencing_columns = '%s, %s' % (qn(f.column), qn(this_validity_field.column))
+                    referenced_by_current = ' AND upper(A.%s) = %s' % (
+                        qn(this_validity_field.column), TIME_CURRENT_SQL)
+                else:
+                    referencing_current = ''
+                    referencing_columns = qn(f.column)
+                    referenced_by_current = ''
+                
+                func_template = '''\
 CREATE FUNCTION %(trigger_name)s() RETURNS TRIGGER AS '
 BEGIN
-IF EXISTS (
-    SELECT * FROM %(referencing_table)s AS A
-        WHERE upper(A.%(referencing_validity_field)s) = TIMESTAMP WITH TIME ZONE ''9999-12-30 00:00:00.000000+0000''
-        AND NOT EXISTS (
-            SELECT * FROM %(referenced_table)s AS B
-            WHERE A.%(referencing_field)s = B.%(referenced_field)s
-            AND upper(B.%(referenced_validity_field)s) = TIMESTAMP WITH TIME ZONE ''9999-12-30 00:00:00.000000+0000''
-    )
+IF %(referencing_current)sNOT EXISTS (
+    SELECT 1 FROM %(referenced_table)s AS B
+        WHERE B.%(referenced_field)s = NEW.%(referencing_field)s
+        AND upper(B.%(referenced_validity_field)s) = %(current)s
 ) THEN
     RAISE ''Temporal current foreign key constraint violation on %(referencing_table)s.%(referencing_field)s'' USING ERRCODE = ''23503'';
 END IF;
@@ -129,68 +170,72 @@ RETURN NULL;
 END
 '
 LANGUAGE 'plpgsql';'''
-                    trigger_template = '''\
+                trigger_template = '''\
 CREATE TRIGGER %(name)s
-AFTER INSERT OR UPDATE OR DELETE ON %(referencing_table)s
+AFTER INSERT OR UPDATE OF %(referencing_columns)s ON %(referencing_table)s
 FOR EACH ROW
 EXECUTE PROCEDURE %(trigger_name)s();'''
-                    
-                    name = '%s_%s_%s' % (f.model._meta.db_table, f.name, 'cur_tfk')
-                    trigger_name = '%s_%s' % (name, 'tr')
-                    info = {
-                        'name': qn(name),
-                        'trigger_name': qn(trigger_name),
-                        'referencing_table': qn(f.model._meta.db_table),
-                        'referencing_field': qn(f.column),
-                        'referencing_validity_field': qn(this_validity_field.column),
-                        'referenced_table': qn(related_model._meta.db_table),
-                        'referenced_field': qn(related_field.column),
-                        'referenced_validity_field': qn(related_validity_field.column),
-                        }
-                    output.append(func_template % info)
-                    output.append(trigger_template % info)
-                else:
-                    # no change needed
-                    pass
-            else:
-                if related_temporal:
-                    func_template = '''\
-CREATE FUNCTION %(trigger_name)s() RETURNS TRIGGER AS '
+                
+                # Closing (or deleting) the current version of a referenced
+                # row must not leave current referencing rows dangling.
+                ref_func_template = '''\
+CREATE FUNCTION %(ref_trigger_name)s() RETURNS TRIGGER AS '
 BEGIN
-IF EXISTS (
-    SELECT * FROM %(referencing_table)s AS A
-        WHERE NOT EXISTS (
-            SELECT * FROM %(referenced_table)s AS B
-            WHERE A.%(referencing_field)s = B.%(referenced_field)s
-            AND upper(B.%(referenced_validity_field)s) = TIMESTAMP WITH TIME ZONE ''9999-12-30 00:00:00.000000+0000''
+IF TG_OP = ''UPDATE'' THEN
+    IF NEW.%(referenced_field)s = OLD.%(referenced_field)s
+        AND upper(NEW.%(referenced_validity_field)s) = %(current)s THEN
+        RETURN NULL;
+    END IF;
+END IF;
+IF upper(OLD.%(referenced_validity_field)s) = %(current)s
+    AND EXISTS (
+        SELECT 1 FROM %(referencing_table)s AS A
+            WHERE A.%(referencing_field)s = OLD.%(referenced_field)s%(referenced_by_current)s
     )
-) THEN
+    AND NOT EXISTS (
+        SELECT 1 FROM %(referenced_table)s AS B
+            WHERE B.%(referenced_field)s = OLD.%(referenced_field)s
+            AND upper(B.%(referenced_validity_field)s) = %(current)s
+    ) THEN
     RAISE ''Temporal current foreign key constraint violation on %(referencing_table)s.%(referencing_field)s'' USING ERRCODE = ''23503'';
 END IF;
 RETURN NULL;
 END
 '
 LANGUAGE 'plpgsql';'''
-                    trigger_template = '''\
-CREATE TRIGGER %(name)s
-AFTER INSERT OR UPDATE OR DELETE ON %(referencing_table)s
+                ref_trigger_template = '''\
+CREATE TRIGGER %(ref_name)s
+AFTER UPDATE OF %(referenced_columns)s OR DELETE ON %(referenced_table)s
 FOR EACH ROW
-EXECUTE PROCEDURE %(trigger_name)s();'''
-                    name = '%s_%s_%s' % (f.model._meta.db_table, f.name, 'cur_tfk')
-                    trigger_name = '%s_%s' % (name, 'tr')
-                    info = {
-                        'name': qn(name),
-                        'trigger_name': qn(trigger_name),
-                        'referencing_table': qn(f.model._meta.db_table),
-                        'referencing_field': qn(f.column),
-                        'referenced_table': qn(related_model._meta.db_table),
-                        'referenced_field': qn(related_field.column),
-                        'referenced_validity_field': qn(related_validity_field.column),
-                        }
-                    output.append(func_template % info)
-                    output.append(trigger_template % info)
-                else:
-                    # no changes required
-                    pass
+EXECUTE PROCEDURE %(ref_trigger_name)s();'''
+                
+                name = '%s_%s_%s' % (f.model._meta.db_table, f.name, 'cur_tfk')
+                trigger_name = '%s_%s' % (name, 'tr')
+                ref_name = '%s_%s' % (name, 'ref')
+                ref_trigger_name = '%s_%s' % (ref_name, 'tr')
+                max_length = self.connection.ops.max_name_length()
+                info = {
+                    'name': qn(truncate_name(name, max_length)),
+                    'trigger_name': qn(truncate_name(trigger_name, max_length)),
+                    'ref_name': qn(truncate_name(ref_name, max_length)),
+                    'ref_trigger_name': qn(truncate_name(ref_trigger_name, max_length)),
+                    'current': TIME_CURRENT_SQL,
+                    'referencing_table': qn(f.model._meta.db_table),
+                    'referencing_field': qn(f.column),
+                    'referencing_columns': referencing_columns,
+                    'referencing_current': referencing_current,
+                    'referenced_by_current': referenced_by_current,
+                    'referenced_table': qn(related_model._meta.db_table),
+                    'referenced_field': qn(related_field.column),
+                    'referenced_columns': '%s, %s' % (qn(related_field.column), qn(related_validity_field.column)),
+                    'referenced_validity_field': qn(related_validity_field.column),
+                    }
+                output.append(func_template % info)
+                output.append(trigger_template % info)
+                output.append(ref_func_template % info)
+                output.append(ref_trigger_template % info)
+            else:
+                # no changes required
+                pass
             
         return output
@@ -1,6 +1,8 @@
+from datetime import date, datetime
 
 from django.db.backends.postgresql_psycopg2.base import DatabaseOperations
 
+from django_temporal.db.backends.postgresql.adapter import PeriodAdapter
 from django_temporal.db.backends.util import TemporalOperation, TemporalFunction, TemporalFunctionTS
 
 class TemporalOperator(TemporalOperation):
@@ -9,6 +11,12 @@ class TemporalOperator(TemporalOperation):
 
 class PostgresTemporalOperations(DatabaseOperations):
     
+    Adapter = PeriodAdapter
+    temporal_element_types = {
+        'tstzrange': 'timestamptz',
+        'daterange': 'date',
+    }
+    
     def __init__(self, connection):
         super(PostgresTemporalOperations, self).__init__(connection)
         
@@ -17,8 +25,6 @@ class PostgresTemporalOperations(DatabaseOperations):
             'nequals': TemporalOperator('<>'),
             'contains': TemporalOperator('@>'),
             'contained_by': TemporalOperator('<@'),
-            #'minus': TemporalOperator('-'),
-            #'union': TemporalOperator('+'),
             'overlaps': TemporalOperator('&&'),
             'before': TemporalOperator('<<'),
             'after': TemporalOperator('>>'),
@@ -31,12 +37,26 @@ class PostgresTemporalOperations(DatabaseOperations):
             'later': TemporalFunctionTS('next'),
             'isempty': TemporalFunctionTS('isempty'),
         }
+        # operators on two periods which return a period, for annotations
+        self.temporal_period_operators = {
+            'union': TemporalOperator('+'),
+            'intersection': TemporalOperator('*'),
+            'minus': TemporalOperator('-'),
+        }
     
     def temporal_lookup_sql(self, lvalue, lookup_type, value, field, qn):
         alias, col, db_type = lvalue
         temporal_col = '%s.%s' % (qn(alias), qn(col))
         if lookup_type in self.temporal_operators:
             op = self.temporal_operators[lookup_type]
+            if lookup_type == 'contains' and isinstance(value, (date, datetime)):
+                # a naive datetime would be a timestamp without time zone
+                return op.as_sql(temporal_col, '%s::' + self.temporal_element_types[db_type])
             return op.as_sql(temporal_col, '%s')
         else:
             raise NotImplementedError
+    
+    def temporal_period_sql(self, operator, lhs, rhs='%s'):
+        """Returns the SQL of operator, one of union, intersection and
+        minus, on the periods lhs and rhs."""
+        return '(' + self.temporal_period_operators[operator].as_sql(lhs, rhs) + ')'
@@ -6,7 +6,7 @@ from django.db.models import *
 from django_temporal.db.models.manager import TemporalManager
 from django_temporal.db.models.fields import \
 	TIME_CURRENT, DATE_CURRENT, TIME_RESOLUTION, DATE_RESOLUTION, \
-	Period, DateRange, PeriodField, DateRangeField, ValidTime, \
+	Period, DateRange, PeriodSet, PeriodField, DateRangeField, ValidTime, \
 	TemporalForeignKey, ForeignKey
 
 """
@@ -0,0 +1,197 @@
+from datetime import datetime, date, time, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django_temporal.db.models.fields import Period, DateRange, get_temporal_field
+
+__all__ = ['PeriodArray']
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+class PeriodArray(object):
+    """Periods stored column-wise, for vectorized queries over many ranges.
+
+    Bounds are kept in the closed-open form Period.normalize gives, in the
+    int64 arrays `lower` and `upper`. Those count microseconds since the
+    epoch for Period values and days since the epoch for DateRange values.
+    `empty` flags empty (and null) periods. Unbounded DateRange bounds are
+    taken as date.min and date.max.
+
+    Requires numpy.
+    """
+
+    def __init__(self, periods=(), value_class=None):
+        if numpy is None:
+            raise ImportError("PeriodArray requires numpy")
+        lowers = []
+        uppers = []
+        empty = []
+        for period in periods:
+            if value_class is None and period is not None:
+                value_class = period.__class__
+            if period is None or period.empty:
+                lowers.append(None)
+                uppers.append(None)
+                empty.append(True)
+                continue
+            lower, upper = period.lower, period.upper
+            if lower is None:
+                lower = date.min
+            elif not period.start_included:
+                lower = lower + period._value_resolution
+            if upper is None:
+                upper = date.max
+            elif period.end_included:
+                upper = upper + period._value_resolution
+            lowers.append(lower)
+            uppers.append(upper)
+            empty.append(False)
+        self.value_class = value_class or Period
+        unit = self._unit()
+        self.lower = numpy.array(lowers, dtype='datetime64[%s]' % unit).view(numpy.int64)
+        self.upper = numpy.array(uppers, dtype='datetime64[%s]' % unit).view(numpy.int64)
+        self.empty = numpy.array(empty, dtype=bool)
+        # empty periods cover nothing
+        self.lower[self.empty] = 0
+        self.upper[self.empty] = 0
+
+    @classmethod
+    def _from_arrays(cls, lower, upper, empty, value_class):
+        self = cls.__new__(cls)
+        self.value_class = value_class
+        self.lower = lower
+        self.upper = upper
+        self.empty = empty
+        return self
+
+    @classmethod
+    def from_queryset(cls, queryset, field_name=None):
+        """Builds an array from the temporal field of every row in queryset."""
+        field = get_temporal_field(queryset.model, field_name)
+        values = queryset.values_list(field.attname, flat=True).iterator()
+        return cls([field.to_python(v) for v in values], field.value_class)
+
+    @classmethod
+    def from_cursor(cls, cursor, column=0, value_class=Period):
+        """Builds an array from a column of the rows left in cursor."""
+        values = []
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                value = row[column]
+                if value is not None and not isinstance(value, Period):
+                    value = value_class(value)
+                values.append(value)
+        return cls(values, value_class)
+
+    def _unit(self):
+        if issubclass(self.value_class, DateRange):
+            return 'D'
+        return 'us'
+
+    def _to_int(self, value):
+        """Returns an instant as an integer in the units of this array."""
+        if issubclass(self.value_class, DateRange):
+            return value.toordinal() - EPOCH_ORDINAL
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time())
+        elif value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        delta = value - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    def _from_int(self, value):
+        if issubclass(self.value_class, DateRange):
+            return date.fromordinal(int(value) + EPOCH_ORDINAL)
+        return EPOCH + timedelta(microseconds=int(value))
+
+    def _bounds(self, period):
+        if not isinstance(period, Period):
+            period = self.value_class(period)
+        if period.empty:
+            return None
+        period = PeriodArray([period], self.value_class)
+        return period.lower[0], period.upper[0]
+
+    def __len__(self):
+        return len(self.lower)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, numpy.integer)):
+            if self.empty[index]:
+                return self.value_class(empty=True)
+            return self.value_class._from_bounds(
+                self._from_int(self.lower[index]), self._from_int(self.upper[index]))
+        return self._from_arrays(self.lower[index], self.upper[index], self.empty[index], self.value_class)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return '<%s of %d %s values>' % (self.__class__.__name__, len(self), self.value_class.__name__)
+
+    def contains(self, value):
+        """Returns a boolean array, True where the period contains value.
+
+        value is an instant or a period.
+        """
+        if isinstance(value, Period):
+            bounds = self._bounds(value)
+            if bounds is None:
+                return ~self.empty
+            lower, upper = bounds
+            return ~self.empty & (self.lower <= lower) & (upper <= self.upper)
+        value = self._to_int(value)
+        return ~self.empty & (self.lower <= value) & (value < self.upper)
+
+    def overlaps(self, period):
+        """Returns a boolean array, True where the period overlaps period."""
+        bounds = self._bounds(period)
+        if bounds is None:
+            return numpy.zeros(len(self), dtype=bool)
+        lower, upper = bounds
+        return ~self.empty & (self.upper > lower) & (upper > self.lower)
+
+    def intersection(self, period):
+        """Returns a new array of the intersections with period."""
+        bounds = self._bounds(period)
+        if bounds is None:
+            empty = numpy.ones(len(self), dtype=bool)
+            zeros = numpy.zeros(len(self), dtype=numpy.int64)
+            return self._from_arrays(zeros, zeros.copy(), empty, self.value_class)
+        lower, upper = bounds
+        empty = ~self.overlaps(period)
+        lower = numpy.where(empty, 0, numpy.maximum(self.lower, lower))
+        upper = numpy.where(empty, 0, numpy.minimum(self.upper, upper))
+        return self._from_arrays(lower, upper, empty, self.value_class)
+
+    def is_current(self):
+        """Returns a boolean array, True where the period is current."""
+        return ~self.empty & (self.upper == self._to_int(self.value_class._value_current))
+
+    def duration(self):
+        """Returns the length of each period as a timedelta64 array."""
+        length = numpy.where(self.empty, 0, self.upper - self.lower)
+        return length.astype('timedelta64[%s]' % self._unit())
+
+    def argsort(self):
+        """Returns the indices that order periods like sorting Periods does.
+
+        That is by lower and then upper bound, with empty periods last.
+        """
+        return numpy.lexsort((self.upper, self.lower, self.empty))
+
+    def sort(self):
+        """Sorts the periods in place."""
+        order = self.argsort()
+        self.lower = self.lower[order]
+        self.upper = self.upper[order]
+        self.empty = self.empty[order]
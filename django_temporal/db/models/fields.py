@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from datetime import datetime, date, tzinfo, timedelta
 import pytz
 import re
@@ -14,16 +15,27 @@ try:
 except ImportError, e:
     pgrange = None
 
-__all__ = ['TZDatetime', 'TZDateTimeField', 'TIME_CURRENT', 'Period', 'DateRange', 'PeriodField', 'DateRangeField', 'ForeignKey', 'TemporalForeignKey', 'DATE_CURRENT']
+__all__ = ['TZDatetime', 'TZDateTimeField', 'TIME_CURRENT', 'Period', 'DateRange', 'PeriodSet', 'PeriodField', 'DateRangeField', 'ForeignKey', 'TemporalForeignKey', 'DATE_CURRENT']
+
+_tz_cache = {}
+
+def get_tz(name):
+    """Returns the pytz time zone called name, looking each name up once."""
+    tz = _tz_cache.get(name)
+    if tz is None:
+        tz = _tz_cache[name] = pytz.timezone(name)
+    return tz
 
 class TZDatetime(datetime):
     def aslocaltimezone(self):
         """Returns the datetime in the local time zone."""
-        tz = pytz.timezone(settings.TIME_ZONE)
-        return self.astimezone(tz)
+        return self.astimezone(get_tz(settings.TIME_ZONE))
 
 # 2009-06-04 12:00:00+01:00 or 2009-06-04 12:00:00 +0100
 TZ_OFFSET = re.compile(r'^"?(.*?)\s?([-\+])(\d\d):?(\d\d)?"?$')
+# the ISO forms of the above, parsed without going through Django
+ISO_OFFSET = re.compile(r'^"?(\d{4})-(\d\d?)-(\d\d?)[T ](\d\d?):(\d\d?)'
+    r'(?::(\d\d?)(?:\.(\d{1,6})\d*)?)?\s?([-\+])(\d\d):?(\d\d)?"?$')
 
 TIME_CURRENT = datetime(9999, 12, 30, 0, 0, 0, 0)
 TIME_RESOLUTION = timedelta(0, 0, 1) # = 1 microsecond
@@ -44,6 +56,29 @@ class TZDateTimeField(models.DateTimeField):
         A wise datetime is left as-is. A string with a time zone offset is
         assigned to UTC.
         """
+        if type(value) is TZDatetime:
+            return value
+        match = isinstance(value, basestring) and ISO_OFFSET.match(value)
+        if match:
+            year, month, day, hour, minute, second, fraction, op, hours, minutes = match.groups()
+            try:
+                parsed = datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    second and int(second) or 0, fraction and int(fraction.ljust(6, '0')) or 0)
+            except ValueError:
+                # an invalid date, left for Django to report
+                pass
+            else:
+                offset = timedelta(hours=int(hours), minutes=minutes and int(minutes) or 0)
+                try:
+                    if op == '+':
+                        parsed = parsed - offset
+                    else:
+                        parsed = parsed + offset
+                except OverflowError:
+                    raise ValidationError("%r is out of the range of datetimes in UTC" % (value,))
+                return TZDatetime(parsed.year, parsed.month, parsed.day, parsed.hour,
+                    parsed.minute, parsed.second, parsed.microsecond, tzinfo=pytz.utc)
+        
         try:
             value = super(TZDateTimeField, self).to_python(value)
         except ValidationError:
@@ -52,7 +87,10 @@ class TZDateTimeField(models.DateTimeField):
                 value, op, hours, minutes = match.groups()
                 minutes = minutes is not None and minutes or '0'
                 value = super(TZDateTimeField, self).to_python(value)
-                value = value - timedelta(hours=int(op + hours), minutes=int(op + minutes))
+                try:
+                    value = value - timedelta(hours=int(op + hours), minutes=int(op + minutes))
+                except OverflowError:
+                    raise ValidationError("%r is out of the range of datetimes in UTC" % (value,))
                 value = value.replace(tzinfo=pytz.utc)
             else:
                 raise
@@ -74,7 +112,7 @@ def force_tz(obj, tz):
     forced to the timezone. Wise datetimes are converted.
     """
     if not isinstance(tz, tzinfo):
-        tz = pytz.timezone(tz)
+        tz = get_tz(tz)
     
     if (obj.tzinfo is None) or (obj.tzinfo.utcoffset(obj) is None):
         return tz.localize(obj)
@@ -82,14 +120,31 @@ def force_tz(obj, tz):
         return obj.astimezone(tz)
 
 
+# packed key of a missing upper bound, above any datetime in microseconds
+UNBOUNDED_KEY = 1 << 62
+
+PERIOD_RE = re.compile(r'^([\[\(])([^,]+),([^\]\)]+)([\]\)])$')
+
+
 class Period(object):
+    """A range of time between two points in time.
+    
+    Bounds are kept as naive datetimes in a closed-open representation.
+    Hashing, equality and ordering go through a packed integer key, which
+    is cached and reset whenever a bound changes.
+    """
+    __slots__ = ('empty', '_lower', '_upper', '_start_included', '_end_included', '_packed_key')
+    
     subvalue_class = TZDateTimeField
     _value_current = TIME_CURRENT
     _value_resolution = TIME_RESOLUTION
+    _value_min = datetime.min
     _input_type = datetime
     pg_dbvalue = pgrange != None and pgrange.DateTimeTZRange or None
+    pg_type = 'tstzrange'
     
     def __init__(self, period=None, lower=None, upper=None, empty=False):
+        self._packed_key = None
         self.empty = False
         if empty:
             self.empty = True
@@ -105,62 +160,90 @@ class Period(object):
         
         if period is not None:
             if isinstance(period, basestring):
-                m = re.match('^([\[\(])([^,]+),([^\]\)]+)([\]\)])$', period.strip())
+                m = PERIOD_RE.match(period.strip())
                 if not m:
                     if period.strip() == EMPTY or period.strip() == u'':
                         self.empty = True
                         return
                     raise TypeError("Invalid period string representation: %s" % repr(period))
                 start_in, lower, upper, end_in = m.groups()
-                
-                self.lower = self.subvalue_class().to_python(lower.strip())
-                self.upper = self.subvalue_class().to_python(upper.strip())
-                if start_in == '[':
-                    self.start_included = True
-                else:
-                    self.start_included = False
-                
-                if end_in == ']':
-                    self.end_included = True
-                else:
-                    self.end_included = False
+                self._set_bounds(
+                    self._parse_value(lower.strip()),
+                    self._parse_value(upper.strip()),
+                    start_in == '[',
+                    end_in == ']')
             elif pgrange is not None and isinstance(period, self.pg_dbvalue):
                 if period.isempty:
                     self.empty = period.isempty
                     return
-                self.lower = self.subvalue_class().to_python(period.lower)
-                self.start_included = bool(period.lower_inc)
-                self.upper = self.subvalue_class().to_python(period.upper)
-                self.end_included = bool(period.upper_inc)
+                self._set_bounds(
+                    self._coerce_value(period.lower),
+                    self._coerce_value(period.upper),
+                    bool(period.lower_inc),
+                    bool(period.upper_inc))
             elif isinstance(period, self.__class__):
                 if period.empty:
                     self.empty = period.empty
                     return
-                self.lower = period.lower
-                self.start_included = period.start_included
-                self.upper = period.upper
-                self.end_included = period.end_included
+                self._set_bounds(period._lower, period._upper,
+                    period._start_included, period._end_included)
         else:
-            self.lower = lower
-            self.start_included = True
+            lower = self._coerce_value(lower)
             if upper is not None:
-                self.upper = upper
-                self.end_included = False
+                self._set_bounds(lower, self._coerce_value(upper), True, False)
             else:
-                self.upper = self._value_current
-                self.end_included = True
-        self.normalize()
+                self._set_bounds(lower, self._value_current, True, True)
+    
+    @classmethod
+    def _from_bounds(cls, lower, upper, start_included=True, end_included=False):
+        """Builds a period from bounds, skipping argument parsing."""
+        self = cls.__new__(cls)
+        self._packed_key = None
+        self.empty = False
+        self._set_bounds(self._coerce_value(lower), self._coerce_value(upper),
+            start_included, end_included)
+        return self
+    
+    def _set_bounds(self, lower, upper, start_included, end_included):
+        """Sets already coerced bounds, normalizing them to closed-open."""
+        if not start_included and lower is not None:
+            lower = lower + self._value_resolution
+        if end_included and upper is not None:
+            upper = upper + self._value_resolution
+        self._lower = lower
+        self._upper = upper
+        self._start_included = True
+        self._end_included = False
+        self._packed_key = None
+    
+    def _coerce_value(self, value):
+        """Returns value as a naive datetime, converting aware ones to UTC."""
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                return value
+            return value.replace(tzinfo=None) - value.utcoffset()
+        raise AssertionError("should never happen")
+    
+    def _parse_value(self, value):
+        return self._coerce_value(_tz_datetime_field.to_python(value))
+    
+    def __getstate__(self):
+        if self.empty:
+            return (True,)
+        return (False, self._lower, self._upper, self._start_included, self._end_included)
+    
+    def __setstate__(self, state):
+        self._packed_key = None
+        self.empty = state[0]
+        if not self.empty:
+            self._lower, self._upper, self._start_included, self._end_included = state[1:]
     
     def lower():
         def fget(self):
             return self._lower
         def fset(self, value):
-            if isinstance(value, TZDatetime):
-                self._lower = value.replace(tzinfo=None)
-            elif isinstance(value, self._input_type):
-                self._lower = self.subvalue_class().to_python(value.strftime(u'%Y-%m-%d %H:%M:%S.%f%z')).replace(tzinfo=None)
-            else:
-                raise AssertionError("should never happen")
+            self._lower = self._coerce_value(value)
+            self._packed_key = None
         return (fget, fset, None, "lower limit of period")
     lower = property(*lower())
     
@@ -171,6 +254,7 @@ class Period(object):
             if not value in (True, False):
                 raise ValueError("Must be True or False")
             self._start_included = value
+            self._packed_key = None
         return (fget, fset, None, "denotes if lower limit timestamp is open or closed")
     start_included = property(*start_included())
     
@@ -178,12 +262,8 @@ class Period(object):
         def fget(self):
             return self._upper
         def fset(self, value):
-            if isinstance(value, TZDatetime):
-                self._upper = value.replace(tzinfo=None)
-            elif isinstance(value, self._input_type):
-                self._upper = self.subvalue_class().to_python(value.strftime(u'%Y-%m-%d %H:%M:%S.%f%z')).replace(tzinfo=None)
-            else:
-                raise AssertionError("should never happen")
+            self._upper = self._coerce_value(value)
+            self._packed_key = None
         return (fget, fset, None, "upper limit of period")
     upper = property(*upper())
     
@@ -194,20 +274,63 @@ class Period(object):
             if not value in (True, False):
                 raise ValueError("Must be True or False")
             self._end_included = value
+            self._packed_key = None
         return (fget, fset, None, "denotes if end timestamp is open or closed")
     end_included = property(*end_included())
     
+    def _value_int(self, value):
+        """Returns a bound as microseconds since 0001-01-01."""
+        return ((value.toordinal() * 86400 + value.hour * 3600 + value.minute * 60
+            + value.second) * 1000000 + value.microsecond)
+    
+    def _key(self):
+        """Returns the packed (empty, lower, upper) key of the closed-open form.
+        
+        Bounds are integers in units of _value_resolution, empty periods
+        order after all others.
+        """
+        key = self._packed_key
+        if key is None:
+            if self.empty:
+                key = (1, 0, 0)
+            else:
+                lower, upper = self._lower, self._upper
+                if lower is None:
+                    lower = 0
+                else:
+                    lower = self._value_int(lower) + (not self._start_included)
+                if upper is None:
+                    upper = UNBOUNDED_KEY
+                else:
+                    upper = self._value_int(upper) + self._end_included
+                key = (0, lower, upper)
+            self._packed_key = key
+        return key
+    
+    def __hash__(self):
+        return hash(self._packed_key or self._key())
+    
     def __eq__(self, other):
-        if self.empty and other.empty:
-            return True
-        if (self.empty and not other.empty) or (not self.empty and other.empty):
-            return False
-        if  self.start_included == other.start_included and \
-            self.end_included == other.end_included and \
-            self.lower == other.lower and\
-            self.upper == other.upper:
-            return True
-        return False
+        if not isinstance(other, Period):
+            return NotImplemented
+        return (self._packed_key or self._key()) == (other._packed_key or other._key())
+    
+    def __ne__(self, other):
+        if not isinstance(other, Period):
+            return NotImplemented
+        return (self._packed_key or self._key()) != (other._packed_key or other._key())
+    
+    def __lt__(self, other):
+        return (self._packed_key or self._key()) < (other._packed_key or other._key())
+    
+    def __le__(self, other):
+        return (self._packed_key or self._key()) <= (other._packed_key or other._key())
+    
+    def __gt__(self, other):
+        return (self._packed_key or self._key()) > (other._packed_key or other._key())
+    
+    def __ge__(self, other):
+        return (self._packed_key or self._key()) >= (other._packed_key or other._key())
     
     def normalize(self):
         if not self.start_included:
@@ -259,16 +382,17 @@ class Period(object):
         return self.intersection(other)
     
     def union(self, other):
-        if self.overlaps:
-            return self.__class__(lower=min(self.lower, other.lower), upper=max(self.upper, other.upper))
-        return [self, other]
+        """Returns the union as a period, or a PeriodSet if there is a gap."""
+        periods = PeriodSet([self, other])
+        if len(periods) > 1:
+            return periods
+        if periods:
+            return periods[0]
+        return self.__class__(empty=True)
 
     def __add__(self, other):
         return self.union(other)
 
-    def __cmp__(self, other):
-        return cmp(self.lower, other.lower) or cmp(self.upper, other.upper)
-
     def __unicode__(self):
         if self.empty:
             return EMPTY
@@ -289,43 +413,197 @@ class Period(object):
         return value.replace(tzinfo=pytz.UTC).strftime(u'%Y-%m-%d %H:%M:%S.%f%z')
 
 class DateRange(Period):
+    """A range of dates, with bounds kept as dates."""
+    __slots__ = ()
+    
     description = "a range of dates"
     subvalue_class = models.DateField
     _value_current = DATE_CURRENT
     _value_resolution = DATE_RESOLUTION
+    _value_min = date.min
     _input_type = date
     pg_dbvalue = pgrange != None and pgrange.DateRange or None
+    pg_type = 'daterange'
 
     def _value_unicode(self, value):
         if value is None:
             return ''
         return value.strftime(u'%Y-%m-%d')
+    
+    def _value_int(self, value):
+        return value.toordinal()
+    
+    def _coerce_value(self, value):
+        """Returns value as a date, dropping the time of datetimes."""
+        if value is None or type(value) is date:
+            return value
+        if isinstance(value, date):
+            return date(value.year, value.month, value.day)
+        raise AssertionError("should never happen")
+    
+    def _parse_value(self, value):
+        return self._coerce_value(_date_field.to_python(value))
 
-    def lower():
-        def fget(self):
-            return self.__lower
-        def fset(self, value):
-            if isinstance(value, date):
-                self.__lower = self.subvalue_class().to_python(value.strftime(u'%Y-%m-%d'))
-            elif value is None:
-                self.__lower = None
+
+class PeriodSet(object):
+    """A set of points in time, kept as a sorted list of disjoint periods.
+    
+    Overlapping and adjacent periods are coalesced when the set is built,
+    which costs O(n log n). Set operations between two sets sweep over
+    their sorted bounds in linear time.
+    """
+    __slots__ = ('value_class', '_bounds')
+    
+    def __init__(self, periods=(), value_class=None):
+        pairs = []
+        for period in periods:
+            if value_class is None:
+                value_class = period.__class__
+            if period.empty:
+                continue
+            lower, upper = period.lower, period.upper
+            if lower is None or upper is None:
+                raise ValueError("Unbounded periods can not be part of a PeriodSet: %r" % (period,))
+            if not period.start_included:
+                lower = lower + period._value_resolution
+            if period.end_included:
+                upper = upper + period._value_resolution
+            if lower < upper:
+                pairs.append((lower, upper))
+        pairs.sort()
+        
+        bounds = []
+        for lower, upper in pairs:
+            if bounds and lower <= bounds[-1]:
+                if upper > bounds[-1]:
+                    bounds[-1] = upper
             else:
-                raise AssertionError("should never happen")
-        return (fget, fset, None, "lower limit of date range")
-    lower = property(*lower())
+                bounds.append(lower)
+                bounds.append(upper)
+        self.value_class = value_class or Period
+        self._bounds = bounds
     
-    def upper():
-        def fget(self):
-            return self.__upper
-        def fset(self, value):
-            if isinstance(value, date):
-                self.__upper = self.subvalue_class().to_python(value.strftime(u'%Y-%m-%d'))
-            elif value is None:
-                self.__upper = None
+    @classmethod
+    def _from_bounds(cls, bounds, value_class):
+        self = cls.__new__(cls)
+        self.value_class = value_class
+        self._bounds = bounds
+        return self
+    
+    def _as_set(self, other):
+        if isinstance(other, PeriodSet):
+            return other
+        if isinstance(other, Period):
+            other = [other]
+        return PeriodSet(other, self.value_class)
+    
+    def _combine(self, other, op):
+        """Sweeps over the bounds of both sets, keeping points where op holds."""
+        a = self._bounds
+        b = self._as_set(other)._bounds
+        len_a, len_b = len(a), len(b)
+        i = j = 0
+        in_a = in_b = inside = False
+        bounds = []
+        while i < len_a or j < len_b:
+            if j >= len_b or (i < len_a and a[i] <= b[j]):
+                point = a[i]
             else:
-                raise AssertionError("should never happen")
-        return (fget, fset, None, "upper limit of date range")
-    upper = property(*upper())
+                point = b[j]
+            while i < len_a and a[i] == point:
+                in_a = not in_a
+                i += 1
+            while j < len_b and b[j] == point:
+                in_b = not in_b
+                j += 1
+            if op(in_a, in_b) != inside:
+                inside = not inside
+                bounds.append(point)
+        return self._from_bounds(bounds, self.value_class)
+    
+    def union(self, other):
+        return self._combine(other, lambda a, b: a or b)
+    
+    def intersection(self, other):
+        return self._combine(other, lambda a, b: a and b)
+    
+    def difference(self, other):
+        return self._combine(other, lambda a, b: a and not b)
+    
+    def complement(self, within=None):
+        """Returns the points of `within` that are not in this set.
+        
+        By default `within` reaches from the earliest representable time up
+        to the current time (TIME_CURRENT or DATE_CURRENT).
+        """
+        if within is None:
+            within = self.value_class(lower=self.value_class._value_min,
+                upper=self.value_class._value_current)
+        return self._as_set(within).difference(self)
+    
+    def gaps(self):
+        """Returns the periods missing between the start and end of this set."""
+        if not self._bounds:
+            return self._from_bounds([], self.value_class)
+        return self.complement(self.value_class(lower=self._bounds[0], upper=self._bounds[-1]))
+    
+    def duration(self):
+        """Returns the total length of time covered by this set."""
+        bounds = self._bounds
+        total = timedelta(0)
+        for i in xrange(0, len(bounds), 2):
+            total += bounds[i + 1] - bounds[i]
+        return total
+    
+    __or__ = __add__ = union
+    __and__ = __mul__ = intersection
+    __sub__ = difference
+    
+    def __contains__(self, value):
+        bounds = self._bounds
+        if isinstance(value, Period):
+            if value.empty:
+                return True
+            i = bisect_right(bounds, value.lower)
+            return i % 2 == 1 and value.upper <= bounds[i]
+        i = bisect_right(bounds, value)
+        return i % 2 == 1
+    
+    def __len__(self):
+        return len(self._bounds) // 2
+    
+    def __nonzero__(self):
+        return bool(self._bounds)
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PeriodSet index out of range")
+        return self.value_class._from_bounds(self._bounds[2 * index], self._bounds[2 * index + 1])
+    
+    def __iter__(self):
+        bounds = self._bounds
+        make = self.value_class._from_bounds
+        for i in xrange(0, len(bounds), 2):
+            yield make(bounds[i], bounds[i + 1])
+    
+    def __eq__(self, other):
+        if not isinstance(other, PeriodSet):
+            return NotImplemented
+        return self._bounds == other._bounds
+    
+    def __ne__(self, other):
+        if not isinstance(other, PeriodSet):
+            return NotImplemented
+        return self._bounds != other._bounds
+    
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ', '.join([unicode(p) for p in self]))
+
+
+_tz_datetime_field = TZDateTimeField()
+_date_field = models.DateField()
 
 
 class PeriodField(models.Field):
@@ -370,7 +648,7 @@ class PeriodField(models.Field):
                 'overlaps', 'before', 'after', 'overleft', 'overright', 'adjacent'):
             if not isinstance(value, self.value_class):
                 value = self.value_class(value)
-            return unicode(value)
+            return value
         if lookup_type in ('prior', 'lower', 'upper', 'later'):
             if self.value_class == Period and isinstance(value, datetime):
                 return unicode(value)
@@ -386,6 +664,8 @@ class PeriodField(models.Field):
         if lookup_type in ('exact', 'lt', 'lte', 'gt', 'gte'):
             return super(PeriodField, self).get_db_prep_lookup(lookup_type=lookup_type, value=value, connection=connection, prepared=prepared)
         elif lookup_type in ('nequals', 'contains', 'contained_by', 'overlaps', 'before', 'after', 'overleft', 'overright', 'adjacent'):
+            if isinstance(value, Period):
+                return [self.get_db_prep_value(value, connection, prepared=True)]
             return [value]
         elif lookup_type in ('prior', 'lower', 'upper', 'later'):
             return [value]
@@ -398,6 +678,10 @@ class PeriodField(models.Field):
         else:
             if self.null and value is None:
                 return None
+            if hasattr(connection.ops, 'Adapter'):
+                if not isinstance(value, self.value_class):
+                    value = self.value_class(value)
+                return connection.ops.Adapter(value)
             if pgrange is not None:
                 if self.value_class == DateRange:
                     pg_klass = pgrange.DateRange
@@ -428,6 +712,26 @@ class DateRangeField(PeriodField):
     def db_type(self, connection):
         return 'daterange'
 
+def get_temporal_field(model, field_name=None):
+    """Returns the temporal field of a model.
+    
+    That is the field named `field_name` if given, otherwise the model's
+    ValidTime or, failing that, its only PeriodField.
+    """
+    fields = model._meta.fields
+    if field_name is not None:
+        for f in fields:
+            if f.name == field_name and isinstance(f, PeriodField):
+                return f
+        raise ValueError("%s has no temporal field named %r" % (model.__name__, field_name))
+    periods = [f for f in fields if isinstance(f, PeriodField)]
+    valid = [f for f in periods if isinstance(f, ValidTime)]
+    if len(valid) == 1:
+        return valid[0]
+    if len(periods) == 1:
+        return periods[0]
+    raise ValueError("Can not tell the temporal field of %s, please name it" % model.__name__)
+
 class TemporalForeignKey(models.ForeignKey):
     def __init__(self, *args, **kwargs):
         temp_current = False
@@ -0,0 +1,228 @@
+import itertools
+import random
+from datetime import datetime, date, time
+
+from django_temporal.db.models.fields import Period, DateRange, get_temporal_field
+
+__all__ = ['PeriodIndex', 'PeriodIndexEntry']
+
+
+class PeriodIndexEntry(object):
+    """A period and its payload, as stored in a PeriodIndex.
+
+    Entries are returned by queries and serve as handles for close() and
+    remove().
+    """
+    __slots__ = ('period', 'payload', 'lower', 'upper', 'key', 'priority', 'max_upper', 'left', 'right')
+
+    def __init__(self, period, payload, lower, upper, key, priority):
+        self.period = period
+        self.payload = payload
+        self.lower = lower
+        self.upper = upper
+        self.key = key
+        self.priority = priority
+        self.max_upper = upper
+        self.left = None
+        self.right = None
+
+    def __repr__(self):
+        return '<%s %r: %r>' % (self.__class__.__name__, self.period, self.payload)
+
+
+def _update(node):
+    max_upper = node.upper
+    if node.left is not None and node.left.max_upper > max_upper:
+        max_upper = node.left.max_upper
+    if node.right is not None and node.right.max_upper > max_upper:
+        max_upper = node.right.max_upper
+    node.max_upper = max_upper
+
+def _rotate_right(node):
+    left = node.left
+    node.left = left.right
+    left.right = node
+    _update(node)
+    _update(left)
+    return left
+
+def _rotate_left(node):
+    right = node.right
+    node.right = right.left
+    right.left = node
+    _update(node)
+    _update(right)
+    return right
+
+def _insert(node, entry):
+    if node is None:
+        return entry
+    if entry.key < node.key:
+        node.left = _insert(node.left, entry)
+        if node.left.priority > node.priority:
+            return _rotate_right(node)
+    else:
+        node.right = _insert(node.right, entry)
+        if node.right.priority > node.priority:
+            return _rotate_left(node)
+    _update(node)
+    return node
+
+def _join(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _join(left.right, right)
+        _update(left)
+        return left
+    right.left = _join(left, right.left)
+    _update(right)
+    return right
+
+def _remove(node, key):
+    if node is None:
+        raise KeyError(key)
+    if key < node.key:
+        node.left = _remove(node.left, key)
+    elif key > node.key:
+        node.right = _remove(node.right, key)
+    else:
+        return _join(node.left, node.right)
+    _update(node)
+    return node
+
+def _overlapping(node, lower, upper, found):
+    while node is not None:
+        if node.max_upper <= lower:
+            return
+        if node.left is not None:
+            _overlapping(node.left, lower, upper, found)
+        if node.lower >= upper:
+            return
+        if node.upper > lower:
+            found.append(node)
+        node = node.right
+
+def _walk(node):
+    while node is not None:
+        for entry in _walk(node.left):
+            yield entry
+        yield node
+        node = node.right
+
+
+class PeriodIndex(object):
+    """An in-memory interval tree over periods and their payloads.
+
+    The index is a treap ordered by lower bound, where every node also keeps
+    the greatest upper bound of its subtree. Inserting, closing and removing
+    entries take O(log n) expected time. Queries skip every subtree that can
+    not hold a match, and return matching entries ordered by lower bound.
+
+    Bounds are indexed in the closed-open form Period.normalize gives, and
+    DateRange indexes work on whole days.
+    """
+
+    def __init__(self, items=(), value_class=None):
+        self.value_class = value_class
+        self._root = None
+        self._len = 0
+        self._counter = itertools.count()
+        self._random = random.Random()
+        for period, payload in items:
+            self.insert(period, payload)
+
+    @classmethod
+    def from_queryset(cls, queryset, field_name=None):
+        """Builds an index of queryset's objects by their temporal field."""
+        field = get_temporal_field(queryset.model, field_name)
+        return cls([(getattr(obj, field.attname), obj) for obj in queryset], field.value_class)
+
+    def _bounds(self, period):
+        if period.empty:
+            raise ValueError("Empty periods can not be indexed")
+        lower, upper = period.lower, period.upper
+        if lower is None:
+            lower = date.min
+        elif not period.start_included:
+            lower = lower + period._value_resolution
+        if upper is None:
+            upper = date.max
+        elif period.end_included:
+            upper = upper + period._value_resolution
+        return lower, upper
+
+    def _instant(self, value):
+        if issubclass(self.value_class or Period, DateRange):
+            if isinstance(value, datetime):
+                return value.date()
+            return value
+        if not isinstance(value, datetime):
+            return datetime.combine(value, time())
+        if value.tzinfo is not None:
+            return value.replace(tzinfo=None) - value.utcoffset()
+        return value
+
+    def insert(self, period, payload=None):
+        """Adds period with payload to the index and returns its entry."""
+        if self.value_class is None:
+            self.value_class = period.__class__
+        lower, upper = self._bounds(period)
+        entry = PeriodIndexEntry(period, payload, lower, upper,
+            (lower, next(self._counter)), self._random.random())
+        self._root = _insert(self._root, entry)
+        self._len += 1
+        return entry
+
+    def remove(self, entry):
+        """Removes an entry from the index."""
+        self._root = _remove(self._root, entry.key)
+        self._len -= 1
+
+    def close(self, entry, at):
+        """Ends the validity of an entry at the instant `at`."""
+        at = self._instant(at)
+        path = []
+        node = self._root
+        while node is not entry:
+            if node is None:
+                raise KeyError(entry.key)
+            path.append(node)
+            if entry.key < node.key:
+                node = node.left
+            else:
+                node = node.right
+        entry.upper = at
+        entry.period = self.value_class._from_bounds(entry.lower, at)
+        _update(entry)
+        for node in reversed(path):
+            _update(node)
+
+    def at(self, instant):
+        """Returns the entries valid at instant."""
+        instant = self._instant(instant)
+        found = []
+        _overlapping(self._root, instant, instant + (self.value_class or Period)._value_resolution, found)
+        return found
+
+    def overlapping(self, period):
+        """Returns the entries whose period overlaps period."""
+        if period.empty:
+            return []
+        lower, upper = self._bounds(period)
+        found = []
+        _overlapping(self._root, lower, upper, found)
+        return found
+
+    def current(self):
+        """Returns the entries valid at current time."""
+        value_class = self.value_class or Period
+        return self.at(value_class._value_current - value_class._value_resolution)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return _walk(self._root)
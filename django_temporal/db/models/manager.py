@@ -7,6 +7,27 @@ class TemporalManager(Manager):
     def get_query_set(self):
         return TemporalQuerySet(self.model)
     
+    def current(self, field_name=None):
+        return self.get_query_set().current(field_name)
+    
+    def as_of(self, instant, field_name=None):
+        return self.get_query_set().as_of(instant, field_name)
+    
+    def with_period(self, name, operator, period, field_name=None):
+        return self.get_query_set().with_period(name, operator, period, field_name)
+    
+    def sequenced_join(self, field_name, name='period', temporal_field=None, related_temporal_field=None):
+        return self.get_query_set().sequenced_join(field_name, name, temporal_field, related_temporal_field)
+    
+    def coalesce(self, fields=None, field_name=None):
+        return self.get_query_set().coalesce(fields, field_name)
+    
+    def as_of_many(self, instants, field_name=None, chunk_size=2000):
+        return self.get_query_set().as_of_many(instants, field_name, chunk_size)
+    
+    def sequenced_aggregate(self, function='count', field=None, start=None, end=None, step=None,
+            field_name=None, chunk_size=2000):
+        return self.get_query_set().sequenced_aggregate(function, field, start, end, step, field_name, chunk_size)
+    
     def at(self, time):
-        return self.get_query_set().filter(valid_time__contains=time)
-
+        return self.as_of(time)
@@ -1,7 +1,198 @@
+import uuid
+
+from django.db import connections, transaction
 from django.db.models.query import QuerySet, Q, ValuesQuerySet, ValuesListQuerySet
+from django_temporal.db.models.fields import get_temporal_field
 from django_temporal.db.models.sql.query import TemporalQuery
 
 class TemporalQuerySet(QuerySet):
     def __init__(self, model=None, query=None, using=None, **kwargs):
         super(TemporalQuerySet, self).__init__(model=model, query=query, using=using, **kwargs)
         self.query = query or TemporalQuery(self.model)
+    
+    def current(self, field_name=None):
+        """Returns the records valid at the current time.
+        
+        The temporal field is found with get_temporal_field. The predicate
+        is `upper(field) = current`, the expression of the index on the
+        upper bound of temporal fields.
+        """
+        field = get_temporal_field(self.model, field_name)
+        return self.filter(**{field.name + '__upper': field.value_class._value_current})
+    
+    def as_of(self, instant, field_name=None):
+        """Returns the records valid at instant, a date or a datetime.
+        
+        The predicate is `field @> instant`, which the GiST index of the
+        temporal field serves.
+        """
+        field = get_temporal_field(self.model, field_name)
+        return self.filter(**{field.name + '__contains': instant})
+    
+    def with_period(self, name, operator, period, field_name=None):
+        """Annotates the records with `name`, the period `operator`, one of
+        "union", "intersection" and "minus", makes of the temporal field and
+        period.
+        
+        A union of periods which neither overlap nor touch is an error in
+        the database, as is a difference which would split a period.
+        """
+        field = get_temporal_field(self.model, field_name)
+        conn = connections[self.db]
+        column = '%s.%s' % (conn.ops.quote_name(self.model._meta.db_table), conn.ops.quote_name(field.column))
+        return self.extra(select={name: conn.ops.temporal_period_sql(operator, column)},
+            select_params=[field.get_db_prep_value(period, conn)])
+    
+    def sequenced_join(self, field_name, name='period', temporal_field=None, related_temporal_field=None):
+        """Joins the records with the versions of the related model, by the
+        foreign key `field_name`, which were valid at the same time.
+        
+        The related records are selected with the records, which are
+        annotated with `name`, the intersection of both temporal fields.
+        Both temporal fields are compared with the overlaps operator, which
+        their GiST indexes serve.
+        """
+        fk = self.model._meta.get_field(field_name)
+        related = fk.rel.to
+        field = get_temporal_field(self.model, temporal_field)
+        related_field = get_temporal_field(related, related_temporal_field)
+        conn = connections[self.db]
+        qn = conn.ops.quote_name
+        
+        # the filter joins the related table, whose alias it names
+        qs = self.filter(**{'%s__%s__isnull' % (field_name, related_field.name): False}).select_related(field_name)
+        base = qs.query.get_initial_alias()
+        alias = [a for a in qs.query.tables if a != base and qs.query.alias_map[a].table_name == related._meta.db_table
+            and qs.query.alias_map[a].lhs_alias == base][-1]
+        lhs = '%s.%s' % (qn(base), qn(field.column))
+        rhs = '%s.%s' % (qn(alias), qn(related_field.column))
+        return qs.extra(select={name: conn.ops.temporal_period_sql('intersection', lhs, rhs)},
+            where=[conn.ops.temporal_operators['overlaps'].as_sql(lhs, rhs)])
+    
+    def coalesce(self, fields=None, field_name=None):
+        """Coalesces the value-equivalent versions among the records, see
+        django_temporal.utils.coalesce. Returns the number removed."""
+        from django_temporal.utils import coalesce
+        return coalesce(self, fields, valid_field=field_name)
+    
+    def as_of_many(self, instants, field_name=None, chunk_size=2000):
+        """Yields (instant, record) pairs of the records valid at each of
+        instants, in order of the instants.
+        
+        The records are joined with `unnest(instants)` on the contains
+        operator in a single query, and read through a server-side cursor
+        `chunk_size` at a time, in a transaction which lasts until they
+        have all been read.
+        """
+        field = get_temporal_field(self.model, field_name)
+        conn = connections[self.db]
+        qn = conn.ops.quote_name
+        fields = self.model._meta.fields
+        sql, params = self.values_list(*[f.attname for f in fields]).query.sql_with_params()
+        contains = conn.ops.temporal_operators['contains'].as_sql(
+            'q.' + qn(field.column), 'i.' + qn('instant'))
+        sql = 'SELECT i.' + qn('instant') + ', q.* FROM unnest(%s::' + conn.ops.temporal_element_types[field.db_type(conn)] \
+            + '[]) AS i(' + qn('instant') + ') JOIN (' + sql + ') AS q ON ' + contains \
+            + ' ORDER BY i.' + qn('instant') + ', q.' + qn(self.model._meta.pk.column)
+        
+        for row in self._stream('as_of_many', sql, [list(instants)] + list(params), chunk_size):
+            obj = self.model(*row[1:])
+            # as QuerySet.iterator marks the records it loads
+            obj._state.db = self.db
+            obj._state.adding = False
+            yield row[0], obj
+    
+    def sequenced_aggregate(self, function='count', field=None, start=None, end=None, step=None,
+            field_name=None, chunk_size=2000):
+        """Yields (period, value) pairs, the step function of the aggregate
+        `function`, one of "count", "sum" and "avg", of `field` over the
+        records valid at each point in time, in order of the periods.
+        
+        The step function is computed in the database by a sweep over the
+        lower and upper bounds of the temporal field: each bound adds or
+        removes a record, and running sums over the bounds give the value
+        between them. Adjacent periods with the same value are joined, and
+        the records are limited to between `start` and `end`, either of
+        which may be None.
+        
+        With `step`, a timedelta, the periods are instead buckets of step
+        from start to end, which both need to be given, made with
+        generate_series, and the value of a bucket is the aggregate over
+        the records valid at any time in it.
+        
+        The rows are read through a server-side cursor like as_of_many.
+        """
+        if function not in ('count', 'sum', 'avg'):
+            raise ValueError("Unknown sequenced aggregate: %s" % function)
+        if function != 'count' and field is None:
+            raise ValueError("The %s of which field?" % function)
+        temporal_field = get_temporal_field(self.model, field_name)
+        conn = connections[self.db]
+        qn = conn.ops.quote_name
+        db_type = temporal_field.db_type(conn)
+        element_type = conn.ops.temporal_element_types[db_type]
+        columns = [temporal_field.attname]
+        if field is not None:
+            columns.append(self.model._meta.get_field(field).attname)
+        qs = self.values_list(*columns)
+        if field is not None:
+            qs = qs.filter(**{field + '__isnull': False})
+        sql, params = qs.query.sql_with_params()
+        value = field is None and '0' or 'q.x'
+        bounds = ['%s::' + element_type, '%s::' + element_type]
+        
+        if step is None:
+            within = db_type + '(' + ', '.join(bounds) + ", '[)')"
+            aggregate = {
+                'count': 'n::bigint',
+                'sum': 'CASE WHEN n > 0 THEN x END',
+                'avg': 'CASE WHEN n > 0 THEN x / n END',
+            }[function]
+            sql = ('WITH q AS (SELECT greatest(lower(q.v), ' + bounds[0] + ') AS l, least(upper(q.v), ' + bounds[1] + ') AS u, '
+                    + value + ' AS x FROM (' + sql + ') AS q(v' + (field is not None and ', x' or '') + ')'
+                    + ' WHERE NOT isempty(q.v) AND q.v && ' + within + '), '
+                'events AS (SELECT l AS t, 1 AS n, x FROM q UNION ALL SELECT u, -1, -x FROM q), '
+                'steps AS (SELECT t, sum(sum(n)) OVER w AS n, sum(sum(x)) OVER w AS x FROM events GROUP BY t WINDOW w AS (ORDER BY t)), '
+                'vals AS (SELECT t, lead(t) OVER (ORDER BY t) AS u, ' + aggregate + ' AS value FROM steps), '
+                # gaps and islands: a change of value starts a new period
+                'changes AS (SELECT t, u, value, CASE WHEN value IS NOT DISTINCT FROM lag(value) OVER (ORDER BY t) '
+                    'THEN 0 ELSE 1 END AS c FROM vals WHERE u IS NOT NULL), '
+                'islands AS (SELECT t, u, value, sum(c) OVER (ORDER BY t) AS i FROM changes) '
+                'SELECT min(t), max(u), value FROM islands GROUP BY i, value ORDER BY min(t)')
+            params = [start, end] + list(params) + [start, end]
+        else:
+            if start is None or end is None:
+                raise ValueError("Buckets need both start and end")
+            aggregate = {
+                'count': 'count(q.v)',
+                'sum': 'sum(q.x)',
+                'avg': 'avg(q.x)',
+            }[function]
+            sql = ('SELECT b.l, b.u, ' + aggregate + ' FROM (SELECT b::' + element_type + ' AS l, '
+                    'least(b + %s::interval, ' + bounds[1] + ')::' + element_type + ' AS u '
+                    'FROM generate_series(' + bounds[0] + ', ' + bounds[1] + ', %s::interval) AS b '
+                    'WHERE b < ' + bounds[1] + ') AS b '
+                'LEFT JOIN (' + sql + ') AS q(v' + (field is not None and ', x' or '') + ') '
+                    'ON q.v && ' + db_type + "(b.l, b.u, '[)') "
+                'GROUP BY b.l, b.u ORDER BY b.l')
+            params = [step, end, start, end, step, end] + list(params)
+        
+        make = temporal_field.value_class._from_bounds
+        for lower, upper, value in self._stream('sequenced_aggregate', sql, params, chunk_size):
+            yield make(lower, upper), value
+    
+    def _stream(self, name, sql, params, chunk_size):
+        """Yields the rows of sql, read through a server-side cursor
+        `chunk_size` at a time."""
+        conn = connections[self.db]
+        with transaction.commit_on_success(using=self.db):
+            conn.cursor()
+            cursor = conn.connection.cursor('%s_%s' % (name, uuid.uuid4().hex[:12]))
+            # the server-side cursor bypasses Django, which would not end
+            # a transaction it has not seen used
+            transaction.set_dirty(using=self.db)
+            cursor.itersize = chunk_size
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+            cursor.close()
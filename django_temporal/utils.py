@@ -1,19 +1,1133 @@
+import bz2
+import collections
 import csv
+import cStringIO
 import datetime
+import decimal
+import itertools
+import json
 import logging
-import os
+import re
+import struct
+import sys
+import threading
 import time
+import uuid
+import zlib
 
-from django.db import connection, transaction
+import pytz
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import DateField, TimeField
+from django.db.models.query import QuerySet
 from psycopg2.extensions import adapt
-from django_temporal.db.models.fields import DATE_CURRENT, TIME_CURRENT
-# TODO
-# merge in between two times
-# documentation
+from django_temporal.db.models.fields import DATE_CURRENT, TIME_CURRENT, TZDateTimeField, force_tz, get_temporal_field
 
-def merge(new_csv, model, timestamp, keys, snapshot='full', copy_fields=None, callback=None, conn=None, valid_field='valid', debug=False):
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# bytes read or generated at a time when feeding COPY
+COPY_CHUNK_SIZE = 64 * 1024
+# Keys are locked in this many ranges of their hash, so that a merge takes
+# no more advisory locks than half the default max_locks_per_transaction.
+KEY_LOCK_BUCKETS = 32
+
+
+class CompressedReader(object):
+    """A file-like reader which decompresses gzip or bz2 data on the fly.
+    
+    The compression is detected from the first bytes of the data. Other
+    data is passed through as it is, unicode is encoded to UTF-8.
+    """
+    copy_options = "CSV NULL ''"
+    
+    def __init__(self, fileobj, chunk_size=COPY_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._raw = self._read_raw()
+        if self._raw.startswith('\x1f\x8b'):
+            self._new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._raw.startswith('BZh'):
+            self._new_decompressor = bz2.BZ2Decompressor
+        else:
+            self._new_decompressor = None
+        self._decompressor = self._new_decompressor and self._new_decompressor()
+        self._buffer = ''
+        self._eof = False
+    
+    def _read_raw(self):
+        data = self.fileobj.read(self.chunk_size)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+    
+    def _fill(self):
+        """Adds the next chunk of data to the buffer, False at the end."""
+        while not self._eof:
+            raw, self._raw = self._raw or self._read_raw(), ''
+            if not raw:
+                self._eof = True
+                if self._decompressor is not None and hasattr(self._decompressor, 'flush'):
+                    self._buffer += self._decompressor.flush()
+                return False
+            if self._decompressor is None:
+                self._buffer += raw
+                return True
+            data = self._decompressor.decompress(raw)
+            # concatenated gzip or bz2 streams start over
+            unused = self._decompressor.unused_data
+            while unused:
+                if hasattr(self._decompressor, 'flush'):
+                    data += self._decompressor.flush()
+                self._decompressor = self._new_decompressor()
+                data += self._decompressor.decompress(unused)
+                unused = self._decompressor.unused_data
+            if data:
+                self._buffer += data
+                return True
+        return False
+    
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+    
+    def readline(self):
+        while '\n' not in self._buffer and self._fill():
+            pass
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+
+class RowReader(object):
+    """A file-like reader which writes rows as CSV for COPY, a chunk at a time.
+    
+    None values are written as NULL.
+    """
+    copy_options = "CSV NULL ''"
+    
+    def __init__(self, rows, fields, chunk_size=COPY_CHUNK_SIZE):
+        self.rows = rows
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self._buffer = cStringIO.StringIO()
+        self._writer = csv.writer(self._buffer)
+    
+    def _value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if not isinstance(value, str) and hasattr(value, '__unicode__'):
+            return unicode(value).encode('utf-8')
+        return value
+    
+    def _row(self, row):
+        if isinstance(row, dict):
+            return [self._value(row.get(f)) for f in self.fields]
+        return [self._value(v) for v in row]
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = self.chunk_size
+        buf = self._buffer
+        if buf.tell() < size:
+            for row in self.rows:
+                self._writer.writerow(self._row(row))
+                if buf.tell() >= size:
+                    break
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        buf.write(data[size:])
+        return data[:size]
+
+
+PGCOPY_EPOCH = datetime.datetime(2000, 1, 1)
+PGCOPY_EPOCH_ORDINAL = PGCOPY_EPOCH.toordinal()
+PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PGCOPY_NULL = struct.pack('!i', -1)
+
+_date_field = DateField()
+_time_field = TimeField()
+_datetime_field = TZDateTimeField()
+
+
+def _encode_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+
+def _encode_boolean(value):
+    if isinstance(value, basestring):
+        value = value.strip().lower() in ('t', 'true', 'y', 'yes', 'on', '1')
+    return value and '\x01' or '\x00'
+
+
+def _encode_numeric(value):
+    # base 10000 digits, weighted from the decimal point
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(isinstance(value, float) and repr(value) or value)
+    if value.is_nan():
+        return struct.pack('!hhHH', 0, 0, 0xC000, 0)
+    if value.is_infinite():
+        raise ValueError("Numeric value is infinite: %s" % value)
+    text = str(value)
+    if 'E' in text:
+        text = format(value, 'f')
+    sign = 0
+    if text[0] == '-':
+        sign, text = 0x4000, text[1:]
+    integer, point, fraction = text.partition('.')
+    scale = len(fraction)
+    integer = integer.zfill((len(integer) + 3) // 4 * 4)
+    fraction = fraction.ljust((scale + 3) // 4 * 4, '0')
+    groups = [int(integer[i:i + 4]) for i in range(0, len(integer), 4)]
+    weight = len(groups) - 1
+    groups += [int(fraction[i:i + 4]) for i in range(0, len(fraction), 4)]
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack('!hhHH%dH' % len(groups), len(groups), weight, sign, scale, *groups)
+
+
+def _encode_date(value):
+    if type(value) is not datetime.date:
+        value = _date_field.to_python(value)
+    return struct.pack('!i', value.toordinal() - PGCOPY_EPOCH_ORDINAL)
+
+
+def _encode_time(value):
+    if not isinstance(value, datetime.time):
+        value = _time_field.to_python(value)
+    return struct.pack('!q', ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond)
+
+
+def _timestamp(value):
+    delta = value - PGCOPY_EPOCH
+    return struct.pack('!q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _encode_timestamptz(value):
+    if not isinstance(value, datetime.datetime):
+        value = _datetime_field.to_python(value)
+    if value.tzinfo is None:
+        # naive datetimes are in the session time zone Django sets, as in CSV
+        if settings.USE_TZ:
+            return _timestamp(value)
+        value = force_tz(value, settings.TIME_ZONE)
+    return _timestamp(value.replace(tzinfo=None) - value.utcoffset())
+
+
+def _encode_timestamp(value):
+    if not isinstance(value, datetime.datetime):
+        value = _datetime_field.to_python(value)
+    return _timestamp(value.replace(tzinfo=None))
+
+
+# binary COPY encoders of database types, without their modifiers
+BINARY_ENCODERS = {
+    'smallint': lambda value: struct.pack('!h', int(value)),
+    'integer': lambda value: struct.pack('!i', int(value)),
+    'serial': lambda value: struct.pack('!i', int(value)),
+    'bigint': lambda value: struct.pack('!q', int(value)),
+    'bigserial': lambda value: struct.pack('!q', int(value)),
+    'real': lambda value: struct.pack('!f', float(value)),
+    'double precision': lambda value: struct.pack('!d', float(value)),
+    'numeric': _encode_numeric,
+    'boolean': _encode_boolean,
+    'varchar': _encode_text,
+    'character varying': _encode_text,
+    'char': _encode_text,
+    'text': _encode_text,
+    'date': _encode_date,
+    'time': _encode_time,
+    'timestamp': _encode_timestamp,
+    'timestamp with time zone': _encode_timestamptz,
+}
+
+
+def binary_encoder(fieldtype):
+    """Returns a function encoding values of the database type fieldtype
+    for binary COPY.
+    
+    Strings are parsed as the type's Django field would."""
+    try:
+        return BINARY_ENCODERS[re.sub(r'\(.*?\)', '', fieldtype).strip()]
+    except KeyError:
+        raise ValueError("No binary COPY encoding for %s" % fieldtype)
+
+
+class BinaryRowReader(RowReader):
+    """A file-like reader which writes rows in the binary COPY format.
+    
+    Values are encoded by the database types of their fields, None values
+    are written as NULL.
+    """
+    copy_options = 'BINARY'
+    
+    def __init__(self, rows, fields, fieldtypes, chunk_size=COPY_CHUNK_SIZE):
+        super(BinaryRowReader, self).__init__(rows, fields, chunk_size)
+        self._encoders = [binary_encoder(fieldtypes[f]) for f in fields]
+        self._tuple = struct.pack('!h', len(fields))
+        self._buffer.write(PGCOPY_HEADER)
+        self._rows = iter(rows)
+    
+    def _encode(self, row):
+        if isinstance(row, dict):
+            row = [row.get(f) for f in self.fields]
+        data = [self._tuple]
+        for encode, value in itertools.izip(self._encoders, row):
+            if value is None:
+                data.append(PGCOPY_NULL)
+            else:
+                value = encode(value)
+                data.append(struct.pack('!i', len(value)) + value)
+        return ''.join(data)
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = self.chunk_size
+        buf = self._buffer
+        while self._rows is not None and buf.tell() < size:
+            try:
+                buf.write(self._encode(self._rows.next()))
+            except StopIteration:
+                buf.write(PGCOPY_TRAILER)
+                self._rows = None
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        buf.write(data[size:])
+        return data[:size]
+
+
+def _row_fields(rows, model):
+    """Returns the fields and the rows of an iterable of rows, the first of
+    which is the header, or of dictionaries."""
+    rows = iter(rows)
+    try:
+        first = rows.next()
+    except StopIteration:
+        raise ValueError("No header row in merge source")
+    if isinstance(first, dict):
+        fields = [f.attname for f in model._meta.fields if f.attname in first]
+        rows = itertools.chain([first], rows)
+    else:
+        fields = list(first)
+    return fields, rows
+
+
+class RecordSource(object):
+    """
+    Records for `merge` in a format other than CSV. `open` returns the
+    field names and a file-like reader of the records for COPY, with the
+    options of COPY as its `copy_options`.
+    """
+    def open(self, model, fieldtypes):
+        raise NotImplementedError
+
+
+class BinaryRows(RecordSource):
+    """
+    Rows, like the ones `merge` accepts, which are copied in the binary
+    COPY format. Values are encoded by the database types of their fields,
+    so that the server does not have to parse them from text.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+    
+    def open(self, model, fieldtypes):
+        fields, rows = _row_fields(self.rows, model)
+        return fields, BinaryRowReader(rows, fields, fieldtypes)
+    
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self.rows)
+
+
+class BinaryCopy(RecordSource):
+    """
+    A path or a file-like object with data in the binary COPY format, such
+    as `COPY ... TO stdout WITH BINARY` writes, of the given fields.
+    """
+    def __init__(self, source, fields):
+        self.source = source
+        self.fields = list(fields)
+    
+    def open(self, model, fieldtypes):
+        source = self.source
+        if isinstance(source, basestring):
+            source = open(source, 'rb')
+        reader = CompressedReader(source)
+        reader.copy_options = 'BINARY'
+        return self.fields, reader
+    
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self.source)
+
+
+class JSONLines(RecordSource):
+    """
+    A path or a file-like object with a JSON object on every line, such as
+    `{"cat": 120033, "name": "Books"}`, optionally compressed with gzip or
+    bz2. The fields are the model fields present in the first object, and
+    the records are copied in the binary COPY format.
+    """
+    def __init__(self, source):
+        self.source = source
+    
+    def _objects(self, reader):
+        for line in iter(reader.readline, ''):
+            if line.strip():
+                yield json.loads(line, parse_float=decimal.Decimal)
+    
+    def open(self, model, fieldtypes):
+        source = self.source
+        if isinstance(source, basestring):
+            source = open(source, 'rb')
+        return BinaryRows(self._objects(CompressedReader(source))).open(model, fieldtypes)
+    
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self.source)
+
+
+class ArrowRecords(RecordSource):
+    """
+    Records in Arrow columns: a pyarrow Table, a record batch or an
+    iterable of them, or a path to a Parquet or an Arrow IPC file. The
+    fields are the model fields among the columns, unless `fields` are
+    given, and the records are copied in the binary COPY format. Requires
+    pyarrow.
+    """
+    def __init__(self, source, fields=None):
+        if pyarrow is None:
+            raise ImportError("ArrowRecords requires pyarrow")
+        self.source = source
+        self.fields = fields
+    
+    def _chunks(self):
+        source = self.source
+        if isinstance(source, basestring):
+            if source.endswith(('.parquet', '.parq')):
+                import pyarrow.parquet
+                parquet = pyarrow.parquet.ParquetFile(source)
+                return (parquet.read_row_group(i) for i in xrange(parquet.num_row_groups))
+            ipc = pyarrow.ipc.open_file(source)
+            return (ipc.get_batch(i) for i in xrange(ipc.num_record_batches))
+        if isinstance(source, pyarrow.Table):
+            return iter(source.to_batches())
+        if isinstance(source, pyarrow.RecordBatch):
+            return iter([source])
+        return iter(source)
+    
+    def _rows(self, chunks, fields):
+        for chunk in chunks:
+            names = chunk.schema.names
+            columns = [chunk.column(names.index(f)).to_pylist() for f in fields]
+            for row in itertools.izip(*columns):
+                yield row
+    
+    def open(self, model, fieldtypes):
+        chunks = self._chunks()
+        try:
+            first = chunks.next()
+        except StopIteration:
+            raise ValueError("No record batches in merge source")
+        fields = self.fields
+        if fields is None:
+            names = first.schema.names
+            fields = [f.attname for f in model._meta.fields if f.attname in names]
+        rows = self._rows(itertools.chain([first], chunks), fields)
+        return fields, BinaryRowReader(rows, fields, fieldtypes)
+    
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self.source)
+
+
+def open_source(source, model, conn=None):
+    """Returns the field names and a file-like reader for COPY of source.
+    
+    source is a path, a file-like object with CSV data, both optionally
+    compressed with gzip or bz2, or an iterable of rows. Rows are either
+    sequences, the first of which is the header, or dictionaries, in which
+    case the fields are the model fields present in the first row. Other
+    formats are given as a `RecordSource`, which is encoded by the
+    database types of the model fields on `conn`.
+    """
+    if isinstance(source, RecordSource):
+        if conn is None:
+            conn = connection
+        fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+        return source.open(model, fieldtypes)
+    if isinstance(source, basestring):
+        source = open(source, 'rb')
+    if hasattr(source, 'read'):
+        reader = CompressedReader(source)
+        fields = csv.reader([reader.readline()]).next()
+        return fields, reader
+    fields, rows = _row_fields(source, model)
+    return fields, RowReader(rows, fields)
+
+
+class MergeAborted(ValueError):
+    """Raised when a merge would change more than it is allowed to."""
+
+
+# A change merging a record would make: the values of its keys, the kind of
+# change, "insert", "update" or "terminate", and the names of the fields
+# which have changed in an update.
+Change = collections.namedtuple('Change', 'key change fields')
+
+
+class MergeStats(object):
+    """Row counts and timings of a merge, as returned by `merge`.
+    
+    `staged` records were read from the source, of which `unchanged` ones
+    matched current records. `terminated` current records had their
+    validity ended, having gone missing or changed, and `inserted` new
+    versions were added. `phases` holds the wall time of each phase in
+    seconds, in order, and `statements` lists (phase, sql, seconds) for
+    every statement executed.
+    """
+    COUNTS = ('staged', 'unchanged', 'terminated', 'inserted')
+    
+    def __init__(self):
+        self.staged = 0
+        self.unchanged = 0
+        self.terminated = 0
+        self.inserted = 0
+        self.phases = collections.OrderedDict()
+        self.statements = []
+        self.total = 0.0
+        self._phase = None
+        self._started = None
+    
+    def start(self, phase):
+        """Ends the running phase, if any, and starts timing `phase`."""
+        now = time.time()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._started
+        self._phase, self._started = phase, now
+    
+    def stop(self):
+        self.start(None)
+    
+    def add(self, other):
+        """Adds the counts and timings of another merge to these."""
+        for name in self.COUNTS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for phase, seconds in other.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.statements.extend(other.statements)
+        self.total += other.total
+    
+    def send(self, metrics, prefix='merge'):
+        """Sends the counts and timings to a metrics sink.
+        
+        `metrics` is either a statsd-like client, whose gauge(name, value)
+        gets the counts and timing(name, ms) the timings, or a callable
+        called as metrics(name, value) with timings in seconds.
+        """
+        timings = list(self.phases.items()) + [('total', self.total)]
+        if hasattr(metrics, 'timing'):
+            for name in self.COUNTS:
+                metrics.gauge('%s.%s' % (prefix, name), getattr(self, name))
+            for phase, seconds in timings:
+                metrics.timing('%s.%s' % (prefix, phase), seconds * 1000)
+        else:
+            for name in self.COUNTS:
+                metrics('%s.%s' % (prefix, name), getattr(self, name))
+            for phase, seconds in timings:
+                metrics('%s.%s' % (prefix, phase), seconds)
+    
+    def __repr__(self):
+        return '<%s %s in %.2f seconds>' % (self.__class__.__name__,
+            ', '.join(['%s=%d' % (name, getattr(self, name)) for name in self.COUNTS]), self.total)
+
+
+class TimedCursor(object):
+    """Wraps a cursor, timing every statement into a MergeStats."""
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+    
+    def _timed(self, method, sql, *args):
+        t1 = time.time()
+        try:
+            return method(sql, *args)
+        finally:
+            self.stats.statements.append((self.stats._phase, sql, time.time() - t1))
+    
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+    
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(self.cursor.copy_expert, sql, file, size)
+    
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class StagedRecords(object):
+    """Records in a table or view of the database, a merge source.
+    
+    `table` can be qualified with a schema, as in "staging.snapshot".
+    `fields` are the columns to merge, by default the ones named like the
+    fields of the model, except its primary key and valid field. `where` is
+    an SQL condition on the table selecting the records to merge, all of
+    them if None.
+    """
+    def __init__(self, table, fields=None, where=None):
+        self.table = table
+        self.fields = fields
+        self.where = where
+    
+    def from_sql(self, qn):
+        """Returns the SQL and parameters of the relation of the records."""
+        return '.'.join([qn(i) for i in self.table.split('.')]), []
+    
+    def get_fields(self, model, conn, valid_field='valid'):
+        """Returns the fields of model to merge from the records."""
+        if self.fields is not None:
+            return self.fields
+        sql, params = self.from_sql(conn.ops.quote_name)
+        cur = conn.cursor()
+        cur.execute('SELECT * FROM ' + sql + ' LIMIT 0;', params or None)
+        columns = [i[0] for i in cur.description]
+        return [f.attname for f in model._meta.fields
+            if f.attname in columns and f.attname not in (model._meta.pk.attname, valid_field)]
+    
+    def stage_where(self, keys, fieldtypes, qn):
+        """Returns the condition on the staged records to merge, or None."""
+        return self.where
+    
+    def orig_where(self, table, keys, fieldtypes, qn):
+        """Returns the condition on the records of table which a full
+        snapshot of these records replaces, or None for all of them."""
+        return None
+    
+    def __repr__(self):
+        return '<%s of %s%s>' % (self.__class__.__name__, self.table, self.where and ' where ' + self.where or '')
+
+
+class QueryRecords(StagedRecords):
+    """Records selected by an SQL query, a merge source.
+    
+    `params` are the parameters of the query. A `where` condition can refer
+    to the records as "source".
+    """
+    def __init__(self, sql, params=(), fields=None, where=None):
+        super(QueryRecords, self).__init__('source', fields, where)
+        self.sql = sql
+        self.params = list(params)
+    
+    @classmethod
+    def from_queryset(cls, queryset, fields=None, using=None):
+        """Returns the records selected by a QuerySet, with the columns
+        named after the fields for values() querysets."""
+        sql, params = queryset.query.get_compiler(using=using or queryset.db).as_sql()
+        return cls(sql, params, fields)
+    
+    def from_sql(self, qn):
+        return '(' + self.sql + ') AS ' + qn(self.table), self.params
+    
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.sql)
+
+
+class StagedShard(StagedRecords):
+    """One shard of the records staged by parallel_merge, a merge source."""
+    def __init__(self, table, fields, shard, shards):
+        super(StagedShard, self).__init__(table, fields)
+        self.shard = shard
+        self.shards = shards
+    
+    def stage_where(self, keys, fieldtypes, qn):
+        return self.orig_where(self.table, keys, fieldtypes, qn)
+    
+    def orig_where(self, table, keys, fieldtypes, qn):
+        return shard_sql(table, keys, fieldtypes, self.shards, qn) + ' = ' + str(int(self.shard))
+    
+    def __repr__(self):
+        return '<%s %d/%d of %s>' % (self.__class__.__name__, self.shard, self.shards, self.table)
+
+
+def key_hash_sql(table, keys, fieldtypes, qn):
+    """Returns the SQL for the hash of the keys of a row."""
+    return 'hashtext(ROW(' + ', '.join(['%s.%s::%s' % (qn(table), qn(i), fieldtypes[i]) for i in keys]) + ')::text)'
+
+
+def shard_sql(table, keys, fieldtypes, shards, qn):
+    """Returns the SQL for the shard of a row, the range of the hash of its
+    keys it falls in, out of `shards` equal ones."""
+    return '((' + key_hash_sql(table, keys, fieldtypes, qn) + '::bigint + 2147483648) * ' \
+        + str(int(shards)) + ' / 4294967296)'
+
+
+def row_digest_sql(table, names, fieldtypes, qn):
+    """Returns the SQL for the md5 digest of the given columns of a row."""
+    # NULL and the empty string have different text in a row
+    return 'md5(ROW(' + ', '.join(['%s.%s::%s' % (qn(table), qn(i), fieldtypes[i]) for i in names]) + ')::text)'
+
+
+def current_value(model, valid_field, conn):
+    """Returns the upper bound marking current records of valid_field."""
+    valid_field_type = model._meta.get_field(valid_field).db_type(conn)
+    if valid_field_type == 'daterange':
+        return DATE_CURRENT
+    elif valid_field_type == 'tstzrange':
+        return TIME_CURRENT
+    raise ValueError("Unknown type of valid field")
+
+
+def is_retroactive(cur, conn, model, timestamp, valid_field='valid', orig_where=None, debug=False):
+    """Returns whether model has history after `timestamp`: versions
+    starting after it or closed versions spanning it."""
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    qn = conn.ops.quote_name
+    at = '%s::' + (CURRENT_VALUE is DATE_CURRENT and 'date' or 'timestamptz')
+    sql = 'SELECT 1 FROM ' + qn(model._meta.db_table) + ' WHERE (' + qn(valid_field) + ' >> ' \
+        + fieldtypes[valid_field] + '(' + at + ', ' + at + ", '[]') OR (" + qn(valid_field) + ' @> ' + at + ' AND upper(' + qn(valid_field) + ') <> ' + at + '))' \
+        + (orig_where and ' AND ' + orig_where or '') + ' LIMIT 1;'
+    params = [timestamp, timestamp, timestamp, CURRENT_VALUE]
+    if debug:
+        print sql % tuple([adapt(i).getquoted() for i in params])
+    cur.execute(sql, params)
+    return cur.fetchone() is not None
+
+
+def locked_keys_sql(table, keys, fieldtypes, buckets, qn):
+    """Returns the SQL condition for the rows of table whose keys are in
+    the buckets `lock_keys` locked."""
+    if not buckets:
+        return 'false'
+    return shard_sql(table, keys, fieldtypes, KEY_LOCK_BUCKETS, qn) + ' IN (' + ', '.join([str(int(i)) for i in buckets]) + ')'
+
+
+def lock_keys(cur, conn, model, source_table, timestamp, keys, fields, snapshot='full', valid_field='valid', orig_where=None, changes=('insert', 'update', 'terminate'), debug=False):
+    """
+    Takes the advisory locks of the keys which merging the records in
+    `source_table` at `timestamp` makes `changes` to, see `change_set_sql`,
+    until the end of the transaction, and returns their buckets.
+    
+    Keys are locked by the range of their hash they fall in, one of
+    KEY_LOCK_BUCKETS, as `lock_key` locks them, so writers of single keys
+    wait only for merges changing keys in the same bucket. Buckets are
+    locked in order, which keeps merges locking each other's keys from
+    deadlocking. The merge should be limited to the keys in the buckets
+    locked, see `locked_keys_sql`: keys which other sessions change after
+    they have been compared are theirs.
+    """
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    changed, params = change_set_sql(conn, model, source_table, timestamp, keys, fields,
+        snapshot=snapshot, valid_field=valid_field, orig_where=orig_where)
+    sql = 'SELECT DISTINCT ' + shard_sql('c', keys, fieldtypes, KEY_LOCK_BUCKETS, qn) + ' AS b FROM (' + changed + ') AS c' \
+        + ' WHERE ' + qn('_change') + ' IN (' + ', '.join(['%s'] * len(changes)) + ') ORDER BY b;'
+    params = params + list(changes)
+    if debug:
+        print sql % tuple([adapt(i).getquoted() for i in params])
+    cur.execute(sql, params)
+    buckets = [i for i, in cur.fetchall()]
+    cur.execute('SELECT count(pg_advisory_xact_lock(hashtext(%s), b)) FROM (SELECT b FROM unnest(%s::integer[]) AS b ORDER BY b) AS buckets;',
+        [orig_table, buckets])
+    return buckets
+
+
+def terminate_missing(cur, conn, model, source_table, timestamp, keys, valid_field='valid', orig_where=None, digest=False, staging='temp', debug=False):
+    """
+    Terminates validity at `timestamp` of the current records of model,
+    whose keys are missing from the records in `source_table`.
+    
+    `orig_where` is an SQL condition limiting the current records to the
+    ones `source_table` is a full snapshot of. Runs in the caller's
+    transaction and returns the number of records terminated.
+    """
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    suffix = uuid.uuid4().hex[:12]
+    staging_name = lambda name: truncate_name('%s_%s_%s' % (orig_table, name, suffix), conn.ops.max_name_length())
+    tmptable = source_table
+    tmptable_term = staging_name('term_temp')
+    staging_kind = staging.upper()
+    
+    logging.debug('Creating index on temporary table')
+    sql = 'CREATE INDEX ' + qn(staging_name('keys_idx')) + ' ON ' \
+        + qn(tmptable) + '(' + ', '.join([qn(i) for i in keys]) + ');'
+    if debug:
+        print sql
+    cur.execute(sql)
+    
+    logging.debug('Terminating validity for newly missing records')
+    # To find out which records have no counterpart in existing table,
+    # we first make a table containing (temporal) keys from both tables
+    # side by side.
+    sql = 'SELECT DISTINCT ' \
+        + ', '.join(['%s.%s AS %s' % (qn(orig_table), qn(i), qn("orig_" + i)) for i in keys]) \
+        + ', ' \
+        + ', '.join(['%s.%s' % (qn(tmptable), qn(i)) for i in keys]) \
+        + (digest and ', ' + row_digest_sql(orig_table, keys, fieldtypes, qn) + ' AS ' + qn('orig_digest') or '') \
+        + ' INTO ' + staging_kind + ' TABLE ' + qn(tmptable_term) \
+        + ' FROM ' + qn(orig_table) + ' LEFT OUTER JOIN ' + qn(tmptable) + ' ON ' \
+        + (digest and row_digest_sql(orig_table, keys, fieldtypes, qn) + ' = ' + row_digest_sql(tmptable, keys, fieldtypes, qn) or
+        same_row_sql(orig_table, tmptable, keys, fieldtypes, qn)) \
+        + ' AND (' + ' OR '.join(['%s.%s IS NOT NULL' % (qn(orig_table), qn(i)) for i in keys]) + ')' \
+        + ' WHERE upper(' + qn(orig_table) + "." + qn(valid_field) + ") = %s" \
+        + (orig_where and ' AND ' + orig_where or '') \
+        + ' ;'
+    params = [CURRENT_VALUE]
+    if debug:
+        print sql % tuple([adapt(i).getquoted() for i in params])
+    cur.execute(sql, params)
+    
+    logging.debug('Creating index.')
+    if digest:
+        sql = 'CREATE INDEX ' + qn(staging_name('term_idx')) \
+            + ' ON ' + qn(tmptable_term) \
+            + '(' + qn('orig_digest') + ');'
+    else:
+        sql = 'CREATE INDEX ' + qn(staging_name('term_idx')) \
+            + ' ON ' + qn(tmptable_term) \
+            + '(' + ', '.join([qn("orig_" + i) for i in keys]) + ');'
+    if debug:
+        print sql
+    cur.execute(sql)
+    
+    sql = 'ANALYZE ' + qn(tmptable_term) + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    
+    # Delete records which counterpart in new dump, to get those, which
+    # have gone missing and are to have their validity terminated.
+    sql = 'DELETE FROM ' + qn(tmptable_term) + " WHERE " \
+        + '\n OR '.join(['%s.%s IS NOT NULL' % (qn(tmptable_term), qn(i)) for i in keys]) \
+        + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    
+    sql = 'SELECT COUNT(*) FROM ' + qn(tmptable_term) + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    data = cur.fetchall()
+    logging.debug('Deleted entries count: %d' % data[0][0])
+    
+    logging.debug('Updating.')
+    # Terminate validity to records, which have gone missing.
+    sql = 'UPDATE ' + qn(orig_table) + ' SET ' \
+        + qn(valid_field) + " = ('[' || lower(" + qn(valid_field) + ") || ',' || %s || ')')::" + fieldtypes[valid_field] \
+        + ' FROM ' + qn(tmptable_term) \
+        + ' WHERE upper(' + qn(valid_field) + ') = %s AND ' \
+        + (digest and row_digest_sql(orig_table, keys, fieldtypes, qn) + ' = ' + qn(tmptable_term) + '.' + qn('orig_digest') or
+        same_row_sql(orig_table, tmptable_term, keys, fieldtypes, qn, prefix='orig_')) \
+        + ';'
+    
+    params = [timestamp, CURRENT_VALUE]
+    if debug:
+        print sql % tuple([adapt(i).getquoted() for i in params])
+    cur.execute(sql, params)
+    terminated = cur.rowcount
+    logging.debug('Terminated entries count: %d' % terminated)
+    
+    sql = 'DROP TABLE ' + qn(tmptable_term) + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    
+    return terminated
+
+
+def same_row_sql(left, right, names, fieldtypes, qn, prefix=''):
+    """Returns the SQL comparing the given columns of two rows NULL-safely.
+    The columns of `right` are named with `prefix`."""
+    return ' AND '.join(['(%s.%s::%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (
+        qn(left), qn(i), fieldtypes[i], qn(right), qn(prefix + i), fieldtypes[i], qn(left), qn(i), qn(right), qn(prefix + i)) for i in names])
+
+
+def merge_into_history(cur, conn, model, source_table, timestamp, keys, fields, snapshot='full', copy_fields=None, valid_field='valid', orig_where=None, digest=False, staging='temp', stats=None, debug=False):
     """
-    `new_csv` is a path to a CSV file, containing the records for the model.
+    Merges the records in `source_table`, valid at `timestamp`, into
+    history which goes on after `timestamp`.
+    
+    The records of a full snapshot hold from `timestamp` until the next
+    time the history changes, where the history merged before takes over
+    again. The records of a delta snapshot hold until the version of their
+    own key valid at `timestamp` ended, or else until the next version of
+    that key, for good. So only the versions valid at `timestamp` are
+    split, and the records are joined with equal versions right before or
+    after them. `orig_where` is an SQL condition limiting the versions to
+    the ones the records belong to. Runs in the caller's transaction.
+    """
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    time_type = CURRENT_VALUE is DATE_CURRENT and 'date' or 'timestamptz'
+    orig_table = model._meta.db_table
+    pk = model._meta.pk.attname
+    columns = [f.attname for f in model._meta.fields if f.attname not in (pk, valid_field)]
+    qn = conn.ops.quote_name
+    suffix = uuid.uuid4().hex[:12]
+    staging_name = lambda name: truncate_name('%s_%s_%s' % (orig_table, name, suffix), conn.ops.max_name_length())
+    tmptable = source_table
+    affected = staging_name('affected')
+    cut = staging_name('cut')
+    inserts = staging_name('inserts')
+    staging_kind = staging.upper()
+    copy_fields = copy_fields or []
+    if stats is None:
+        stats = MergeStats()
+    
+    def same(left, right, names):
+        if digest:
+            return row_digest_sql(left, names, fieldtypes, qn) + ' = ' + row_digest_sql(right, names, fieldtypes, qn)
+        return same_row_sql(left, right, names, fieldtypes, qn)
+    
+    def valid_range(lower, upper):
+        return fieldtypes[valid_field] + '(' + lower + ', ' + upper + ", '[)')"
+    
+    def execute(sql, params=None):
+        if debug:
+            print params and sql % tuple([adapt(i).getquoted() for i in params]) or sql
+        cur.execute(sql, params)
+        return cur.rowcount
+    
+    at = '%s::' + time_type
+    
+    # The history changes next where a version begins or ends after
+    # timestamp, in any of the records.
+    next_change = None
+    if snapshot == 'full':
+        execute('SELECT least((SELECT min(lower(' + qn(valid_field) + ')) FROM ' + qn(orig_table) \
+            + ' WHERE ' + qn(valid_field) + ' >> ' + fieldtypes[valid_field] + '(' + at + ', ' + at + ", '[]'))" \
+            + ', (SELECT min(upper(' + qn(valid_field) + ')) FROM ' + qn(orig_table) \
+            + ' WHERE ' + qn(valid_field) + ' @> ' + at + '), ' + at + ');',
+            [timestamp, timestamp, timestamp, CURRENT_VALUE])
+        next_change = cur.fetchone()[0]
+        logging.debug('Merging into history between %s and %s' % (timestamp, next_change))
+    
+    execute('SELECT ' + ', '.join([qn(i) for i in [pk] + columns]) \
+        + ', lower(' + qn(valid_field) + ') AS ' + qn('_lower') \
+        + ', upper(' + qn(valid_field) + ') AS ' + qn('_upper') \
+        + ' INTO ' + staging_kind + ' TABLE ' + qn(affected) \
+        + ' FROM ' + qn(orig_table) \
+        + ' WHERE ' + qn(valid_field) + ' @> ' + at \
+        + (orig_where and ' AND ' + orig_where or '') + ';', [timestamp])
+    execute('ANALYZE ' + qn(affected) + ';')
+    
+    # Versions to be cut short are those with no exact counterpart in the
+    # records, out of the ones whose keys are there for delta snapshots.
+    execute('SELECT ' + qn(pk) + ', ' + qn('_lower') \
+        + ' INTO ' + staging_kind + ' TABLE ' + qn(cut) \
+        + ' FROM ' + qn(affected) \
+        + ' WHERE NOT EXISTS (SELECT 1 FROM ' + qn(tmptable) + ' WHERE ' + same(affected, tmptable, fields) + ')' \
+        + (snapshot == 'delta' and ' AND EXISTS (SELECT 1 FROM ' + qn(tmptable) + ' WHERE ' + same(affected, tmptable, keys) + ')' or '') \
+        + ';')
+    
+    stats.unchanged += execute('DELETE FROM ' + qn(tmptable) + ' USING ' + qn(affected) \
+        + ' WHERE ' + same(affected, tmptable, fields) + ';')
+    
+    if snapshot == 'delta':
+        # a delta says nothing of other keys, whose changes do not end it
+        upper = 'coalesce(' + qn(affected) + '.' + qn('_upper') \
+            + ', (SELECT min(lower(' + qn(valid_field) + ')) FROM ' + qn(orig_table) \
+            + ' WHERE ' + same(orig_table, tmptable, keys) \
+            + ' AND lower(' + qn(valid_field) + ') > ' + at \
+            + (orig_where and ' AND ' + orig_where or '') + '), ' + at + ')'
+        upper_params = [timestamp, CURRENT_VALUE]
+    else:
+        upper, upper_params = at, [next_change]
+    # NULLIF gives NULLs of the type of the primary key.
+    execute('SELECT DISTINCT ' + ', '.join(['%s.%s' % (qn(tmptable), qn(i)) for i in fields]) \
+        + ''.join([', %s.%s' % (qn(affected), qn(i)) for i in copy_fields]) \
+        + ', ' + upper + ' AS ' + qn('_upper') \
+        + ', NULLIF(' + qn(affected) + '.' + qn(pk) + ', ' + qn(affected) + '.' + qn(pk) + ') AS ' + qn('_prev') \
+        + ', NULLIF(' + qn(affected) + '.' + qn(pk) + ', ' + qn(affected) + '.' + qn(pk) + ') AS ' + qn('_next') \
+        + ' INTO ' + staging_kind + ' TABLE ' + qn(inserts) \
+        + ' FROM ' + qn(tmptable) \
+        + ' LEFT OUTER JOIN ' + qn(affected) + ' ON ' + same(affected, tmptable, keys) + ';',
+        upper_params)
+    
+    logging.debug('Cutting versions at %s' % (timestamp,))
+    # versions beginning at timestamp are replaced altogether
+    stats.terminated += execute('DELETE FROM ' + qn(orig_table) + ' USING ' + qn(cut) \
+        + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = ' + qn(cut) + '.' + qn(pk) \
+        + ' AND ' + qn(cut) + '.' + qn('_lower') + ' = ' + at + ';', [timestamp])
+    stats.terminated += execute('UPDATE ' + qn(orig_table) \
+        + ' SET ' + qn(valid_field) + ' = ' + valid_range('lower(' + qn(valid_field) + ')', at) \
+        + ' FROM ' + qn(cut) \
+        + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = ' + qn(cut) + '.' + qn(pk) + ';', [timestamp])
+    # and take over again where the history changes next, unless the
+    # records of a delta take their place
+    if snapshot == 'full':
+        stats.inserted += execute('INSERT INTO ' + qn(orig_table) + '(' + ', '.join([qn(i) for i in columns + [valid_field]]) + ') ' \
+            + 'SELECT ' + ', '.join(['%s.%s' % (qn(affected), qn(i)) for i in columns]) \
+            + ', ' + valid_range(at, qn('_upper')) \
+            + ' FROM ' + qn(affected) + ' JOIN ' + qn(cut) \
+            + ' ON ' + qn(affected) + '.' + qn(pk) + ' = ' + qn(cut) + '.' + qn(pk) \
+            + ' WHERE ' + qn(affected) + '.' + qn('_upper') + ' > ' + at + ';', [next_change, next_change])
+    
+    logging.debug('Joining equal versions')
+    # A version equal to the record right after it is taken over by it,
+    # one right before it takes the record over.
+    execute('UPDATE ' + qn(inserts) \
+        + ' SET ' + qn('_upper') + ' = upper(' + qn(orig_table) + '.' + qn(valid_field) + ')' \
+        + ', ' + qn('_next') + ' = ' + qn(orig_table) + '.' + qn(pk) \
+        + ' FROM ' + qn(orig_table) \
+        + ' WHERE ' + same(orig_table, inserts, fields) \
+        + ' AND lower(' + qn(orig_table) + '.' + qn(valid_field) + ') = ' + qn(inserts) + '.' + qn('_upper') + ';')
+    execute('DELETE FROM ' + qn(orig_table) + ' USING ' + qn(inserts) \
+        + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = ' + qn(inserts) + '.' + qn('_next') + ';')
+    execute('UPDATE ' + qn(inserts) \
+        + ' SET ' + qn('_prev') + ' = ' + qn(orig_table) + '.' + qn(pk) \
+        + ' FROM ' + qn(orig_table) \
+        + ' WHERE ' + same(orig_table, inserts, fields) \
+        + ' AND upper(' + qn(orig_table) + '.' + qn(valid_field) + ') = ' + at + ';', [timestamp])
+    execute('UPDATE ' + qn(orig_table) \
+        + ' SET ' + qn(valid_field) + ' = ' + valid_range('lower(' + qn(orig_table) + '.' + qn(valid_field) + ')', qn(inserts) + '.' + qn('_upper')) \
+        + ' FROM ' + qn(inserts) \
+        + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = ' + qn(inserts) + '.' + qn('_prev') + ';')
+    
+    logging.debug('Inserting versions from %s' % (timestamp,))
+    stats.inserted += execute('INSERT INTO ' + qn(orig_table) + '(' + ', '.join([qn(i) for i in fields + copy_fields + [valid_field]]) + ') ' \
+        + 'SELECT ' + ', '.join(['%s::%s' % (qn(i), fieldtypes[i]) for i in fields + copy_fields]) \
+        + ', ' + valid_range(at, qn('_upper')) \
+        + ' FROM ' + qn(inserts) \
+        + ' WHERE ' + qn('_prev') + ' IS NULL;', [timestamp])
+    
+    for table in (affected, cut, inserts):
+        execute('DROP TABLE ' + qn(table) + ';')
+    return stats
+
+
+def merge_source(source, model, conn, valid_field='valid'):
+    """Returns the source, the fields to merge and a CSV reader for them.
+    
+    The reader is None for records in the database, which are returned as
+    `StagedRecords`, QuerySets included.
+    """
+    if isinstance(source, QuerySet):
+        source = QueryRecords.from_queryset(source, using=conn.alias)
+    if isinstance(source, StagedRecords):
+        return source, source.get_fields(model, conn, valid_field), None
+    fields, reader = open_source(source, model, conn)
+    return source, fields, reader
+
+
+def stage_records(cur, conn, source, fields, reader, tmptable, keys, fieldtypes, staging='temp', debug=False):
+    """Loads the records of a merge source into a new staging table and
+    returns their number."""
+    qn = conn.ops.quote_name
+    #fielddef = ', '.join(['%s varchar(500)' % qn(i) for i in fields])
+    fielddef = ', '.join(['%s %s NULL' % (qn(i), fieldtypes[i]) for i in fields])
+    
+    # First we load the new dump into db as a table
+    # This table is `tmptable`
+    logging.debug('Creating table ' + tmptable)
+    sql = 'CREATE ' + staging.upper() + ' TABLE ' + qn(tmptable) + '(' + fielddef + ');'
+    if debug:
+        print sql
+    cur.execute(sql)
+    logging.debug('Copying from %r' % (source,))
+    
+    if reader is None:
+        # records in the database are selected into the staging table
+        # directly, without a round trip through CSV
+        relation, params = source.from_sql(qn)
+        where = source.stage_where(keys, fieldtypes, qn)
+        sql = 'INSERT INTO ' + qn(tmptable) + ' SELECT ' + ', '.join([qn(i) for i in fields]) \
+            + ' FROM ' + relation \
+            + (where and ' WHERE ' + where or '') + ';'
+        if debug:
+            print sql % tuple([adapt(i).getquoted() for i in params])
+        cur.execute(sql, params or None)
+    else:
+        sql = 'COPY ' + qn(tmptable) + ' FROM stdin WITH ' + reader.copy_options + ';'
+        if debug:
+            print sql
+        cur.copy_expert(sql, reader, COPY_CHUNK_SIZE)
+    sql = 'SELECT COUNT(*) FROM %s' % qn(tmptable) + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    count = cur.fetchall()[0][0]
+    
+    logging.debug('Number of records in input CSV: %d' % count)
+    
+    # autovacuum never analyzes temporary tables
+    sql = 'ANALYZE ' + qn(tmptable) + ';'
+    if debug:
+        print sql
+    cur.execute(sql)
+    return count
+
+
+def change_set_sql(conn, model, source_table, timestamp, keys, fields, snapshot='full', valid_field='valid', orig_where=None):
+    """
+    Returns the SQL and parameters of a query comparing the records in
+    `source_table` with the records of model valid at `timestamp`.
+    
+    The query returns the keys, the change as "_change", one of "insert",
+    "update", "terminate" and "unchanged", and as "_columns" the names of
+    the fields which have changed. Keys are matched by their digest, which
+    a full outer join can hash.
+    """
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    at = '%s::' + (CURRENT_VALUE is DATE_CURRENT and 'date' or 'timestamptz')
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    new, old = 'new', 'old'
+    values = [i for i in fields if i not in keys]
+    
+    sql = 'SELECT ' + ', '.join(['CASE WHEN %s.%s THEN %s.%s ELSE %s.%s END AS %s' % (
+            qn(new), qn('_new'), qn(new), qn(i), qn(old), qn(i), qn(i)) for i in keys]) \
+        + ', CASE WHEN ' + qn(old) + '.' + qn('_old') + " IS NULL THEN 'insert'" \
+        + ' WHEN ' + qn(new) + '.' + qn('_new') + " IS NULL THEN 'terminate'" \
+        + ' WHEN ' + ' OR '.join(['%s.%s IS DISTINCT FROM %s.%s' % (qn(new), qn(i), qn(old), qn(i)) for i in values] or ['false']) \
+        + " THEN 'update' ELSE 'unchanged' END AS " + qn('_change') \
+        + ', ARRAY(SELECT c FROM unnest(ARRAY[' \
+        + ', '.join(["CASE WHEN %s.%s IS DISTINCT FROM %s.%s THEN %s END" % (
+            qn(new), qn(i), qn(old), qn(i), adapt(str(i)).getquoted()) for i in values] or ['NULL']) \
+        + ']::text[]) AS c WHERE c IS NOT NULL AND ' + qn(new) + '.' + qn('_new') + ' AND ' + qn(old) + '.' + qn('_old') + ') AS ' + qn('_columns') \
+        + ' FROM (SELECT DISTINCT ' + ', '.join([qn(i) for i in fields]) + ', true AS ' + qn('_new') \
+            + ' FROM ' + qn(source_table) + ') AS ' + qn(new) \
+        + ' FULL OUTER JOIN (SELECT ' + ', '.join([qn(i) for i in fields]) + ', true AS ' + qn('_old') \
+            + ' FROM ' + qn(orig_table) + ' WHERE ' + qn(valid_field) + ' @> ' + at \
+            + (orig_where and ' AND ' + orig_where or '') + ') AS ' + qn(old) \
+        + ' ON ' + row_digest_sql(new, keys, fieldtypes, qn) + ' = ' + row_digest_sql(old, keys, fieldtypes, qn) \
+        + (snapshot == 'delta' and ' WHERE ' + qn(new) + '.' + qn('_new') or '')
+    return sql, [timestamp]
+
+
+def merge(new_csv, model, timestamp, keys, snapshot='full', copy_fields=None, callback=None, conn=None, valid_field='valid', debug=False, digest=False, staging='temp', metrics=None, dry_run=False, max_terminated=None):
+    """
+    `new_csv` is the source of records for the model: a path to a CSV file,
+    a file-like object, or an iterable of rows or dictionaries. CSV data can
+    be compressed with gzip or bz2. See `open_source`. Other formats are
+    given as a `RecordSource`, such as `JSONLines` or `ArrowRecords`, and
+    copied in the binary format. Records already in the database are given
+    as a QuerySet, or as `StagedRecords` of a table or view or
+    `QueryRecords` of an SQL query.
     
     `timestamp is the date when the given dataset was valid
     
@@ -29,38 +1143,61 @@ def merge(new_csv, model, timestamp, keys, snapshot='full', copy_fields=None, ca
     
     `callback` is a function to be called before the end of transaction 
     as callback(model, timestamp, keys, snapshot, conn)
+    
+    `digest`, if True, matches rows by the md5 digest of their text instead
+    of comparing every column NULL-safely, which turns each match into a
+    single equality that can be hashed or indexed. Keys are matched by the
+    digest of the key columns.
+    
+    `staging` is the kind of tables the data is staged in, "temp" or
+    "unlogged". Either way they are not WAL-logged, get a name unique to
+    this merge and are gone when the transaction is rolled back. Unlike
+    temporary tables, unlogged ones can be seen from other sessions.
+    
+    `metrics` is an optional sink the counts and timings are sent to once
+    the merge has committed, see `MergeStats.send`.
+    
+    `dry_run`, if True, stages the records and compares them with the
+    records valid at `timestamp`, without changing the table. The counts
+    are those the merge would have, except for the joining of equal
+    versions when merging into history. See `diff` for the changes.
+    
+    `max_terminated` is the highest fraction of the records valid at
+    `timestamp` the merge may terminate, by their going missing or
+    changing. If more would be, MergeAborted is raised before the table is
+    changed, guarding against truncated or otherwise broken snapshots.
+    
+    Returns a `MergeStats` with the number of records staged, unchanged,
+    terminated and inserted, and the time taken by each phase and statement.
     """
     
-    import time
-    rdr = csv.reader(open(new_csv))
-    fields = rdr.next()
     assert snapshot in ('full', 'delta')
-    
-    new_csv = os.path.abspath(new_csv)
+    assert staging in ('temp', 'unlogged')
     
     if conn is None:
         # FIXME
         conn = connection
         
     fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
-    valid_field_type = fieldtypes[valid_field]
-    if valid_field_type == 'daterange':
-        CURRENT_VALUE = DATE_CURRENT
-    elif valid_field_type == 'tstzrange':
-        CURRENT_VALUE = TIME_CURRENT
-    else:
-        raise ValueError("Unknown type of valid field")
+    new_csv, fields, reader = merge_source(new_csv, model, conn, valid_field)
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    stats = MergeStats()
+    total_t1 = time.time()
     
-    with transaction.commit_on_success():
-        cur = conn.cursor()
+    with transaction.commit_on_success(using=conn.alias):
+        cur = TimedCursor(conn.cursor(), stats)
         orig_table = model._meta.db_table
-        tmptable = orig_table + '_temp'
-        tmptable_term = orig_table + '_term_temp'
         qn = conn.ops.quote_name
-        #fielddef = ', '.join(['%s varchar(500)' % qn(i) for i in fields])
-        fielddef = ', '.join(['%s %s NULL' % (qn(i), fieldtypes[i]) for i in fields])
+        # staging tables are private to this merge, so concurrent merges
+        # into the same table do not clobber each other
+        suffix = uuid.uuid4().hex[:12]
+        staging_name = lambda name: truncate_name('%s_%s_%s' % (orig_table, name, suffix), conn.ops.max_name_length())
+        tmptable = staging_name('temp')
+        tmptable_term = staging_name('term_temp')
+        staging_kind = staging.upper()
         
-        total_t1 = time.time()
+        row_digest = lambda table, names: row_digest_sql(table, names, fieldtypes, qn)
+        same_row = lambda left, right, names: same_row_sql(left, right, names, fieldtypes, qn)
         
         if debug:
             print 'STARTING STATE'
@@ -70,232 +1207,763 @@ def merge(new_csv, model, timestamp, keys, snapshot='full', copy_fields=None, ca
             cur.copy_expert(sql, sys.stdout)
             print '~'*80
             
-        sql = 'DROP TABLE IF EXISTS ' + qn(tmptable) + ';'
-        if debug:
-            print sql
-        cur.execute(sql)
-        
-        sql = 'DROP TABLE IF EXISTS ' + qn(tmptable_term) + ';'
-        if debug:
-            print sql
-        cur.execute(sql)
+        # a dry run leaves no trace, not even its staging tables
+        if dry_run:
+            sid = transaction.savepoint(using=conn.alias)
         
         # First we load the new dump into db as a table
         # This table is `tmptable`
-        logging.debug('Creating table ' + tmptable)
-        sql = 'CREATE TABLE ' + qn(tmptable) + '(' + fielddef + ');'
-        if debug:
-            print sql
-        cur.execute(sql)
-        t1 = time.time()
-        logging.debug('Copying from ' + new_csv)
+        stats.start('stage')
+        stats.staged = stage_records(cur, conn, new_csv, fields, reader, tmptable, keys,
+            fieldtypes, staging=staging, debug=debug)
         
-        sql = '''COPY ''' + qn(tmptable) + ''' FROM %s WITH CSV HEADER NULL '';'''
-        if debug:
-            print sql % adapt(new_csv).getquoted()
-        sql = sql % 'stdin'
-        cur.copy_expert(sql, open(new_csv))
-        t2 = time.time()
-        logging.debug('COPY took %.2f seconds' % (t2-t1,))
-        sql = 'SELECT COUNT(*) FROM %s' % qn(tmptable) + ';'
-        if debug:
-            print sql
-        cur.execute(sql)
-        count = cur.fetchall()[0][0]
+        orig_where = None
+        if isinstance(new_csv, StagedRecords):
+            orig_where = new_csv.orig_where(orig_table, keys, fieldtypes, qn)
         
-        logging.debug('Number of records in input CSV: %d' % count)
+        # A snapshot older than some of the history is merged into it, by
+        # splitting the versions valid at its timestamp.
+        at = '%s::' + (CURRENT_VALUE is DATE_CURRENT and 'date' or 'timestamptz')
+        retroactive = is_retroactive(cur, conn, model, timestamp, valid_field=valid_field, orig_where=orig_where, debug=debug)
         
-        logging.debug('Locking table ' + orig_table)
-        sql = 'LOCK TABLE ' + qn(orig_table) + ' IN ROW EXCLUSIVE MODE;'
+        if dry_run or max_terminated is not None:
+            stats.start('diff')
+            sql, params = change_set_sql(conn, model, tmptable, timestamp, keys, fields,
+                snapshot=snapshot, valid_field=valid_field, orig_where=orig_where)
+            sql = 'SELECT ' + qn('_change') + ', count(*) FROM (' + sql + ') AS changes GROUP BY ' + qn('_change') + ';'
+            if debug:
+                print sql % tuple([adapt(i).getquoted() for i in params])
+            cur.execute(sql, params)
+            changes = dict(cur.fetchall())
+            terminated = changes.get('terminate', 0) + changes.get('update', 0)
+            if max_terminated is not None:
+                sql = 'SELECT count(*) FROM ' + qn(orig_table) + ' WHERE ' + qn(valid_field) + ' @> ' + at \
+                    + (orig_where and ' AND ' + orig_where or '') + ';'
+                cur.execute(sql, [timestamp])
+                valid = cur.fetchone()[0]
+                if terminated > max_terminated * valid:
+                    raise MergeAborted("Merge would terminate %d of %d records valid at %s" % (terminated, valid, timestamp))
+            if dry_run:
+                stats.unchanged = changes.get('unchanged', 0)
+                stats.terminated = terminated
+                stats.inserted = changes.get('insert', 0) + changes.get('update', 0)
+                stats.start('cleanup')
+                transaction.savepoint_rollback(sid, using=conn.alias)
+                stats.stop()
+                stats.total = time.time() - total_t1
+                logging.info('Dry run %r' % (stats,))
+                return stats
+        
+        stats.start('lock')
+        locked = lock_keys(cur, conn, model, tmptable, timestamp, keys, fields, snapshot=snapshot,
+            valid_field=valid_field, orig_where=orig_where, debug=debug)
+        logging.debug('Locked %d key buckets of %s' % (len(locked), orig_table))
+        
+        # the records of keys left unlocked were unchanged
+        sql = 'DELETE FROM ' + qn(tmptable) + ' WHERE NOT ' + locked_keys_sql(tmptable, keys, fieldtypes, locked, qn) + ';'
         if debug:
             print sql
         cur.execute(sql)
+        stats.unchanged += cur.rowcount
+        orig_where = (orig_where and orig_where + ' AND ' or '') + locked_keys_sql(orig_table, keys, fieldtypes, locked, qn)
         
-        logging.debug('Deleting unchanged records...')
-        t1 = time.time()
-        
-        if snapshot == 'full':
-            logging.debug('Creating index on temporary table')
-            sql = 'CREATE INDEX ' + qn(tmptable + '_keys_idx') + ' ON ' \
-                + qn(tmptable) + '(' + ', '.join([qn(i) for i in keys]) + ');'
-            if debug:
-                print sql
-            cur.execute(sql)
+        if retroactive:
+            stats.start('retroactive')
+            logging.debug('Merging into history after %s' % (timestamp,))
+            merge_into_history(cur, conn, model, tmptable, timestamp, keys, fields, snapshot=snapshot,
+                copy_fields=copy_fields, valid_field=valid_field, orig_where=orig_where, digest=digest,
+                staging=staging, stats=stats, debug=debug)
+        else:
+            if snapshot == 'full':
+                stats.start('terminate')
+                stats.terminated += terminate_missing(cur, conn, model, tmptable, timestamp, keys, valid_field=valid_field,
+                    orig_where=orig_where, digest=digest, staging=staging, debug=debug)
             
-            logging.debug('Terminating validity for newly missing records')
-            # To find out which records have no counterpart in existing table,
-            # we first make a table containing (temporal) keys from both tables
-            # side by side.
-            sql = 'SELECT DISTINCT ' \
-                + ', '.join(['%s.%s AS %s' % (qn(orig_table), qn(i), qn("orig_" + i)) for i in keys]) \
-                + ', ' \
-                + ', '.join(['%s.%s' % (qn(tmptable), qn(i)) for i in keys]) \
-                + ' INTO ' + qn(tmptable_term) \
-                + ' FROM ' + qn(orig_table) + ' LEFT OUTER JOIN ' + qn(tmptable) + ' ON ' \
-                + ' AND '.join(['(%s.%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (qn(orig_table), qn(i), qn(tmptable), qn(i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable), qn(i)) for i in keys]) \
-                + ' AND (' + ' OR '.join(['%s.%s IS NOT NULL' % (qn(orig_table), qn(i)) for i in keys]) + ')' \
-                + ' WHERE upper(' + qn(orig_table) + "." + qn(valid_field) + ") = %s ;"
+            stats.start('unchanged')
+            logging.debug('Deleting unchanged records...')
+            # Select keys from current temporal table, that have exact counterparts
+            # (including non-key fields) in new dump. We use this to see which
+            # records have not changed.
+            sql = 'SELECT ' \
+                + ', '.join(['%s.%s' % (qn(orig_table), qn(i)) for i in keys]) \
+                + ' INTO ' + staging_kind + ' TABLE ' + qn(tmptable_term) \
+                + ' FROM ' + qn(orig_table) \
+                + ' JOIN ' + qn(tmptable) + ' ON ' \
+                + (digest and row_digest(orig_table, fields) + ' = ' + row_digest(tmptable, fields) or
+                same_row(orig_table, tmptable, fields)) \
+                + ' WHERE upper(' + qn(valid_field) + ') = %s;'
             params = [CURRENT_VALUE]
             if debug:
                 print sql % tuple([adapt(i).getquoted() for i in params])
             cur.execute(sql, params)
             
-            logging.debug('Creating index.')
-            sql = 'CREATE INDEX ' + qn(tmptable_term + '_idx') \
-                + ' ON ' + qn(tmptable_term) \
-                + '(' + ', '.join([qn("orig_" + i) for i in keys]) + ');'
-            if debug:
-                print sql
-            cur.execute(sql)
-            
-            sql = 'ANALYZE ' + qn(tmptable_term) + ';'
-            if debug:
-                print sql
-            cur.execute(sql)
-            
-            # Delete records which counterpart in new dump, to get those, which
-            # have gone missing and are to have their validity terminated.
-            sql = 'DELETE FROM ' + qn(tmptable_term) + " WHERE " \
-                + '\n OR '.join(['%s.%s IS NOT NULL' % (qn(tmptable_term), qn(i)) for i in keys]) \
+            # Delete rows from new dump, which have not changed compared to temporal
+            # table.
+            sql = 'DELETE FROM ' + qn(tmptable) \
+                + ' USING ' + qn(tmptable_term) \
+                + ' WHERE ' \
+                + (digest and row_digest(tmptable_term, keys) + ' = ' + row_digest(tmptable, keys) or
+                same_row(tmptable_term, tmptable, keys)) \
                 + ';'
             if debug:
                 print sql
             cur.execute(sql)
+            stats.unchanged += cur.rowcount
+            logging.debug('Number of changed or new records in temp table: %d' % (stats.staged - stats.unchanged))
             
-            sql = 'SELECT COUNT(*) FROM ' + qn(tmptable_term) + ';'
-            if debug:
-                print sql
-            cur.execute(sql)
-            data = cur.fetchall()
-            logging.debug('Deleted entries count: %d' % data[0][0])
-            
-            logging.debug('Updating.')
-            # Terminate validity to records, which have gone missing.
-            sql = 'UPDATE ' + qn(orig_table) + ' SET ' \
-                + qn(valid_field) + " = ('[' || lower(" + qn(valid_field) + ") || ',' || %s || ')')::" + fieldtypes[valid_field] \
-                + ' FROM ' + qn(tmptable_term) \
-                + ' WHERE upper(' + qn(valid_field) + ') = %s AND ' \
-                + '\n AND '.join(['(%s.%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (qn(orig_table), qn(i), qn(tmptable_term), qn('orig_' + i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable_term), qn('orig_' + i)) for i in keys]) \
+            stats.start('update')
+            logging.debug('Adding changed items')
+            # First terminate validity to records in temporal table. New records
+            # will have same key, starting with current time.
+            sql = 'UPDATE ' + qn(orig_table) + " SET " + qn(valid_field) + " = ('[' || lower(" + qn(valid_field) + ") || ',' || %s || ')'):: " + fieldtypes[valid_field] \
+                + ' FROM ' + qn(tmptable) \
+                + " WHERE upper(" + qn(valid_field) + ") = %s AND " \
+                + (digest and row_digest(orig_table, keys) + ' = ' + row_digest(tmptable, keys) or
+                same_row(orig_table, tmptable, keys)) \
                 + ';'
-            
             params = [timestamp, CURRENT_VALUE]
             if debug:
                 print sql % tuple([adapt(i).getquoted() for i in params])
             cur.execute(sql, params)
-            t2 = time.time()
-            logging.debug('Terminating validity took %.2f seconds' % (t2-t1))
+            stats.terminated += cur.rowcount
+            
+            stats.start('insert')
+            # Insert new records into temporal table, with current time as start of
+            # validity. This covers both updated and new records.
+            if copy_fields is None:
+                copy_fields = []
+                copy_field_spec = []
+                copy_fields_from = ''
+            else:
+                copy_field_spec = ['%s.%s::%s' % (qn(orig_table), qn(i), fieldtypes[i]) for i in copy_fields]
+                copy_fields_from = ' LEFT OUTER JOIN ' + qn(orig_table) + ' ON ' \
+                    + (digest and row_digest(orig_table, keys) + ' = ' + row_digest(tmptable, keys) or
+                    same_row(orig_table, tmptable, keys)) \
+                    + ' AND upper(' + qn(orig_table) + '.' + qn(valid_field) + ') = %s'
+                
+            sql = 'INSERT INTO ' + qn(orig_table) + '(' + ','.join([qn(i) for i in fields + copy_fields + [valid_field]]) + ') ' \
+                + ' SELECT DISTINCT ' + \
+                    ', '.join(['%s.%s::%s' % (qn(tmptable), qn(i), fieldtypes[i]) for i in fields] + \
+                    copy_field_spec + \
+                ["('[' || %s || ',' || %s || ')')::" + fieldtypes[valid_field]]) \
+                    + ' FROM ' + qn(tmptable) + copy_fields_from + ';'
+            if copy_fields:
+                params = [timestamp, CURRENT_VALUE, timestamp]
+            else:
+                params = [timestamp, CURRENT_VALUE]
+            if debug:
+                print sql % tuple([adapt(i).getquoted() for i in params])
+            cur.execute(sql, params)
+            stats.inserted = cur.rowcount
             
+            stats.start('cleanup')
             sql = 'DROP TABLE ' + qn(tmptable_term) + ';'
             if debug:
                 print sql
             cur.execute(sql)
         
-        t1 = time.time()
-        
-        # Select keys from current temporal table, that have exact counterparts
-        # (including non-key fields) in new dump. We use this to see which
-        # records have not changed.
-        sql = 'SELECT ' \
-            + ', '.join(['%s.%s' % (qn(orig_table), qn(i)) for i in keys]) \
-            + ' INTO ' + qn(tmptable_term) \
-            + ' FROM ' + qn(orig_table) \
-            + ' JOIN ' + qn(tmptable) + ' ON ' \
-            + ' AND '.join(['(%s.%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (qn(orig_table), qn(i), qn(tmptable), qn(i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable), qn(i)) for i in fields]) \
-            + ' ' \
-            + ' WHERE upper(' + qn(valid_field) + ') = %s AND ' \
-            + '\n AND '.join(['(%s.%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (qn(orig_table), qn(i), qn(tmptable), qn(i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable), qn(i)) for i in fields]) \
-            + ';'
-        params = [CURRENT_VALUE]
+        stats.start('cleanup')
+        logging.debug('Dropping temporary table ' + tmptable)
+        cur.execute('DROP TABLE ' + qn(tmptable) + ';')
+
+        sql = 'SAVEPOINT merge_complete;'
+        if debug:
+            print sql
+        cur.execute(sql)
+
+        if callback is not None and callable(callback):
+            stats.start('callback')
+            logging.info('Calling callback.')
+            callback(model=model, timestamp=timestamp, keys=keys, snapshot=snapshot, conn=conn)
+        stats.start('commit')
+    stats.stop()
+    
+    stats.total = time.time() - total_t1
+    logging.info('Merged %r' % (stats,))
+    if metrics is not None:
+        stats.send(metrics)
+    return stats
+
+
+def diff(new_csv, model, timestamp, keys, snapshot='full', conn=None, valid_field='valid', debug=False, staging='temp', chunk_size=2000):
+    """
+    Yields the changes merging `new_csv` would make, as `Change` tuples,
+    without changing the table. Arguments are those of `merge`.
+    
+    The records are staged and compared with the records valid at
+    `timestamp`, and the changes are read through a server-side cursor,
+    `chunk_size` at a time. This runs in a transaction of its own, which
+    lasts until the changes have all been read or the generator is closed.
+    """
+    assert snapshot in ('full', 'delta')
+    assert staging in ('temp', 'unlogged')
+    
+    if conn is None:
+        conn = connection
+    
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    new_csv, fields, reader = merge_source(new_csv, model, conn, valid_field)
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    suffix = uuid.uuid4().hex[:12]
+    tmptable = truncate_name('%s_temp_%s' % (orig_table, suffix), conn.ops.max_name_length())
+    
+    with transaction.commit_on_success(using=conn.alias):
+        cur = conn.cursor()
+        stage_records(cur, conn, new_csv, fields, reader, tmptable, keys, fieldtypes, staging=staging, debug=debug)
+        orig_where = None
+        if isinstance(new_csv, StagedRecords):
+            orig_where = new_csv.orig_where(orig_table, keys, fieldtypes, qn)
+        sql, params = change_set_sql(conn, model, tmptable, timestamp, keys, fields,
+            snapshot=snapshot, valid_field=valid_field, orig_where=orig_where)
+        sql = 'SELECT * FROM (' + sql + ') AS changes WHERE ' + qn('_change') + " <> 'unchanged';"
         if debug:
             print sql % tuple([adapt(i).getquoted() for i in params])
-        cur.execute(sql, params)
         
-        # Delete rows from new dump, which have not changed compared to temporal
-        # table.
-        sql = 'DELETE FROM ' + qn(tmptable) \
-            + ' USING ' + qn(tmptable_term) \
-            + ' WHERE ' \
-            + '\n AND '.join(
-                ['(%s.%s::%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (
-                    qn(tmptable_term), qn(i), fieldtypes[i], qn(tmptable), qn(i), fieldtypes[i], qn(tmptable_term), qn(i), qn(tmptable), qn(i)) for i in keys]
-                ) \
-            + ';'
+        changes = conn.connection.cursor('%s_diff_%s' % (orig_table, suffix))
+        changes.itersize = chunk_size
+        changes.execute(sql, params)
+        for row in changes:
+            yield Change(tuple(row[:len(keys)]), row[len(keys)], row[len(keys) + 1])
+        changes.close()
+        cur.execute('DROP TABLE ' + qn(tmptable) + ';')
+
+
+def parallel_merge(new_csv, model, timestamp, keys, workers=4, callback=None, conn=None, debug=False, **kwargs):
+    """
+    Merges like `merge`, splitting the work over `workers` connections.
+    
+    The records are staged once, in an unlogged table. Each worker then
+    merges the records whose keys hash to its shard, on a connection and in
+    a transaction of its own. Shards commit independently: until all of
+    them have, other sessions can see the table partly merged, and if a
+    shard fails the others stay merged. Merging the same data again is a
+    no-op for the shards already merged, so rerunning a failed merge
+    completes it.
+    
+    `callback` is called once all shards have been merged, with `conn`.
+    Other arguments are passed on to `merge`. Returns the `MergeStats` of
+    all shards together, with the wall time of the whole merge as total.
+    """
+    if conn is None:
+        conn = connection
+    
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    fields, reader = open_source(new_csv, model, conn)
+    qn = conn.ops.quote_name
+    stage = truncate_name('%s_stage_%s' % (model._meta.db_table, uuid.uuid4().hex[:12]), conn.ops.max_name_length())
+    metrics = kwargs.pop('metrics', None)
+    stats = MergeStats()
+    
+    t1 = time.time()
+    stats.start('stage')
+    with transaction.commit_on_success(using=conn.alias):
+        cur = TimedCursor(conn.cursor(), stats)
+        sql = 'CREATE UNLOGGED TABLE ' + qn(stage) + '(' + ', '.join(['%s %s NULL' % (qn(i), fieldtypes[i]) for i in fields]) + ');'
         if debug:
             print sql
         cur.execute(sql)
+        sql = 'COPY ' + qn(stage) + ' FROM stdin WITH ' + reader.copy_options + ';'
+        if debug:
+            print sql
+        cur.copy_expert(sql, reader, COPY_CHUNK_SIZE)
+        cur.execute('ANALYZE ' + qn(stage) + ';')
+    stats.stop()
+    
+    errors = []
+    shard_stats = []
+    def work(shard):
+        # connections are per thread, this opens a new one
+        shard_conn = connections[conn.alias]
+        try:
+            shard_stats.append(merge(StagedShard(stage, fields, shard, workers), model, timestamp, keys,
+                conn=shard_conn, debug=debug, **kwargs))
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            shard_conn.close()
+    
+    try:
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        with transaction.commit_on_success(using=conn.alias):
+            conn.cursor().execute('DROP TABLE ' + qn(stage) + ';')
+    
+    if errors:
+        logging.error('%d of %d shards failed' % (len(errors), workers))
+        raise errors[0][0], errors[0][1], errors[0][2]
+    
+    for shard in shard_stats:
+        stats.add(shard)
+    if callback is not None and callable(callback):
+        stats.start('callback')
+        logging.info('Calling callback.')
+        callback(model=model, timestamp=timestamp, keys=keys, snapshot=kwargs.get('snapshot', 'full'), conn=conn)
+        stats.stop()
+    
+    stats.total = time.time() - t1
+    logging.info('Merged %r' % (stats,))
+    if metrics is not None:
+        stats.send(metrics)
+    return stats
+
+
+# table keeping the progress of batched merges, created on first use
+CHECKPOINT_TABLE = 'django_temporal_merge_checkpoint'
+
+
+def batched_merge(new_csv, model, timestamp, keys, name, batch_size=100000, snapshot='full', callback=None, conn=None, debug=False, **kwargs):
+    """
+    Merges like `merge`, in batches of `batch_size` keys which commit one
+    by one, so that an interrupted merge can be resumed.
+    
+    The records are staged once, numbered into batches in order of their
+    keys, and the progress is kept in a checkpoint table under `name`.
+    Calling batched_merge again with the same name resumes after the last
+    committed batch, from the staged records; `new_csv` is not read then.
+    For a full snapshot, the records which have gone missing are terminated
+    first, in a transaction of its own; a full snapshot older than some of
+    the history is refused with ValueError. Until the last batch has committed,
+    other sessions see the table partly merged.
+    
+    `callback` is called once, after the last batch, with `conn`. Other
+    arguments are passed on to `merge`. Returns the `MergeStats` of the
+    batches merged by this call together.
+    """
+    assert snapshot in ('full', 'delta')
+    assert batch_size > 0
+    
+    if conn is None:
+        conn = connection
+    
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    checkpoint_table = qn(CHECKPOINT_TABLE)
+    metrics = kwargs.pop('metrics', None)
+    stats = MergeStats()
+    
+    t1 = time.time()
+    stats.start('stage')
+    with transaction.commit_on_success(using=conn.alias):
+        cur = TimedCursor(conn.cursor(), stats)
+        sql = 'CREATE TABLE IF NOT EXISTS ' + checkpoint_table + ' (' \
+            + 'name varchar(200) PRIMARY KEY, ' \
+            + 'model_table varchar(200) NOT NULL, ' \
+            + 'stage_table varchar(200) NOT NULL, ' \
+            + 'fields text NOT NULL, ' \
+            + 'valid_at varchar(100) NOT NULL, ' \
+            + 'snapshot varchar(5) NOT NULL, ' \
+            + 'batches integer NOT NULL, ' \
+            + 'terminated boolean NOT NULL, ' \
+            + 'next_batch integer NOT NULL);'
+        if debug:
+            print sql
+        cur.execute(sql)
+        cur.execute('SELECT model_table, stage_table, fields, valid_at, snapshot, batches, terminated, next_batch FROM ' \
+            + checkpoint_table + ' WHERE name = %s FOR UPDATE;', [name])
+        row = cur.fetchone()
         
-        t2 = time.time()
-        logging.debug('Deleting took %.2f' % (t2-t1,))
+        if row is None:
+            # missing records would have to be restored after the history
+            # which follows, which merging by batches of keys cannot do
+            if snapshot == 'full' and is_retroactive(cur, conn, model, timestamp,
+                    valid_field=kwargs.get('valid_field', 'valid'), debug=debug):
+                raise ValueError("%s has history after %s, merge the full snapshot with merge" % (orig_table, timestamp))
+            fields, reader = open_source(new_csv, model, conn)
+            suffix = uuid.uuid4().hex[:12]
+            stage = truncate_name('%s_batches_%s' % (orig_table, suffix), conn.ops.max_name_length())
+            rawtable = truncate_name('%s_temp_%s' % (orig_table, suffix), conn.ops.max_name_length())
+            
+            sql = 'CREATE TEMP TABLE ' + qn(rawtable) + '(' + ', '.join(['%s %s NULL' % (qn(i), fieldtypes[i]) for i in fields]) + ');'
+            if debug:
+                print sql
+            cur.execute(sql)
+            sql = 'COPY ' + qn(rawtable) + ' FROM stdin WITH ' + reader.copy_options + ';'
+            if debug:
+                print sql
+            cur.copy_expert(sql, reader, COPY_CHUNK_SIZE)
+            
+            # records with the same keys fall into the same batch
+            sql = 'CREATE TABLE ' + qn(stage) + ' AS SELECT ' + ', '.join([qn(i) for i in fields]) \
+                + ', (dense_rank() OVER (ORDER BY ' + ', '.join([qn(i) for i in keys]) + ') - 1) / ' \
+                + str(int(batch_size)) + ' AS ' + qn('_batch') \
+                + ' FROM ' + qn(rawtable) + ';'
+            if debug:
+                print sql
+            cur.execute(sql)
+            cur.execute('DROP TABLE ' + qn(rawtable) + ';')
+            sql = 'CREATE INDEX ' + qn(truncate_name('%s_batch_idx_%s' % (orig_table, suffix), conn.ops.max_name_length())) \
+                + ' ON ' + qn(stage) + '(' + qn('_batch') + ');'
+            if debug:
+                print sql
+            cur.execute(sql)
+            cur.execute('ANALYZE ' + qn(stage) + ';')
+            cur.execute('SELECT coalesce(max(' + qn('_batch') + ') + 1, 0) FROM ' + qn(stage) + ';')
+            batches = cur.fetchone()[0]
+            terminated, next_batch = False, 0
+            
+            cur.execute('INSERT INTO ' + checkpoint_table \
+                + ' (name, model_table, stage_table, fields, valid_at, snapshot, batches, terminated, next_batch)' \
+                + ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);',
+                [name, orig_table, stage, ','.join(fields), unicode(timestamp), snapshot, batches, terminated, next_batch])
+            logging.debug('Staged %d batches in %s' % (batches, stage))
+        else:
+            model_table, stage, fields, valid_at, resumed_snapshot, batches, terminated, next_batch = row
+            if (model_table, valid_at, resumed_snapshot) != (orig_table, unicode(timestamp), snapshot):
+                raise ValueError("Checkpoint %r is a %s merge into %s at %s" % (name, resumed_snapshot, model_table, valid_at))
+            fields = fields.split(',')
+            logging.debug('Resuming at batch %d of %d' % (next_batch, batches))
+    
+    if snapshot == 'full' and not terminated:
+        stats.start('terminate')
+        with transaction.commit_on_success(using=conn.alias):
+            cur = TimedCursor(conn.cursor(), stats)
+            locked = lock_keys(cur, conn, model, stage, timestamp, keys, fields, valid_field=kwargs.get('valid_field', 'valid'),
+                changes=('terminate',), debug=debug)
+            stats.terminated += terminate_missing(cur, conn, model, stage, timestamp, keys,
+                valid_field=kwargs.get('valid_field', 'valid'),
+                orig_where=locked_keys_sql(orig_table, keys, fieldtypes, locked, qn),
+                digest=kwargs.get('digest', False),
+                staging=kwargs.get('staging', 'temp'), debug=debug)
+            cur.execute('UPDATE ' + checkpoint_table + ' SET terminated = true WHERE name = %s;', [name])
+    
+    stats.stop()
+    
+    for batch in range(next_batch, batches):
+        # the checkpoint moves on in the transaction of the batch
+        def checkpoint(conn, batch=batch, **kw):
+            conn.cursor().execute('UPDATE ' + checkpoint_table + ' SET next_batch = %s WHERE name = %s;', [batch + 1, name])
+        stats.add(merge(StagedRecords(stage, fields, qn('_batch') + ' = ' + str(int(batch))), model, timestamp, keys,
+            snapshot='delta', callback=checkpoint, conn=conn, debug=debug, **kwargs))
+        logging.debug('Merged batch %d of %d' % (batch + 1, batches))
+    
+    stats.start('cleanup')
+    with transaction.commit_on_success(using=conn.alias):
+        cur = TimedCursor(conn.cursor(), stats)
+        cur.execute('DROP TABLE ' + qn(stage) + ';')
+        cur.execute('DELETE FROM ' + checkpoint_table + ' WHERE name = %s;', [name])
+    
+    if callback is not None and callable(callback):
+        stats.start('callback')
+        logging.info('Calling callback.')
+        callback(model=model, timestamp=timestamp, keys=keys, snapshot=snapshot, conn=conn)
+    stats.stop()
+    
+    stats.total = time.time() - t1
+    logging.info('Merged %r' % (stats,))
+    if metrics is not None:
+        stats.send(metrics)
+    return stats
+
+
+def backfill(snapshots, model, keys, snapshot='full', conn=None, valid_field='valid', debug=False, staging='temp', metrics=None):
+    """
+    Builds the history of model from a sequence of (timestamp, source)
+    pairs in one pass, instead of merging them one by one.
+    
+    Each source is staged like in `merge`, all of them into one table. The
+    versions of each key and their validity are then computed at once, with
+    window functions over the snapshots in order, and inserted in a single
+    statement. `snapshot` is "full" or "delta" and applies to all of the
+    snapshots, as in `merge`. The result is the same as merging the
+    snapshots in order, on a table with no history after the first
+    timestamp, which is checked.
+    
+    Timestamps must be increasing. Returns a `MergeStats`.
+    """
+    assert snapshot in ('full', 'delta')
+    assert staging in ('temp', 'unlogged')
+    
+    if conn is None:
+        conn = connection
+    
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    time_type = CURRENT_VALUE is DATE_CURRENT and 'date' or 'timestamptz'
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    stats = MergeStats()
+    total_t1 = time.time()
+    
+    with transaction.commit_on_success(using=conn.alias):
+        cur = TimedCursor(conn.cursor(), stats)
+        suffix = uuid.uuid4().hex[:12]
+        staging_name = lambda name: truncate_name('%s_%s_%s' % (orig_table, name, suffix), conn.ops.max_name_length())
+        tmptable = staging_name('temp')
+        timestable = staging_name('times')
+        staging_kind = staging.upper()
+        
+        stats.start('stage')
+        fields = None
+        timestamps = []
+        for seq, (timestamp, source) in enumerate(snapshots):
+            if timestamps and not timestamps[-1] < timestamp:
+                raise ValueError("Snapshot timestamps are not increasing: %r, %r" % (timestamps[-1], timestamp))
+            timestamps.append(timestamp)
+            source_fields, reader = open_source(source, model, conn)
+            if fields is None:
+                fields = source_fields
+                sql = 'CREATE ' + staging_kind + ' TABLE ' + qn(tmptable) + '(' \
+                    + ', '.join(['%s %s NULL' % (qn(i), fieldtypes[i]) for i in fields]) \
+                    + ', ' + qn('_seq') + ' integer NOT NULL);'
+                if debug:
+                    print sql
+                cur.execute(sql)
+                sql = 'CREATE ' + staging_kind + ' TABLE ' + qn(timestable) + '(' \
+                    + qn('_seq') + ' integer PRIMARY KEY, ' + qn('_ts') + ' ' + time_type + ' NOT NULL);'
+                if debug:
+                    print sql
+                cur.execute(sql)
+            elif source_fields != fields:
+                raise ValueError("Snapshot at %s has fields %s, not %s" % (timestamp, ', '.join(source_fields), ', '.join(fields)))
+            
+            # rows copied get the number of their snapshot by default
+            cur.execute('ALTER TABLE ' + qn(tmptable) + ' ALTER ' + qn('_seq') + ' SET DEFAULT ' + str(int(seq)) + ';')
+            sql = 'COPY ' + qn(tmptable) + '(' + ', '.join([qn(i) for i in fields]) + ') FROM stdin WITH ' + reader.copy_options + ';'
+            if debug:
+                print sql
+            cur.copy_expert(sql, reader, COPY_CHUNK_SIZE)
+            cur.execute('INSERT INTO ' + qn(timestable) + ' VALUES (%s, %s);', [seq, timestamp])
+        
+        if fields is None:
+            stats.stop()
+            return stats
         
         sql = 'SELECT COUNT(*) FROM %s' % qn(tmptable) + ';'
+        cur.execute(sql)
+        stats.staged = cur.fetchall()[0][0]
+        logging.debug('Number of records in %d snapshots: %d' % (len(timestamps), stats.staged))
+        cur.execute('ANALYZE ' + qn(tmptable) + ';')
+        cur.execute('ANALYZE ' + qn(timestable) + ';')
+        
+        stats.start('lock')
+        sql = 'LOCK TABLE ' + qn(orig_table) + ' IN SHARE ROW EXCLUSIVE MODE;'
         if debug:
             print sql
         cur.execute(sql)
-        count = cur.fetchall()[0][0]
-        logging.debug('Number of changed or new records in temp table: %d' % count)
+        sql = 'SELECT 1 FROM ' + qn(orig_table) + ' WHERE upper(' + qn(valid_field) + ') > %s LIMIT 1;'
+        cur.execute(sql, [timestamps[0]])
+        if cur.fetchone() is not None:
+            raise ValueError("%s has history after %s" % (orig_table, timestamps[0]))
         
-        logging.debug('Adding changed items')
-        # First terminate validity to records in temporal table. New records
-        # will have same key, starting with current time.
-        sql = 'UPDATE ' + qn(orig_table) + " SET " + qn(valid_field) + " = ('[' || lower(" + qn(valid_field) + ") || ',' || %s || ')'):: " + fieldtypes[valid_field] \
-            + ' FROM ' + qn(tmptable) \
-            + " WHERE upper(" + qn(valid_field) + ") = %s AND " \
-            + ' AND '.join(
-                ['(%s.%s::%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (
-                    qn(orig_table), qn(i), fieldtypes[i], qn(tmptable), qn(i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable), qn(i)) for i in keys]
-                ) \
+        stats.start('insert')
+        # A version starts where a key first appears, where its values
+        # change, and in full snapshots also where it reappears after having
+        # been missing. Numbering the starts gives each row its version.
+        key_list = ', '.join([qn(i) for i in keys])
+        field_list = ', '.join([qn(i) for i in fields])
+        values = [i for i in fields if i not in keys]
+        unchanged = ' AND '.join(['NOT (%s IS DISTINCT FROM lag(%s) OVER w)' % (qn(i), qn(i)) for i in values]) or 'true'
+        if snapshot == 'full':
+            continued = 'lag(' + qn('_seq') + ') OVER w = ' + qn('_seq') + ' - 1'
+            # a version ends with the first snapshot without it
+            end_seq = 'max(' + qn('_seq') + ') + 1'
+        else:
+            continued = 'lag(' + qn('_seq') + ') OVER w IS NOT NULL'
+            # a version ends where the next one starts
+            end_seq = 'lead(min(' + qn('_seq') + ')) OVER (PARTITION BY ' + key_list + ' ORDER BY ' + qn('_version') + ')'
+        
+        sql = 'INSERT INTO ' + qn(orig_table) + '(' + field_list + ', ' + qn(valid_field) + ') ' \
+            + 'SELECT ' + ', '.join(['v.%s::%s' % (qn(i), fieldtypes[i]) for i in fields]) \
+            + ', ' + fieldtypes[valid_field] + '(s.' + qn('_ts') + ', coalesce(e.' + qn('_ts') + ', %s), \'[)\')' \
+            + ' FROM (' \
+                + 'SELECT ' + field_list + ', min(' + qn('_seq') + ') AS ' + qn('_start_seq') \
+                + ', ' + end_seq + ' AS ' + qn('_end_seq') \
+                + ' FROM (' \
+                    + 'SELECT ' + field_list + ', ' + qn('_seq') \
+                    + ', sum(' + qn('_start') + ') OVER (PARTITION BY ' + key_list + ' ORDER BY ' + qn('_seq') + ') AS ' + qn('_version') \
+                    + ' FROM (' \
+                        + 'SELECT ' + field_list + ', ' + qn('_seq') \
+                        + ', CASE WHEN ' + continued + ' AND ' + unchanged + ' THEN 0 ELSE 1 END AS ' + qn('_start') \
+                        + ' FROM (SELECT DISTINCT ' + field_list + ', ' + qn('_seq') + ' FROM ' + qn(tmptable) + ') AS d' \
+                        + ' WINDOW w AS (PARTITION BY ' + key_list + ' ORDER BY ' + qn('_seq') + ')' \
+                    + ') AS c' \
+                + ') AS b' \
+                + ' GROUP BY ' + field_list + ', ' + qn('_version') \
+            + ') AS v' \
+            + ' JOIN ' + qn(timestable) + ' s ON s.' + qn('_seq') + ' = v.' + qn('_start_seq') \
+            + ' LEFT OUTER JOIN ' + qn(timestable) + ' e ON e.' + qn('_seq') + ' = v.' + qn('_end_seq') \
             + ';'
-        params = [timestamp, CURRENT_VALUE]
+        params = [CURRENT_VALUE]
         if debug:
             print sql % tuple([adapt(i).getquoted() for i in params])
         cur.execute(sql, params)
+        stats.inserted = cur.rowcount
         
-        print '~'*30
-        # Insert new records into temporal table, with current time as start of
-        # validity. This covers both updated and new records.
-        if copy_fields is None:
-            copy_fields = []
-            copy_field_spec = []
-            copy_fields_from = ''
-        else:
-            copy_field_spec = ['%s.%s::%s' % (qn(orig_table), qn(i), fieldtypes[i]) for i in copy_fields]
-            copy_fields_from = ' LEFT OUTER JOIN ' + qn(orig_table) + ' ON ' \
-                + ' AND '.join(
-                ['(%s.%s::%s=%s.%s::%s OR (%s.%s IS NULL AND %s.%s IS NULL))' % (
-                    qn(orig_table), qn(i), fieldtypes[i], qn(tmptable), qn(i), fieldtypes[i], qn(orig_table), qn(i), qn(tmptable), qn(i)) for i in keys]
-                ) \
-                + ' AND upper(' + qn(orig_table) + '.' + qn(valid_field) + ') = %s'
-            
-        sql = 'INSERT INTO ' + qn(orig_table) + '(' + ','.join([qn(i) for i in fields + copy_fields + [valid_field]]) + ') ' \
-            + ' SELECT DISTINCT ' + \
-                ', '.join(['%s.%s::%s' % (qn(tmptable), qn(i), fieldtypes[i]) for i in fields] + \
-                copy_field_spec + \
-            ["('[' || %s || ',' || %s || ')')::" + fieldtypes[valid_field]]) \
-                + ' FROM ' + qn(tmptable) + copy_fields_from + ';'
-        if copy_fields:
-            params = [timestamp, CURRENT_VALUE, timestamp]
-        else:
-            params = [timestamp, CURRENT_VALUE]
+        stats.start('cleanup')
+        cur.execute('DROP TABLE ' + qn(tmptable) + ';')
+        cur.execute('DROP TABLE ' + qn(timestable) + ';')
+        stats.start('commit')
+    stats.stop()
+    
+    stats.total = time.time() - total_t1
+    logging.info('Backfilled %r' % (stats,))
+    if metrics is not None:
+        stats.send(metrics)
+    return stats
+
+
+def coalesce(source, fields=None, conn=None, valid_field=None, debug=False):
+    """
+    Coalesces value-equivalent versions: records of a model, or of a
+    QuerySet, whose `fields` are all equal and whose validity overlaps or
+    touches, are replaced by one record valid over all of them. Returns the
+    number of records removed.
+    
+    `fields` default to all fields but the primary key and `valid_field`,
+    which defaults to the temporal field of the model. Other fields are
+    taken from the earliest record. Records are numbered into islands with
+    window functions: a record starts a new island unless it starts before
+    the latest end of the records before it with the same values. Missing
+    bounds are unbounded, and so is the bound of an island they are in.
+    """
+    if isinstance(source, QuerySet):
+        model = source.model
+        if conn is None:
+            conn = connections[source.db]
+    else:
+        model, source = source, None
+    if conn is None:
+        conn = connection
+    
+    valid_field = get_temporal_field(model, valid_field).attname
+    pk = model._meta.pk.attname
+    if fields is None:
+        fields = [f.attname for f in model._meta.fields if f.attname not in (pk, valid_field)]
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    orig_table = model._meta.db_table
+    qn = conn.ops.quote_name
+    tmptable = truncate_name('%s_coalesce_%s' % (orig_table, uuid.uuid4().hex[:12]), conn.ops.max_name_length())
+    
+    params = []
+    where = ''
+    if source is not None:
+        sql, params = source.values(pk).query.sql_with_params()
+        where = ' WHERE ' + qn(pk) + ' IN (' + sql + ')'
+    partition = ', '.join([qn(i) for i in fields])
+    order = 'lower(' + qn(valid_field) + ') NULLS FIRST, ' + qn(pk)
+    island = 'PARTITION BY ' + partition + ', ' + qn('_island')
+    # missing bounds compare as infinite
+    element_type = conn.ops.temporal_element_types[fieldtypes[valid_field]]
+    lower = 'CASE WHEN lower_inf(' + qn(valid_field) + ") THEN '-infinity'::" + element_type \
+        + ' ELSE lower(' + qn(valid_field) + ') END'
+    upper = 'CASE WHEN upper_inf(' + qn(valid_field) + ") THEN 'infinity'::" + element_type \
+        + ' ELSE upper(' + qn(valid_field) + ') END'
+    
+    with transaction.commit_on_success(using=conn.alias):
+        cur = conn.cursor()
+        sql = 'LOCK TABLE ' + qn(orig_table) + ' IN SHARE ROW EXCLUSIVE MODE;'
+        if debug:
+            print sql
+        cur.execute(sql)
+        
+        sql = 'CREATE TEMP TABLE ' + qn(tmptable) + ' AS SELECT * FROM (SELECT ' + qn(pk) + ', ' \
+            + 'first_value(' + qn(pk) + ') OVER (' + island + ' ORDER BY ' + order + ') AS ' + qn('_first') + ', ' \
+            + fieldtypes[valid_field] + '(CASE WHEN bool_or(lower_inf(' + qn(valid_field) + ')) OVER (' + island + ') THEN NULL ' \
+                + 'ELSE min(lower(' + qn(valid_field) + ')) OVER (' + island + ') END, ' \
+                + 'CASE WHEN bool_or(upper_inf(' + qn(valid_field) + ')) OVER (' + island + ') THEN NULL ' \
+                + 'ELSE max(upper(' + qn(valid_field) + ')) OVER (' + island + ") END, '[)') AS " + qn('_valid') + ', ' \
+            + 'count(*) OVER (' + island + ') AS ' + qn('_versions') \
+            + ' FROM (SELECT ' + qn(pk) + ', ' + qn(valid_field) + ', ' + partition + ', ' \
+                + 'sum(' + qn('_start') + ') OVER (PARTITION BY ' + partition + ' ORDER BY ' + order + ') AS ' + qn('_island') \
+            + ' FROM (SELECT ' + qn(pk) + ', ' + qn(valid_field) + ', ' + partition + ', ' \
+                + 'CASE WHEN ' + lower + ' <= max(' + upper + ') OVER (PARTITION BY ' + partition \
+                + ' ORDER BY ' + order + ' ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) THEN 0 ELSE 1 END AS ' + qn('_start') \
+            + ' FROM ' + qn(orig_table) + where + ') AS starts) AS islands) AS versions' \
+            + ' WHERE ' + qn('_versions') + ' > 1;'
         if debug:
             print sql % tuple([adapt(i).getquoted() for i in params])
         cur.execute(sql, params)
         
-        logging.debug('Dropping temporary table ' + tmptable)
-        cur.execute('DROP TABLE ' + qn(tmptable) + ';')
-        
-        sql = 'DROP TABLE ' + qn(tmptable_term) + ';'
+        # the versions are removed before the first one is extended over
+        # them, which would violate the exclusion constraint otherwise
+        sql = 'DELETE FROM ' + qn(orig_table) + ' USING ' + qn(tmptable) + ' t' \
+            + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = t.' + qn(pk) \
+            + ' AND t.' + qn(pk) + ' <> t.' + qn('_first') + ';'
         if debug:
             print sql
         cur.execute(sql)
-
-        sql = 'SAVEPOINT merge_complete;'
+        removed = cur.rowcount
+        sql = 'UPDATE ' + qn(orig_table) + ' SET ' + qn(valid_field) + ' = t.' + qn('_valid') \
+            + ' FROM ' + qn(tmptable) + ' t' \
+            + ' WHERE ' + qn(orig_table) + '.' + qn(pk) + ' = t.' + qn(pk) \
+            + ' AND t.' + qn(pk) + ' = t.' + qn('_first') + ';'
         if debug:
             print sql
         cur.execute(sql)
+        cur.execute('DROP TABLE ' + qn(tmptable) + ';')
+    
+    logging.info('Coalesced %d versions of %s' % (removed, orig_table))
+    return removed
 
-        if callback is not None and callable(callback):
-            logging.info('Calling callback.')
-            callback(model=model, timestamp=timestamp, keys=keys, snapshot=snapshot, conn=conn)
 
-        total_t2 = time.time()
-        logging.info('Total time: %.2f seconds.' % (total_t2-total_t1))
+def lock_key(record, model, keys, conn=None):
+    """
+    Takes the advisory lock `merge` takes for the key of `record`, a
+    dictionary of field values, until the end of the transaction. `keys`
+    are the key fields, in the order they are given to `merge`.
+    
+    Writers changing versions of single keys take it to wait for a merge of
+    the same key, instead of failing on the exclusion constraint late in the
+    merge. Merges of keys in other buckets, see `lock_keys`, do not block
+    them.
+    """
+    if conn is None:
+        conn = connection
+    
+    fieldtypes = dict([(f.attname, f.db_type(conn)) for f in model._meta.fields])
+    sql = 'SELECT pg_advisory_xact_lock(hashtext(%s), ((hashtext(ROW(' \
+        + ', '.join(['%%s::%s' % fieldtypes[i] for i in keys]) + ')::text)::bigint + 2147483648) * ' \
+        + str(int(KEY_LOCK_BUCKETS)) + ' / 4294967296)::integer);'
+    conn.cursor().execute(sql, [model._meta.db_table] + [record[i] for i in keys])
+
+
+def save_version(record, model, timestamp, keys, terminate=False, conn=None, valid_field='valid'):
+    """
+    Makes `record`, a dictionary of field values, the version of its key
+    valid from `timestamp` on, through the ORM and under `lock_key`.
+    
+    The current version of the key ends at `timestamp`, unless it already
+    has the values of `record`. With `terminate=True` the current version
+    is ended and no new one is added. Returns the version valid from
+    `timestamp`, or None. Raises ValueError if the key has history after
+    `timestamp`.
+    """
+    if conn is None:
+        conn = connection
+    
+    manager = model._default_manager.db_manager(conn.alias)
+    value_class = model._meta.get_field(valid_field).value_class
+    CURRENT_VALUE = current_value(model, valid_field, conn)
+    if isinstance(timestamp, datetime.datetime) and timestamp.tzinfo is not None:
+        # bounds of periods are naive, in UTC
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    
+    with transaction.commit_on_success(using=conn.alias):
+        lock_key(record, model, keys, conn=conn)
+        versions = [i for i in manager.filter(**dict([(k, record[k]) for k in keys]))
+            if getattr(i, valid_field).upper > timestamp]
+        if len(versions) > 1 or [i for i in versions if getattr(i, valid_field).lower > timestamp or not getattr(i, valid_field).is_current()]:
+            raise ValueError("%s has history after %s" % (model._meta.db_table, timestamp))
+        
+        if versions:
+            version = versions[0]
+            if not terminate and all([getattr(version, k) == v for k, v in record.items()]):
+                return version
+            if getattr(version, valid_field).lower == timestamp:
+                version.delete()
+            else:
+                getattr(version, valid_field).upper = timestamp
+                version.save(using=conn.alias)
+        
+        if terminate:
+            return None
+        version = model(**record)
+        setattr(version, valid_field, value_class(lower=timestamp, upper=CURRENT_VALUE))
+        version.save(using=conn.alias)
+        return version
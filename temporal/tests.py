@@ -1,10 +1,12 @@
 
 import datetime
 import unittest2
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.db import connection, transaction
 from django.db.utils import IntegrityError
-from django_temporal.db.models.fields import Period, DateRange, TIME_CURRENT, TZDatetime
+from django.core.exceptions import ValidationError
+from django_temporal.db.models.fields import Period, DateRange, PeriodSet, TIME_CURRENT, DATE_CURRENT, TZDatetime
+from django_temporal.db.models.query import TemporalQuerySet
 from models import Category, CategoryToo, ReferencedTemporalFK, BothTemporalFK, DateTestModel, NullEmptyFieldModel, DateMergeModel, DateMergeModelNull, DateTimeMergeModel
 
 from contextlib import contextmanager
@@ -52,6 +54,29 @@ class TestParseTimestamp(TestCase):
         m = TZ_OFFSET.match('"2009-06-04 12:00:00 +0100"')
         self.assertEqual(m.groups(), ('2009-06-04 12:00:00', '+', '01', '00'))
 
+        # strings with an offset are parsed to UTC directly
+        import pytz
+        from django_temporal.db.models.fields import TZDateTimeField, get_tz, force_tz
+        field = TZDateTimeField()
+        utc = lambda *args: datetime.datetime(*args, tzinfo=pytz.utc)
+        for value, expected in [
+                ('2000-01-01 12:00:00.000000+0000', utc(2000, 1, 1, 12)),
+                ('2009-06-04 12:00:00 +0100', utc(2009, 6, 4, 11)),
+                ('"2009-06-04 12:00:00 +0100"', utc(2009, 6, 4, 11)),
+                ('2009-06-04T12:00:00.5-02:30', utc(2009, 6, 4, 14, 30, 0, 500000)),
+                ('2009-06-04 12:00+01', utc(2009, 6, 4, 11)),
+                ('2009-06-04 23:30:00.1234567-01', utc(2009, 6, 5, 0, 30, 0, 123456))]:
+            parsed = field.to_python(value)
+            self.assertEqual((parsed, parsed.tzinfo), (expected, pytz.utc))
+            self.assertEqual(type(parsed), TZDatetime)
+        self.assertEqual(field.to_python('2009-06-04 12:00:00'), datetime.datetime(2009, 6, 4, 12))
+        self.assertRaises(ValidationError, field.to_python, '2009-02-30 12:00:00+0100')
+        self.assertRaises(ValidationError, field.to_python, '9999-12-31 23:00-01')
+        self.assertRaises(ValidationError, field.to_python, '0001-01-01 00:30+01')
+
+        self.assertTrue(get_tz('Europe/Ljubljana') is get_tz('Europe/Ljubljana'))
+        self.assertEqual(force_tz(datetime.datetime(2009, 6, 4, 12), 'UTC'), utc(2009, 6, 4, 12))
+
 class TestOverlaps(TestCase):
     def runTest(self):
         p1 = DateRange('[2010-01-04, 9999-12-30)')
@@ -141,6 +166,224 @@ class TestPeriod(TestCase):
         self.assertEqual([p4, p5], sorted([p5, p4]))
         
 
+class TestPeriodValues(TestCase):
+    def runTest(self):
+        import pickle
+        from django.utils.tzinfo import FixedOffset
+
+        lower = datetime.datetime(2000, 1, 1, 12, 0, 0, 0)
+        upper = datetime.datetime(2000, 2, 1, 12, 0, 0, 0)
+        p = Period(lower=lower, upper=upper)
+        self.assertEqual(hasattr(p, '__dict__'), False)
+        self.assertEqual(p, Period('[2000-01-01 12:00:00.000000+0000,2000-02-01 12:00:00.000000+0000)'))
+
+        # aware bounds are converted to UTC and drop the time zone
+        aware = Period(lower=lower.replace(tzinfo=FixedOffset(60)), upper=upper)
+        self.assertEqual(aware.lower, datetime.datetime(2000, 1, 1, 11, 0, 0, 0))
+        self.assertEqual(aware.lower.tzinfo, None)
+
+        self.assertEqual(p, pickle.loads(pickle.dumps(p)))
+        self.assertEqual(p, pickle.loads(pickle.dumps(p, pickle.HIGHEST_PROTOCOL)))
+        e = Period(empty=True)
+        self.assertEqual(e, pickle.loads(pickle.dumps(e)))
+
+        d = DateRange(lower=lower, upper=upper)
+        self.assertEqual(d.lower, datetime.date(2000, 1, 1))
+        self.assertEqual(type(d.lower), datetime.date)
+        self.assertEqual(d, DateRange('[2000-01-01,2000-01-31]'))
+        self.assertEqual(hasattr(d, '__dict__'), False)
+
+        for bad in [datetime.date(2000, 1, 1), '2000-01-01']:
+            try:
+                p.lower = bad
+            except AssertionError:
+                pass
+            else:
+                self.fail('Should throw an AssertionError')
+
+class TestPeriodKey(TestCase):
+    def runTest(self):
+        d = datetime.date
+        lower = datetime.datetime(2000, 1, 1, 12, 0, 0, 0)
+        upper = datetime.datetime(2000, 2, 1, 12, 0, 0, 0)
+        p = Period(lower=lower, upper=upper)
+        same = Period('[2000-01-01 12:00:00.000000+0000,2000-02-01 12:00:00.000000+0000)')
+        self.assertEqual(hash(p), hash(same))
+        self.assertEqual(len(set([p, same, Period(p)])), 1)
+        self.assertEqual({p: 1}[same], 1)
+        self.assertFalse(p != same)
+        self.assertNotEqual(p, None)
+        self.assertNotEqual(p, Period(empty=True))
+        self.assertEqual(Period(empty=True), DateRange(empty=True))
+
+        # equal closed-open forms are equal, whatever the bounds were
+        self.assertEqual(DateRange('[2000-01-01,2000-01-31]'), DateRange('(1999-12-31,2000-02-01)'))
+        self.assertEqual(hash(DateRange('[2000-01-01,2000-01-31]')), hash(DateRange(d(2000, 1, 1), d(2000, 2, 1))))
+
+        # the cached key follows changes to the bounds
+        key = hash(p)
+        p.upper = upper + datetime.timedelta(1)
+        self.assertNotEqual(p, same)
+        self.assertNotEqual(hash(p), key)
+        p.upper = upper
+        self.assertEqual(p, same)
+        p.end_included = True
+        self.assertNotEqual(p, same)
+        p.normalize()
+        self.assertEqual(p.upper, upper + datetime.timedelta(0, 0, 1))
+
+        # ordering by lower then upper bound, empty periods last
+        e = DateRange(empty=True)
+        a = DateRange(d(2000, 1, 1), d(2000, 2, 1))
+        b = DateRange(d(2000, 1, 1), d(2000, 3, 1))
+        c = DateRange(d(1999, 1, 1), d(2001, 1, 1))
+        u = DateRange._from_bounds(d(2000, 1, 1), None)
+        self.assertEqual(sorted([e, u, b, a, c]), [c, a, b, u, e])
+        self.assertTrue(a < b <= b < u)
+        self.assertTrue(e > u >= u)
+
+class TestPeriodSet(TestCase):
+    def runTest(self):
+        d = datetime.date
+        p1 = DateRange(d(2000, 1, 1), d(2000, 2, 1))
+        p2 = DateRange(d(2000, 1, 15), d(2000, 3, 1))
+        p3 = DateRange(d(2000, 3, 1), d(2000, 4, 1))
+        p4 = DateRange(d(2000, 5, 1), d(2000, 6, 1))
+
+        # overlapping and adjacent periods are coalesced
+        s = PeriodSet([p4, p3, DateRange(empty=True), p2, p1])
+        self.assertEqual(list(s), [DateRange(d(2000, 1, 1), d(2000, 4, 1)), p4])
+        self.assertEqual(len(s), 2)
+        self.assertEqual(s.duration(), datetime.timedelta(91 + 31))
+        self.assertEqual(list(s.gaps()), [DateRange(d(2000, 4, 1), d(2000, 5, 1))])
+
+        self.assertEqual(d(2000, 3, 31) in s, True)
+        self.assertEqual(d(2000, 4, 1) in s, False)
+        self.assertEqual(p2 in s, True)
+        self.assertEqual(DateRange(d(2000, 3, 1), d(2000, 5, 2)) in s, False)
+
+        other = PeriodSet([DateRange(d(2000, 1, 20), d(2000, 5, 10))])
+        self.assertEqual(list(s | other), [DateRange(d(2000, 1, 1), d(2000, 6, 1))])
+        self.assertEqual(list(s & other), [
+            DateRange(d(2000, 1, 20), d(2000, 4, 1)),
+            DateRange(d(2000, 5, 1), d(2000, 5, 10))])
+        self.assertEqual(list(s - other), [
+            DateRange(d(2000, 1, 1), d(2000, 1, 20)),
+            DateRange(d(2000, 5, 10), d(2000, 6, 1))])
+        self.assertEqual(list(s - p4), [DateRange(d(2000, 1, 1), d(2000, 4, 1))])
+
+        complement = s.complement()
+        self.assertEqual(complement[0], DateRange(datetime.date.min, d(2000, 1, 1)))
+        self.assertEqual(complement[-1], DateRange(d(2000, 6, 1), DATE_CURRENT))
+        self.assertEqual(complement | s, PeriodSet([DateRange(datetime.date.min, DATE_CURRENT)]))
+
+        # union of disjoint periods is a set, adjacent ones give a period
+        self.assertEqual(p1.union(p4), PeriodSet([p1, p4]))
+        self.assertEqual(p2 + p3, DateRange(d(2000, 1, 15), d(2000, 4, 1)))
+
+        t = datetime.datetime
+        ps = PeriodSet([Period(t(2000, 1, 1), t(2000, 1, 2)), Period(t(2000, 1, 3), TIME_CURRENT)])
+        self.assertEqual(ps.complement(), PeriodSet([
+            Period(datetime.datetime.min, t(2000, 1, 1)),
+            Period(t(2000, 1, 2), t(2000, 1, 3))]))
+
+class TestPeriodArray(TestCase):
+    def runTest(self):
+        from django_temporal.db.models.arrays import PeriodArray, numpy
+        if numpy is None:
+            raise unittest2.SkipTest('numpy is not installed')
+
+        t = datetime.datetime
+        periods = [
+            Period(t(2000, 1, 1), t(2000, 2, 1)),
+            Period('(2000-01-15 00:00:00.000000+0000,2000-03-01 00:00:00.000000+0000]'),
+            Period(empty=True),
+            Period(t(1999, 1, 1), TIME_CURRENT),
+            ]
+        arr = PeriodArray(periods)
+        self.assertEqual(len(arr), 4)
+        self.assertEqual(list(arr), periods)
+
+        instants = [t(1999, 6, 1), t(2000, 1, 15), t(2000, 1, 15, 0, 0, 0, 1), t(2000, 3, 1), t(2000, 3, 1, 0, 0, 0, 1)]
+        for instant in instants:
+            expected = [not p.empty and p.lower <= instant < p.upper for p in periods]
+            self.assertEqual(list(arr.contains(instant)), expected)
+
+        other = Period(t(2000, 2, 1), t(2000, 2, 10))
+        self.assertEqual(list(arr.overlaps(other)), [p.overlaps(other) for p in periods])
+        self.assertEqual(list(arr.contains(other)), [False, True, False, True])
+        self.assertEqual(list(arr.intersection(other)), [p.intersection(other) for p in periods])
+        self.assertEqual(list(arr.is_current()), [False, False, False, True])
+        self.assertEqual(arr.duration()[0].astype(object), datetime.timedelta(31))
+
+        arr.sort()
+        self.assertEqual(list(arr), sorted([p for p in periods if not p.empty]) + [Period(empty=True)])
+
+        d = datetime.date
+        dates = PeriodArray([DateRange('[2000-01-01,2000-01-31]'), DateRange(d(2000, 3, 1), d(2000, 4, 1))])
+        self.assertEqual(list(dates.contains(d(2000, 1, 31))), [True, False])
+        self.assertEqual(list(dates.contains(t(2000, 3, 1, 12, 0))), [False, True])
+        self.assertEqual(dates.duration()[0].astype(object), datetime.timedelta(31))
+
+        qs = Category.objects.order_by('pk')
+        self.assertEqual(list(PeriodArray.from_queryset(qs)), [c.valid_time for c in qs])
+        cur = connection.cursor()
+        cur.execute('SELECT valid_time FROM temporal_category ORDER BY id')
+        self.assertEqual(list(PeriodArray.from_cursor(cur)), [c.valid_time for c in qs])
+
+class TestPeriodIndex(TestCase):
+    def runTest(self):
+        import random
+        from django_temporal.db.models.index import PeriodIndex
+
+        rnd = random.Random(42)
+        start = datetime.datetime(2000, 1, 1)
+        hour = datetime.timedelta(0, 3600)
+        items = []
+        for i in range(300):
+            lower = start + rnd.randint(0, 1000) * hour
+            if rnd.random() < 0.2:
+                upper = TIME_CURRENT
+            else:
+                upper = lower + rnd.randint(1, 100) * hour
+            items.append((Period(lower, upper), i))
+        index = PeriodIndex(items)
+        self.assertEqual(len(index), 300)
+        self.assertEqual([e.payload for e in index], [i for p, i in sorted(items, key=lambda x: (x[0].lower, x[1]))])
+
+        def brute(period):
+            return sorted([i for p, i in items if p.overlaps(period)])
+
+        for j in range(50):
+            instant = start + rnd.randint(0, 1100) * hour
+            self.assertEqual(sorted([e.payload for e in index.at(instant)]),
+                sorted([i for p, i in items if p.lower <= instant < p.upper]))
+            query = Period(instant, instant + rnd.randint(1, 50) * hour)
+            self.assertEqual(sorted([e.payload for e in index.overlapping(query)]), brute(query))
+
+        current = sorted([i for p, i in items if p.is_current()])
+        self.assertEqual(sorted([e.payload for e in index.current()]), current)
+
+        # closing and removing entries
+        for entry in index.current()[:10]:
+            index.close(entry, start)
+            items[entry.payload] = (Period(entry.period.lower, start), entry.payload)
+        self.assertEqual(len(index.current()), len(current) - 10)
+        entry = index.at(start + 500 * hour)[0]
+        index.remove(entry)
+        del items[[i for p, i in items].index(entry.payload)]
+        self.assertEqual(len(index), 299)
+        query = Period(start, start + 1100 * hour)
+        self.assertEqual(sorted([e.payload for e in index.overlapping(query)]), brute(query))
+
+        # date ranges work on whole days
+        categories = PeriodIndex.from_queryset(Category.objects.all())
+        self.assertEqual([e.payload.pk for e in categories.at(datetime.date(1996, 6, 1))], [2])
+        self.assertEqual(sorted([e.payload.pk for e in categories.current()]), [4, 5])
+        dates = PeriodIndex([(DateRange('[2000-01-01,2000-01-31]'), 'jan')])
+        self.assertEqual([e.payload for e in dates.at(datetime.datetime(2000, 1, 31, 23, 0))], ['jan'])
+        self.assertEqual(dates.at(datetime.date(2000, 2, 1)), [])
+
 class TestPostgreSQL(TestCase):
     def runTest(self):
         p = Period('[2000-01-01 12:00:00.000000+0000,2000-02-01 12:00:00.000000+0000]')
@@ -163,6 +406,48 @@ class TestPostgreSQL(TestCase):
         obj4 = Category.objects.get(valid_time__later=p.later())
         self.assertEquals(obj4.pk, v.pk)
 
+class TestAdapters(TestCase):
+    def runTest(self):
+        cur = connection.cursor()
+        cur.execute('SELECT valid_time FROM temporal_category WHERE id = 1')
+        value = cur.fetchall()[0][0]
+        self.assertEqual(type(value), Period)
+        self.assertEqual(value, Period(lower=datetime.datetime(1996,1,1), upper=datetime.datetime(1996,6,1)))
+
+        p = Period('(2000-01-01 12:00:00.000000+0000,2000-02-01 12:00:00.000000+0000]')
+        d = DateRange('[2000-01-01,2000-02-01]')
+        cur.execute('SELECT %s, %s, %s, %s', [p, d, Period(empty=True), DateRange(empty=True)])
+        row = cur.fetchall()[0]
+        self.assertEqual(type(row[1]), DateRange)
+        self.assertEqual(row, (p, d, Period(empty=True), DateRange(empty=True)))
+
+        cur.execute("SELECT '[2000-01-01,)'::daterange, ARRAY['[2000-01-01,2000-02-01)'::daterange]")
+        row = cur.fetchall()[0]
+        self.assertEqual(row[0].lower, datetime.date(2000, 1, 1))
+        self.assertEqual(row[0].upper, None)
+        self.assertEqual(row[1], [DateRange('[2000-01-01,2000-02-01)')])
+
+        # bounds go to and come from the database in UTC, in any time zone,
+        # as without USE_TZ; Django's own cursors insist on UTC
+        raw = connection.connection.cursor()
+        raw.execute('SHOW TIME ZONE')
+        time_zone = raw.fetchone()[0]
+        raw.execute("SET TIME ZONE 'Europe/Ljubljana'")
+        try:
+            raw.execute('SELECT %s, %s::text', [p, p])
+            self.assertEqual(raw.fetchall()[0], (p, u'["2000-01-01 13:00:00.000001+01","2000-02-01 13:00:00.000001+01")'))
+            raw.execute('INSERT INTO temporal_category (cat, valid_time) VALUES (1, %s) RETURNING valid_time', [p])
+            self.assertEqual(raw.fetchone()[0], p)
+        finally:
+            raw.execute('SET TIME ZONE %s', [time_zone])
+
+        # ranges periods cannot hold are returned as text
+        cur.execute("SELECT '[2000-01-01,)'::tstzrange, '(,2000-01-01 00:00+00)'::tstzrange, '[2000-01-01,infinity)'::tstzrange,"
+            " '[-infinity,2000-01-01)'::daterange, '[2000-01-01,infinity)'::daterange, '[2000-01-01,9999-12-31 23:59:59.999999+00]'::tstzrange")
+        self.assertEqual(cur.fetchall()[0], ('["2000-01-01 00:00:00+00",)', '(,"2000-01-01 00:00:00+00")',
+            '["2000-01-01 00:00:00+00",infinity)', '[-infinity,2000-01-01)', '[2000-01-01,infinity)',
+            '["2000-01-01 00:00:00+00","9999-12-31 23:59:59.999999+00"]'))
+
 class TestProxyObject(TestCase):
     def runTest(self):
         period = Period(lower=datetime.datetime(1996,10,1), upper=datetime.datetime(1997,1,1))
@@ -284,6 +569,165 @@ class TestFunctionWhereLookups(TestCase):
         self.assertEqual(result.count(), 1)
         self.assertEqual(result[0].pk, i.pk)
 
+class TestCurrentAsOf(TestCase):
+    def runTest(self):
+        self.assertEqual(sorted(i.pk for i in Category.objects.current()), [4, 5])
+        self.assertEqual([i.pk for i in Category.objects.as_of(datetime.datetime(1996, 7, 1))], [2])
+        self.assertEqual(Category.objects.at(datetime.datetime(1996, 7, 1)).get().pk, 2)
+        self.assertEqual([i.pk for i in Category.objects.filter(cat=120033).current()], [5])
+
+        # the temporal field is found by its type, not by its name
+        p = Period(lower=datetime.datetime(1996, 1, 1))
+        p.set_current()
+        BothTemporalFK.objects.create(name='current', category_id=5, validity_time=p)
+        BothTemporalFK.objects.create(name='past', category_id=5,
+            validity_time=Period(lower=datetime.datetime(1996, 1, 1), upper=datetime.datetime(1996, 2, 1)))
+        self.assertEqual([i.name for i in TemporalQuerySet(BothTemporalFK).current()], ['current'])
+        self.assertEqual(sorted(i.name for i in TemporalQuerySet(BothTemporalFK).as_of(datetime.datetime(1996, 1, 15))),
+            ['current', 'past'])
+
+        # on a large table both are answered from indexes
+        cur = connection.cursor()
+        cur.execute("INSERT INTO temporal_datemergemodelnull (k1, k2, c, valid) "
+            "SELECT 'k' || i, NULL, i, daterange('2000-01-01'::date + i %% 1000, "
+            "CASE WHEN i %% 100 = 0 THEN %s ELSE '2000-01-02'::date + i %% 1000 END) "
+            "FROM generate_series(1, 50000) AS i;", [DATE_CURRENT])
+        cur.execute('ANALYZE temporal_datemergemodelnull;')
+        def plan(queryset):
+            sql, params = queryset.query.sql_with_params()
+            cur.execute('EXPLAIN ' + sql, params)
+            return '\n'.join(i for i, in cur.fetchall())
+        self.assertEqual(DateMergeModelNull.objects.current().count(), 500)
+        self.assertTrue('temporal_datemergemodelnull_valid_current' in plan(DateMergeModelNull.objects.current()))
+        self.assertEqual(DateMergeModelNull.objects.as_of(datetime.date(2000, 2, 1)).count(), 100)
+        self.assertFalse('Seq Scan' in plan(DateMergeModelNull.objects.as_of(datetime.date(2000, 2, 1))))
+
+class TestAsOfMany(TestCase):
+    def runTest(self):
+        import pytz
+        utc = lambda *args: datetime.datetime(*args, tzinfo=pytz.utc)
+        pairs = list(Category.objects.as_of_many([datetime.datetime(1997, 2, 1), utc(1996, 3, 1), datetime.datetime(1996, 7, 1),
+            datetime.datetime(1995, 1, 1)], chunk_size=2))
+        self.assertEqual([(instant, row.pk) for instant, row in pairs],
+            [(utc(1996, 3, 1), 1), (utc(1996, 7, 1), 2), (utc(1997, 2, 1), 4), (utc(1997, 2, 1), 5)])
+        self.assertEqual(pairs[1][1].valid_time, Period(lower=datetime.datetime(1996, 6, 1), upper=datetime.datetime(1996, 8, 1)))
+        self.assertEqual([(row._state.db, row._state.adding) for instant, row in pairs], [('default', False)] * 4)
+        self.assertEqual([(i.date(), row.pk) for i, row in Category.objects.filter(cat=120033).as_of_many(
+            [datetime.datetime(1996, 7, 1), datetime.datetime(1997, 2, 1)])],
+            [(datetime.date(1996, 7, 1), 2), (datetime.date(1997, 2, 1), 5)])
+        self.assertEqual(list(Category.objects.as_of_many([])), [])
+
+        for i, c in enumerate([1, 2, 3]):
+            DateMergeModelNull.objects.create(k1='a', k2=None, c=c,
+                valid=DateRange(lower=datetime.date(2000, 1 + i, 1), upper=i < 2 and datetime.date(2000, 2 + i, 1) or DATE_CURRENT))
+        month_ends = [datetime.date(2000, 1 + i, 28) for i in range(12)]
+        self.assertEqual([(instant.month, row.c) for instant, row in DateMergeModelNull.objects.as_of_many(month_ends)],
+            [(1, 1), (2, 2)] + [(i, 3) for i in range(3, 13)])
+
+class TestSequencedAggregate(TestCase):
+    def runTest(self):
+        d = datetime.date
+        DateMergeModelNull.objects.create(k1='a', c=1, valid=DateRange(lower=d(2000, 1, 1), upper=d(2000, 3, 1)))
+        DateMergeModelNull.objects.create(k1='b', c=2, valid=DateRange(lower=d(2000, 2, 1), upper=d(2000, 4, 1)))
+        DateMergeModelNull.objects.create(k1='c', c=4, valid=DateRange(lower=d(2000, 3, 1), upper=DATE_CURRENT))
+        steps = lambda *args, **kwargs: [(p.lower, p.upper, value) for p, value in
+            DateMergeModelNull.objects.sequenced_aggregate(*args, chunk_size=2, **kwargs)]
+
+        # a ending when c starts leaves the count unchanged
+        self.assertEqual(steps(), [(d(2000, 1, 1), d(2000, 2, 1), 1), (d(2000, 2, 1), d(2000, 4, 1), 2),
+            (d(2000, 4, 1), DATE_CURRENT, 1)])
+        self.assertEqual(steps('sum', 'c'), [(d(2000, 1, 1), d(2000, 2, 1), 1), (d(2000, 2, 1), d(2000, 3, 1), 3),
+            (d(2000, 3, 1), d(2000, 4, 1), 6), (d(2000, 4, 1), DATE_CURRENT, 4)])
+        self.assertEqual([v for l, u, v in steps('avg', 'c')], [1, 1.5, 3, 4])
+        self.assertEqual(steps(start=d(2000, 2, 15), end=d(2000, 5, 1)),
+            [(d(2000, 2, 15), d(2000, 4, 1), 2), (d(2000, 4, 1), d(2000, 5, 1), 1)])
+        self.assertEqual(TemporalQuerySet(DateMergeModelNull).filter(c__gt=1).sequenced_aggregate().next()[1], 1)
+
+        # the last bucket ends at end, and empty buckets are kept
+        month = datetime.timedelta(30)
+        self.assertEqual(steps(start=d(1999, 12, 1), end=d(2000, 2, 15), step=month), [(d(1999, 12, 1), d(1999, 12, 31), 0),
+            (d(1999, 12, 31), d(2000, 1, 30), 1), (d(2000, 1, 30), d(2000, 2, 15), 2)])
+        self.assertEqual([v for l, u, v in steps('sum', 'c', start=d(1999, 12, 1), end=d(2000, 2, 15), step=month)], [None, 1, 3])
+        self.assertRaises(ValueError, steps, step=month)
+        self.assertRaises(ValueError, steps, 'sum')
+
+        # the count of categories is the number valid at any point of each period
+        periods = list(Category.objects.sequenced_aggregate())
+        self.assertEqual([p.lower for p, n in periods[1:]], [p.upper for p, n in periods[:-1]])
+        for period, count in periods:
+            self.assertEqual(count, Category.objects.as_of(period.lower).count())
+            self.assertEqual(count, Category.objects.as_of(period.upper - datetime.timedelta(microseconds=1)).count())
+        days = list(Category.objects.sequenced_aggregate(start=datetime.datetime(1996, 1, 1), end=datetime.datetime(1998, 1, 1),
+            step=datetime.timedelta(1)))
+        self.assertEqual(len(days), 731)
+        self.assertEqual(days[100][0], Period(lower=datetime.datetime(1996, 4, 10), upper=datetime.datetime(1996, 4, 11)))
+
+class TestSequencedJoin(TestCase):
+    def runTest(self):
+        current = lambda lower: Period(lower=lower, upper=TIME_CURRENT)
+        BothTemporalFK.objects.create(name='a', category_id=5,
+            validity_time=Period(lower=datetime.datetime(1996, 6, 1), upper=datetime.datetime(1998, 1, 1)))
+        BothTemporalFK.objects.create(name='b', category_id=4,
+            validity_time=Period(lower=datetime.datetime(1996, 1, 1), upper=datetime.datetime(1996, 10, 1)))
+        BothTemporalFK.objects.create(name='c', category_id=4, validity_time=current(datetime.datetime(1997, 1, 1)))
+
+        # b ends when its category starts
+        rows = TemporalQuerySet(BothTemporalFK).sequenced_join('category', name='valid').order_by('name')
+        self.assertEqual([(i.name, i.category.cat, i.valid) for i in rows], [
+            ('a', 120033, Period(lower=datetime.datetime(1997, 1, 1), upper=datetime.datetime(1998, 1, 1))),
+            ('c', 137112, current(datetime.datetime(1997, 1, 1))),
+        ])
+        self.assertEqual(TemporalQuerySet(BothTemporalFK).filter(name='c').sequenced_join('category').get().period,
+            current(datetime.datetime(1997, 1, 1)))
+
+        in_1996 = Period(lower=datetime.datetime(1996, 5, 1), upper=datetime.datetime(1996, 9, 1))
+        rows = Category.objects.filter(pk__in=[1, 2]).with_period('in_1996', 'intersection', in_1996).order_by('pk')
+        self.assertEqual([i.in_1996 for i in rows], [
+            Period(lower=datetime.datetime(1996, 5, 1), upper=datetime.datetime(1996, 6, 1)),
+            Period(lower=datetime.datetime(1996, 6, 1), upper=datetime.datetime(1996, 8, 1))])
+        self.assertEqual(Category.objects.with_period('p', 'union', in_1996).get(pk=1).p,
+            Period(lower=datetime.datetime(1996, 1, 1), upper=datetime.datetime(1996, 9, 1)))
+        self.assertEqual(Category.objects.with_period('p', 'minus', in_1996).get(pk=1).p,
+            Period(lower=datetime.datetime(1996, 1, 1), upper=datetime.datetime(1996, 5, 1)))
+
+class TestCoalesce(TestCase):
+    def runTest(self):
+        from django_temporal.utils import coalesce
+        from models import CopyFieldModel
+        day = lambda i: i is None and DATE_CURRENT or datetime.date(2000, 1, i)
+        history = lambda: sorted((i.k1, i.k2, i.c, i.valid.lower.day, i.valid.upper) for i in DateMergeModelNull.objects.all())
+        for k1, k2, c, lower, upper in [
+                ('a', 'foo', 1, 1, 2), ('a', 'foo', 1, 2, 3), ('a', 'foo', 2, 3, 4), ('a', 'foo', 1, 4, 5), ('a', 'foo', 1, 5, None),
+                ('b', 'bar', 5, 1, 2), ('b', 'bar', 5, 3, 4),
+                ('x', None, 7, 1, 2), ('x', None, 7, 2, 3),
+                ('y', None, 8, 1, 2), ('y', None, 8, 2, 3)]:
+            DateMergeModelNull.objects.create(k1=k1, k2=k2, c=c, valid=DateRange(lower=day(lower), upper=day(upper)))
+
+        self.assertEqual(DateMergeModelNull.objects.filter(k1='y').coalesce(), 1)
+        self.assertEqual(DateMergeModelNull.objects.filter(k1='y').count(), 1)
+        self.assertEqual(coalesce(DateMergeModelNull), 3)
+        self.assertEqual(history(), [
+            ('a', 'foo', 1, 1, day(3)), ('a', 'foo', 1, 4, DATE_CURRENT), ('a', 'foo', 2, 3, day(4)),
+            ('b', 'bar', 5, 1, day(2)), ('b', 'bar', 5, 3, day(4)),
+            ('x', None, 7, 1, day(3)), ('y', None, 8, 1, day(3))])
+        self.assertEqual(coalesce(DateMergeModelNull), 0)
+
+        # fields which are not compared are kept from the earliest version
+        CopyFieldModel.objects.create(a=1, b='x', c='old', valid=DateRange(lower=day(1), upper=day(2)))
+        CopyFieldModel.objects.create(a=1, b='x', c='new', valid=DateRange(lower=day(2), upper=DATE_CURRENT))
+        self.assertEqual(coalesce(CopyFieldModel, fields=['a', 'b']), 1)
+        self.assertEqual([(i.c, i.valid) for i in CopyFieldModel.objects.all()], [('old', DateRange(lower=day(1), upper=DATE_CURRENT))])
+
+        # missing bounds are unbounded, and not left out
+        DateMergeModelNull.objects.all().delete()
+        cur = connection.cursor()
+        for k1, valid in [('u', '[2000-01-01,2000-01-02)'), ('u', '[2000-01-02,)'), ('v', '(,2000-01-02)'),
+                ('v', '[2000-01-02,2000-01-03)'), ('w', '(,2000-01-02)'), ('w', '[2000-01-01,)')]:
+            cur.execute('INSERT INTO temporal_datemergemodelnull (k1, c, valid) VALUES (%s, 1, %s::daterange)', [k1, valid])
+        self.assertEqual(coalesce(DateMergeModelNull), 3)
+        cur.execute('SELECT k1, valid::text FROM temporal_datemergemodelnull ORDER BY k1')
+        self.assertEqual(cur.fetchall(), [('u', '[2000-01-01,)'), ('v', '(,2000-01-03)'), ('w', '(,)')])
+
 class TestCurrentForeignKey(TestCase):
     def runTest(self):
         
@@ -310,6 +754,37 @@ class TestCurrentForeignKey(TestCase):
         tfk4 = BothTemporalFK(name='Will do', category=v4, validity_time=p)
         tfk4.save()
 
+class TestCurrentForeignKeyReferenced(TestCase):
+    def runTest(self):
+        v4 = Category.objects.get(pk=4)
+        v5 = Category.objects.get(pk=5)
+
+        tfk1 = ReferencedTemporalFK(name='Shall pass', category=v4)
+        tfk1.save()
+
+        p = Period(lower=datetime.datetime(2000, 1, 1, 12, 0), upper=TIME_CURRENT)
+        tfk2 = BothTemporalFK(name='Will do', category=v5, validity_time=p)
+        tfk2.save()
+
+        # closing a referenced current version is refused
+        v4.valid_time = Period(lower=v4.valid_time.lower, upper=datetime.datetime(2001, 1, 1))
+        with _fail_atomic():
+            v4.save()
+
+        v5.valid_time = Period(lower=v5.valid_time.lower, upper=datetime.datetime(2001, 1, 1))
+        with _fail_atomic():
+            v5.save()
+
+        # a closed referencing version no longer needs a current referenced one
+        tfk2.validity_time = Period(lower=p.lower, upper=datetime.datetime(2001, 1, 1))
+        tfk2.save()
+        v5.save()
+
+        # current rows can not be pointed to a closed version
+        tfk1.category = v5
+        with _fail_atomic():
+            tfk1.save()
+
 class TestDateRange(TestCase):
     def runTest(self):
         p = DateRange('[2000-01-01, 2000-02-01]')
@@ -528,6 +1003,581 @@ class TestDateMergeWithNullKey(TestCase):
         self.assertEqual(m3.valid.upper, datum4)
         self.assertEqual(m4.valid.upper.year, 9999)
 
+class TestMergeSources(TestCase):
+    def runTest(self):
+        import bz2
+        import gzip
+        import os
+        import tempfile
+        from cStringIO import StringIO
+        from django_temporal.utils import merge, CompressedReader, RowReader
+
+        def gzipped(data):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(data)
+            f.close()
+            return buf.getvalue()
+
+        def current():
+            return sorted([(m.a, m.b) for m in DateMergeModel.objects.filter(valid__contains=DATE_CURRENT - datetime.timedelta(1))])
+
+        today = datetime.date.today()
+        merge(StringIO('a,b\n1,foo\n2,bar\n'), DateMergeModel, today - datetime.timedelta(5), keys=['a'])
+        self.assertEqual(current(), [(1, 'foo'), (2, 'bar')])
+
+        merge(StringIO(gzipped('a,b\n2,bar\n') + gzipped('3,baz\n')), DateMergeModel, today - datetime.timedelta(4), keys=['a'])
+        self.assertEqual(current(), [(2, 'bar'), (3, 'baz')])
+
+        fd, path = tempfile.mkstemp(suffix='.csv.bz2')
+        try:
+            os.write(fd, bz2.compress('a,b\n2,bar\n3,"baz, again"\n'))
+            os.close(fd)
+            merge(path, DateMergeModel, today - datetime.timedelta(3), keys=['a'])
+        finally:
+            os.remove(path)
+        self.assertEqual(current(), [(2, 'bar'), (3, 'baz, again')])
+
+        rows = ({'a': i, 'b': u'\u017eaba %d' % i, 'unknown': 1} for i in range(2, 1000))
+        merge(rows, DateMergeModel, today - datetime.timedelta(2), keys=['a'])
+        self.assertEqual(len(current()), 998)
+        self.assertEqual(DateMergeModel.objects.get(a=500).b, u'\u017eaba 500')
+
+        merge([('a', 'b'), (1, 'back')], DateMergeModel, today - datetime.timedelta(1), keys=['a'], snapshot='delta')
+        self.assertEqual(len(current()), 999)
+        merge([('k1', 'k2', 'c'), ('a', None, 1)], DateMergeModelNull, today, keys=['k1', 'k2'])
+        self.assertEqual(DateMergeModelNull.objects.filter(k2__isnull=True, valid__contains=today).count(), 1)
+
+        # readers hand out data a chunk at a time
+        reader = RowReader(iter([(i, 'x' * i) for i in range(100)]), ['a', 'b'], chunk_size=10)
+        chunks = list(iter(lambda: reader.read(10), ''))
+        self.assertTrue(max(len(c) for c in chunks) == 10)
+        self.assertEqual(''.join(chunks), ''.join('%d,%s\r\n' % (i, 'x' * i) for i in range(100)))
+        reader = CompressedReader(StringIO(gzipped('x' * 1000)), chunk_size=7)
+        self.assertEqual(reader.read(3), 'xxx')
+        self.assertEqual(reader.read(), 'x' * 997)
+
+class TestSQLSources(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, StagedRecords, QueryRecords
+        from temporal.models import CopyFieldModel
+        day = lambda i: datetime.date(2000, 1, i)
+        current = lambda: sorted(DateMergeModel.objects.filter(valid__contains=DATE_CURRENT - datetime.timedelta(1)).values_list('a', 'b'))
+
+        cur = connection.cursor()
+        cur.execute('CREATE SCHEMA merge_staging')
+        cur.execute('CREATE TABLE merge_staging.snapshot (a integer, b varchar(50), other text)')
+        cur.execute("INSERT INTO merge_staging.snapshot VALUES (1, 'foo', 'x'), (2, 'bar', 'y')")
+
+        merge(StagedRecords('merge_staging.snapshot'), DateMergeModel, day(1), keys=['a'])
+        self.assertEqual(current(), [(1, 'foo'), (2, 'bar')])
+        merge(QueryRecords('SELECT a, upper(b) AS b FROM merge_staging.snapshot WHERE a > %s', [1]), DateMergeModel, day(2), keys=['a'])
+        self.assertEqual(current(), [(2, 'BAR')])
+
+        merge([('a', 'b', 'c'), (3, 'copy', None), (4, 'copy', 'z')], CopyFieldModel, day(1), keys=['a'])
+        merge(CopyFieldModel.objects.filter(a=3), DateMergeModel, day(3), keys=['a'], snapshot='delta')
+        self.assertEqual(current(), [(2, 'BAR'), (3, 'copy')])
+        merge(CopyFieldModel.objects.filter(a=4).values('a', 'b'), DateMergeModel, day(4), keys=['a'], snapshot='delta')
+        self.assertEqual(current(), [(2, 'BAR'), (3, 'copy'), (4, 'copy')])
+
+class TestMergeStats(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, MergeStats
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+
+        stats = merge(datafile('daterangenull_1.csv'), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+        self.assertTrue(isinstance(stats, MergeStats))
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (4, 0, 0, 4))
+
+        sent = []
+        class Client(object):
+            def gauge(self, name, value):
+                sent.append(('gauge', name, value))
+            def timing(self, name, ms):
+                sent.append(('timing', name, ms))
+        stats = merge(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'],
+            metrics=Client())
+        # a has gone missing, c and x have changed, d is new
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (4, 1, 3, 3))
+        self.assertEqual(list(stats.phases), ['stage', 'lock', 'terminate', 'unchanged', 'update', 'insert', 'cleanup', 'commit'])
+        self.assertTrue(stats.total >= sum(stats.phases.values()) > 0)
+        self.assertEqual(set(phase for phase, sql, seconds in stats.statements), set(stats.phases) - set(['commit']))
+        self.assertTrue(('gauge', 'merge.terminated', 3) in sent)
+        self.assertEqual([name for kind, name, value in sent if kind == 'timing'],
+            ['merge.' + phase for phase in stats.phases] + ['merge.total'])
+
+        sent = []
+        merge(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 3), keys=['k1', 'k2'],
+            metrics=lambda name, value: sent.append((name, value)))
+        self.assertTrue(('merge.unchanged', 4) in sent)
+
+class TestMergeDiff(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, diff, MergeAborted
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        history = lambda: sorted((i.k1, i.k2, i.c, i.valid.lower, i.valid.upper) for i in DateMergeModelNull.objects.all())
+
+        merge(datafile('daterangenull_1.csv'), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+        before = history()
+        cur = connection.cursor()
+        locks = "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+        cur.execute(locks)
+        locked = cur.fetchone()[0]
+
+        stats = merge(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'],
+            dry_run=True)
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (4, 1, 3, 3))
+        self.assertEqual(history(), before)
+        # rolled back to before staging, and took no locks
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname LIKE 'temporal_datemergemodelnull_temp_%%'")
+        self.assertEqual(cur.fetchone()[0], 0)
+        cur.execute(locks)
+        self.assertEqual(cur.fetchone()[0], locked)
+
+        changes = sorted(diff(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2']))
+        self.assertEqual([tuple(i) for i in changes], [
+            (('a', 'foo'), 'terminate', []),
+            (('c', 'test'), 'update', ['c']),
+            (('d', 'echo'), 'insert', []),
+            (('x', None), 'update', ['c']),
+        ])
+        self.assertEqual(history(), before)
+
+        # a and the old versions of c and x make 3 of 4 records
+        self.assertRaises(MergeAborted, merge, datafile('daterangenull_2.csv'), DateMergeModelNull,
+            datetime.date(2000, 1, 2), keys=['k1', 'k2'], max_terminated=0.5)
+        self.assertEqual(history(), before)
+
+        stats = merge(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'],
+            max_terminated=0.75)
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (4, 1, 3, 3))
+
+class TestBinarySources(TestCase):
+    def runTest(self):
+        from decimal import Decimal
+        from cStringIO import StringIO
+        from django_temporal.utils import merge, BinaryRowReader, BinaryRows, BinaryCopy, JSONLines
+        import os, pytz
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        history = lambda: sorted((i.k1, i.k2, i.c, i.valid.lower, i.valid.upper) for i in DateMergeModelNull.objects.all())
+
+        # values are encoded by the database types of their fields
+        fieldtypes = [('i', 'integer'), ('b', 'bigint'), ('s', 'smallint'), ('f', 'double precision'), ('r', 'real'),
+            ('n', 'numeric(12, 4)'), ('m', 'numeric'), ('t', 'varchar(20)'), ('o', 'boolean'), ('d', 'date'),
+            ('h', 'time'), ('ts', 'timestamp'), ('tz', 'timestamp with time zone')]
+        fields = [name for name, fieldtype in fieldtypes]
+        rows = [
+            (1, 2 ** 40, -3, 0.5, 1.5, Decimal('-12.5'), Decimal('12345678.000100'), u'\u010d\u0161', True,
+                datetime.date(1999, 12, 31), datetime.time(12, 30, 1, 5), datetime.datetime(2000, 1, 1, 0, 0, 0, 1),
+                datetime.datetime(2009, 6, 4, 12, tzinfo=pytz.utc)),
+            ('7', '8', '9', '0.25', '2', '0.001', '1E+5', 'a,"b"\n', 'f',
+                '2000-01-02', '23:59:59', '1970-01-01 00:00:00', '2009-06-04 12:00:00+0100'),
+            (None, None, None, None, None, 0, Decimal('-0.00000001'), '', None, None, None, None, None),
+        ]
+        cur = connection.cursor()
+        cur.execute('CREATE TEMP TABLE binary_types (' + ', '.join(['%s %s' % i for i in fieldtypes]) + ');')
+        cur.copy_expert('COPY binary_types FROM stdin WITH BINARY;', BinaryRowReader(rows, fields, dict(fieldtypes), chunk_size=16))
+        cur.execute("SELECT " + ', '.join(fields[:-1]) + ", tz AT TIME ZONE 'UTC' FROM binary_types;")
+        self.assertEqual(cur.fetchall(), [
+            (1, 2 ** 40, -3, 0.5, 1.5, Decimal('-12.5000'), Decimal('12345678.000100'), u'\u010d\u0161', True,
+                datetime.date(1999, 12, 31), datetime.time(12, 30, 1, 5), datetime.datetime(2000, 1, 1, 0, 0, 0, 1),
+                datetime.datetime(2009, 6, 4, 12)),
+            (7, 8, 9, 0.25, 2.0, Decimal('0.0010'), Decimal('100000'), 'a,"b"\n', False,
+                datetime.date(2000, 1, 2), datetime.time(23, 59, 59), datetime.datetime(1970, 1, 1),
+                datetime.datetime(2009, 6, 4, 11)),
+            (None, None, None, None, None, Decimal('0.0000'), Decimal('-0.00000001'), '', None, None, None, None, None),
+        ])
+        self.assertRaises(ValueError, BinaryRowReader, rows, ['v'], {'v': 'daterange'})
+
+        # the same history as merging CSV
+        merge(datafile('daterangenull_1.csv'), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+        merge(datafile('daterangenull_2.csv'), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'])
+        expected = history()
+        DateMergeModelNull.objects.all().delete()
+
+        merge(BinaryRows([('k1', 'k2', 'c'), ('a', 'foo', 1), ('b', 'bar', 22), ('c', 'test', 12), ('x', None, 7)]),
+            DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+        lines = StringIO('{"k1": "b", "k2": "bar", "c": 22}\n{"k1": "c", "k2": "test", "c": 13}\n\n'
+            '{"k1": "d", "k2": "echo", "c": 10}\n{"k1": "x", "k2": null, "c": 8}\n')
+        stats = merge(JSONLines(lines), DateMergeModelNull, datetime.date(2000, 1, 2), keys=['k1', 'k2'])
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (4, 1, 3, 3))
+        self.assertEqual(history(), expected)
+
+        # binary COPY data as PostgreSQL writes it
+        data = StringIO()
+        cur.execute("CREATE TEMP TABLE binary_copy AS SELECT 'd'::varchar AS k1, 'echo'::varchar AS k2, 11 AS c;")
+        cur.copy_expert('COPY binary_copy TO stdout WITH BINARY;', data)
+        data.seek(0)
+        stats = merge(BinaryCopy(data, ['k1', 'k2', 'c']), DateMergeModelNull, datetime.date(2000, 1, 3), keys=['k1', 'k2'],
+            snapshot='delta')
+        self.assertEqual((stats.staged, stats.unchanged, stats.terminated, stats.inserted), (1, 0, 1, 1))
+
+class TestArrowSource(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, ArrowRecords, pyarrow
+        if pyarrow is None:
+            raise unittest2.SkipTest('pyarrow is not installed')
+        table = pyarrow.Table.from_arrays([pyarrow.array(['a', 'b', 'x']), pyarrow.array(['foo', 'bar', None]),
+            pyarrow.array([1, 22, 7]), pyarrow.array([1.5, 2.5, 3.5])], ['k1', 'k2', 'c', 'ignored'])
+        stats = merge(ArrowRecords(table), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'])
+        self.assertEqual(stats.inserted, 3)
+        self.assertEqual(sorted((i.k1, i.k2, i.c) for i in DateMergeModelNull.objects.all()),
+            [('a', 'foo', 1), ('b', 'bar', 22), ('x', None, 7)])
+
+class TestKeyLocks(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, lock_key, save_version
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        history = lambda: sorted((i.k1, i.k2, i.c, i.valid.lower, i.valid.upper) for i in DateMergeModelNull.objects.all())
+        cur = connection.cursor()
+        def locks():
+            cur.execute("SELECT objid FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = hashtext(%s)::oid"
+                " AND objsubid = 2;",
+                [DateMergeModelNull._meta.db_table])
+            return set(i for i, in cur.fetchall())
+
+        # the test transaction holds the locks merge takes, one per key
+        merge(datafile('daterangenull_1.csv'), DateMergeModelNull, datetime.date(2000, 1, 1), keys=['k1', 'k2'], snapshot='delta')
+        merged = locks()
+        self.assertEqual(len(merged), 4)
+        lock_key({'k1': 'x', 'k2': None}, DateMergeModelNull, ['k1', 'k2'])
+        lock_key({'k1': 'c', 'k2': 'test'}, DateMergeModelNull, ['k1', 'k2'])
+        self.assertEqual(locks(), merged)
+        lock_key({'k1': 'd', 'k2': 'echo'}, DateMergeModelNull, ['k1', 'k2'])
+        self.assertEqual(len(locks() - merged), 1)
+
+        version = save_version({'k1': 'c', 'k2': 'test', 'c': 13}, DateMergeModelNull, datetime.date(2000, 1, 2), ['k1', 'k2'])
+        self.assertEqual(version.valid, DateRange(lower=datetime.date(2000, 1, 2), upper=DATE_CURRENT))
+        self.assertEqual(save_version({'k1': 'c', 'k2': 'test', 'c': 13}, DateMergeModelNull, datetime.date(2000, 1, 3), ['k1', 'k2']).pk,
+            version.pk)
+        self.assertEqual(save_version({'k1': 'x', 'k2': None}, DateMergeModelNull, datetime.date(2000, 1, 2), ['k1', 'k2'], terminate=True),
+            None)
+        save_version({'k1': 'd', 'k2': 'echo', 'c': 10}, DateMergeModelNull, datetime.date(2000, 1, 2), ['k1', 'k2'])
+        save_version({'k1': 'a', 'k2': 'foo'}, DateMergeModelNull, datetime.date(2000, 1, 2), ['k1', 'k2'], terminate=True)
+
+        # the same history as merging the next snapshot
+        self.assertEqual(history(), [
+            ('a', 'foo', 1, datetime.date(2000, 1, 1), datetime.date(2000, 1, 2)),
+            ('b', 'bar', 22, datetime.date(2000, 1, 1), DATE_CURRENT),
+            ('c', 'test', 12, datetime.date(2000, 1, 1), datetime.date(2000, 1, 2)),
+            ('c', 'test', 13, datetime.date(2000, 1, 2), DATE_CURRENT),
+            ('d', 'echo', 10, datetime.date(2000, 1, 2), DATE_CURRENT),
+            ('x', None, 7, datetime.date(2000, 1, 1), datetime.date(2000, 1, 2)),
+        ])
+        self.assertRaises(ValueError, save_version, {'k1': 'c', 'k2': 'test', 'c': 14}, DateMergeModelNull,
+            datetime.date(2000, 1, 1), ['k1', 'k2'])
+
+        # time stamps with a time zone are compared in UTC
+        import pytz
+        helsinki = pytz.timezone('Europe/Helsinki')
+        save_version({'a': 1, 'b': 'x'}, DateTimeMergeModel, helsinki.localize(datetime.datetime(2000, 1, 1, 12)), ['a'])
+        version = save_version({'a': 1, 'b': 'y'}, DateTimeMergeModel, datetime.datetime(2000, 1, 2, 12, tzinfo=pytz.utc), ['a'])
+        self.assertEqual(sorted((i.b, i.valid) for i in DateTimeMergeModel.objects.filter(a=1)), [
+            ('x', Period(lower=datetime.datetime(2000, 1, 1, 10), upper=datetime.datetime(2000, 1, 2, 12))),
+            ('y', Period(lower=datetime.datetime(2000, 1, 2, 12), upper=TIME_CURRENT))])
+        self.assertEqual(version.valid.lower, datetime.datetime(2000, 1, 2, 12))
+
+class TestKeyLockWriters(TransactionTestCase):
+    def runTest(self):
+        import threading
+        from django.db import connections, DatabaseError
+        from django_temporal.utils import merge, save_version, KEY_LOCK_BUCKETS
+        keys = ['k1', 'k2']
+        records = [['k1', 'k2', 'c']] + [('key %d' % i, None, i) for i in range(10001)]
+        merge(records, DateMergeModelNull, datetime.date(2000, 1, 1), keys=keys)
+
+        cur = connection.cursor()
+        def bucket(key):
+            cur.execute('SELECT (hashtext(ROW(%s::varchar(50), NULL::varchar(50))::text)::bigint + 2147483648) * %s / 4294967296',
+                [key, KEY_LOCK_BUCKETS])
+            return cur.fetchone()[0]
+        other = [key for key, k2, c in records[2:] if bucket(key) != bucket('key 0')][0]
+
+        saved = {}
+        def write(key):
+            # connections are per thread, this opens a new one
+            conn = connections['default']
+            try:
+                conn.cursor().execute("SET statement_timeout = 500")
+                saved[key] = save_version({'k1': key, 'k2': None, 'c': -2}, DateMergeModelNull,
+                    datetime.date(2000, 1, 3), keys, conn=conn) is not None
+            except DatabaseError as e:
+                saved[key] = 'statement timeout' in str(e) and 'timeout' or str(e)
+            finally:
+                conn.close()
+        def writers(**kwargs):
+            for key in ('key 0', other):
+                thread = threading.Thread(target=write, args=(key,))
+                thread.start()
+                thread.join()
+
+        # while a snapshot of all the keys changing one of them merges,
+        # only the writers of keys in its bucket wait
+        records[1] = ('key 0', None, -1)
+        stats = merge(records, DateMergeModelNull, datetime.date(2000, 1, 2), keys=keys, callback=writers)
+        self.assertEqual((stats.unchanged, stats.terminated, stats.inserted), (10000, 1, 1))
+        self.assertEqual(saved, {'key 0': 'timeout', other: True})
+        self.assertEqual(sorted((i.c, i.valid.lower) for i in DateMergeModelNull.objects.filter(k1__in=['key 0', other])),
+            [(-2, datetime.date(2000, 1, 3)), (-1, datetime.date(2000, 1, 2)), (0, datetime.date(2000, 1, 1)),
+            (int(other.split()[1]), datetime.date(2000, 1, 1))])
+
+        # a merge changing keys in every bucket holds up all writers
+        records = [records[0]] + [(k1, k2, c + 1) for k1, k2, c in records[1:]]
+        saved.clear()
+        merge(records, DateMergeModelNull, datetime.date(2000, 1, 4), keys=keys, callback=writers)
+        self.assertEqual(saved, {'key 0': 'timeout', other: 'timeout'})
+
+class TestDigestMerge(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+
+        def history(digest):
+            DateMergeModelNull.objects.all().delete()
+            for i in range(1, 5):
+                merge(datafile('daterangenull_%d.csv' % i),
+                    DateMergeModelNull,
+                    datetime.date(2000, 1, i),
+                    keys=['k1', 'k2'],
+                    snapshot=i == 3 and 'delta' or 'full',
+                    digest=digest
+                    )
+            return sorted([(m.k1, m.k2, m.c, m.valid) for m in DateMergeModelNull.objects.all()])
+
+        rows = history(True)
+        self.assertEqual(rows, history(False))
+        self.assertTrue(('b', 'bar', 22, DateRange(datetime.date(2000, 1, 1), datetime.date(2000, 1, 4))) in rows)
+        self.assertTrue(('c', 'test', 14, DateRange(datetime.date(2000, 1, 3), datetime.date(2000, 1, 4))) in rows)
+
+class TestMergeStaging(TestCase):
+    def runTest(self):
+        from cStringIO import StringIO
+        from django_temporal.utils import merge
+
+        table = DateMergeModel._meta.db_table
+        cur = connection.cursor()
+
+        def staging_tables():
+            cur.execute("SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r'", [table + '\\_%'])
+            return sorted([r[0] for r in cur.fetchall()])
+
+        # a table named like the old staging table is left alone
+        cur.execute('CREATE TABLE %s_temp (x integer)' % table)
+        seen = []
+        def callback(**kwargs):
+            seen.append(staging_tables())
+        for staging in ('temp', 'unlogged'):
+            merge(StringIO('a,b\n1,foo\n'), DateMergeModel, datetime.date(2000, 1, 1), keys=['a'], staging=staging, callback=callback)
+        self.assertEqual(seen, [[table + '_temp']] * 2)
+        self.assertEqual(DateMergeModel.objects.count(), 1)
+
+        # staging tables go away with a failed merge
+        def fail(**kwargs):
+            raise ValueError
+        try:
+            with transaction.atomic():
+                merge(StringIO('a,b\n2,bar\n'), DateMergeModel, datetime.date(2000, 1, 2), keys=['a'], callback=fail)
+        except ValueError:
+            pass
+        else:
+            self.fail('Should throw a ValueError')
+        self.assertEqual(staging_tables(), [table + '_temp'])
+        self.assertEqual(DateMergeModel.objects.count(), 1)
+
+class TestParallelMerge(TransactionTestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, parallel_merge
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+
+        def history(merge, **kwargs):
+            DateMergeModelNull.objects.all().delete()
+            for i in range(1, 5):
+                merge(datafile('daterangenull_%d.csv' % i),
+                    DateMergeModelNull,
+                    datetime.date(2000, 1, i),
+                    keys=['k1', 'k2'],
+                    snapshot=i == 3 and 'delta' or 'full',
+                    **kwargs
+                    )
+            return sorted([(m.k1, m.k2, m.c, m.valid) for m in DateMergeModelNull.objects.all()])
+
+        calls = []
+        rows = history(parallel_merge, workers=3, callback=lambda **kwargs: calls.append(kwargs['snapshot']))
+        self.assertEqual(rows, history(merge))
+        self.assertEqual(calls, ['full', 'full', 'delta', 'full'])
+
+        cur = connection.cursor()
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname LIKE %s", [DateMergeModelNull._meta.db_table + '\\_stage\\_%'])
+        self.assertEqual(cur.fetchone()[0], 0)
+
+        # a failing shard is reported, the staged records are dropped
+        self.assertRaises(Exception, parallel_merge, datafile('daterangenull_1.csv'),
+            DateMergeModelNull, datetime.date(2000, 1, 5), keys=['k1', 'k2'], workers=2, valid_field='k1')
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname LIKE %s", [DateMergeModelNull._meta.db_table + '\\_stage\\_%'])
+        self.assertEqual(cur.fetchone()[0], 0)
+
+class TestBatchedMerge(TransactionTestCase):
+    def runTest(self):
+        from django_temporal import utils
+        from django_temporal.utils import merge, batched_merge, CHECKPOINT_TABLE
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        rows = lambda: sorted([(m.k1, m.k2, m.c, m.valid) for m in DateMergeModelNull.objects.all()])
+
+        def history(merge, **kwargs):
+            DateMergeModelNull.objects.all().delete()
+            for i in range(1, 5):
+                merge(datafile('daterangenull_%d.csv' % i),
+                    DateMergeModelNull,
+                    datetime.date(2000, 1, i),
+                    keys=['k1', 'k2'],
+                    snapshot=i == 3 and 'delta' or 'full',
+                    **kwargs
+                    )
+            return rows()
+
+        expected = history(merge)
+        self.assertEqual(history(batched_merge, name='test', batch_size=2), expected)
+
+        # interrupt the last merge after its first batch, then resume
+        DateMergeModelNull.objects.all().delete()
+        for i in range(1, 4):
+            merge(datafile('daterangenull_%d.csv' % i), DateMergeModelNull, datetime.date(2000, 1, i),
+                keys=['k1', 'k2'], snapshot=i == 3 and 'delta' or 'full')
+        calls = []
+        def failing_merge(*args, **kwargs):
+            if calls:
+                raise RuntimeError("interrupted")
+            calls.append(args)
+            return merge(*args, **kwargs)
+        utils.merge = failing_merge
+        try:
+            self.assertRaises(RuntimeError, batched_merge, datafile('daterangenull_4.csv'), DateMergeModelNull,
+                datetime.date(2000, 1, 4), keys=['k1', 'k2'], name='test', batch_size=2)
+        finally:
+            utils.merge = merge
+        cur = connection.cursor()
+        cur.execute('SELECT terminated, next_batch FROM ' + CHECKPOINT_TABLE + ' WHERE name = %s', ['test'])
+        self.assertEqual(cur.fetchone(), (True, 1))
+        self.assertNotEqual(rows(), expected)
+
+        # resuming a different merge under the same name is refused
+        self.assertRaises(ValueError, batched_merge, None, DateMergeModelNull,
+            datetime.date(2000, 1, 5), keys=['k1', 'k2'], name='test')
+        batched_merge(None, DateMergeModelNull, datetime.date(2000, 1, 4), keys=['k1', 'k2'], name='test')
+        self.assertEqual(rows(), expected)
+
+        cur.execute('SELECT count(*) FROM ' + CHECKPOINT_TABLE)
+        self.assertEqual(cur.fetchone()[0], 0)
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname LIKE %s", [DateMergeModelNull._meta.db_table + '\\_batches\\_%'])
+        self.assertEqual(cur.fetchone()[0], 0)
+
+        # a late full snapshot is refused before anything is staged
+        DateMergeModelNull.objects.all().delete()
+        for i in (1, 2, 4):
+            merge(datafile('daterangenull_%d.csv' % i), DateMergeModelNull, datetime.date(2000, 1, i), keys=['k1', 'k2'])
+        before = rows()
+        self.assertRaises(ValueError, batched_merge, datafile('daterangenull_3.csv'), DateMergeModelNull,
+            datetime.date(2000, 1, 3), keys=['k1', 'k2'], name='late')
+        self.assertEqual(rows(), before)
+        cur = connection.cursor()
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname = %s", [CHECKPOINT_TABLE])
+        if cur.fetchone()[0]:
+            cur.execute('SELECT count(*) FROM ' + CHECKPOINT_TABLE)
+            self.assertEqual(cur.fetchone()[0], 0)
+        batched_merge(datafile('daterangenull_3.csv'), DateMergeModelNull, datetime.date(2000, 1, 3), keys=['k1', 'k2'],
+            name='late', snapshot='delta')
+        late = rows()
+        DateMergeModelNull.objects.all().delete()
+        for i in (1, 2, 4, 3):
+            merge(datafile('daterangenull_%d.csv' % i), DateMergeModelNull, datetime.date(2000, 1, i), keys=['k1', 'k2'],
+                snapshot=i == 3 and 'delta' or 'full')
+        self.assertEqual(late, rows())
+
+class TestBackfill(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge, backfill
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        rows = lambda: sorted([(m.k1, m.k2, m.c, m.valid) for m in DateMergeModelNull.objects.all()])
+        snapshots = [(datetime.date(2000, 1, i), datafile('daterangenull_%d.csv' % i)) for i in range(1, 5)]
+
+        for snapshot in ('full', 'delta'):
+            DateMergeModelNull.objects.all().delete()
+            for timestamp, path in snapshots:
+                merge(path, DateMergeModelNull, timestamp, keys=['k1', 'k2'], snapshot=snapshot)
+            expected = rows()
+
+            DateMergeModelNull.objects.all().delete()
+            stats = backfill(snapshots, DateMergeModelNull, keys=['k1', 'k2'], snapshot=snapshot)
+            self.assertEqual(rows(), expected)
+            self.assertEqual(stats.inserted, len(expected))
+
+            # the history can be merged into as usual
+            merge(datafile('daterangenull_1.csv'), DateMergeModelNull, datetime.date(2000, 1, 5), keys=['k1', 'k2'], snapshot=snapshot)
+
+        # backfilling over existing history is refused
+        self.assertRaises(ValueError, backfill, snapshots, DateMergeModelNull, keys=['k1', 'k2'])
+        DateMergeModelNull.objects.all().delete()
+        self.assertRaises(ValueError, backfill, snapshots[::-1], DateMergeModelNull, keys=['k1', 'k2'])
+
+class TestRetroactiveMerge(TestCase):
+    def runTest(self):
+        from django_temporal.utils import merge
+        import os
+        datafile = lambda x: os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', x)
+        rows = lambda: sorted([(m.k1, m.k2, m.c, m.valid) for m in DateMergeModelNull.objects.all()])
+
+        def history(days, snapshots={}):
+            DateMergeModelNull.objects.all().delete()
+            for i in days:
+                merge(datafile('daterangenull_%d.csv' % i), DateMergeModelNull, datetime.date(2000, 1, i),
+                    keys=['k1', 'k2'], snapshot=snapshots.get(i, 'full'))
+            return rows()
+
+        # a snapshot arriving late ends up where it would have been merged
+        expected = history([1, 2, 3, 4])
+        for late in (1, 2, 3):
+            days = [i for i in range(1, 5) if i != late] + [late]
+            self.assertEqual(history(days), expected)
+        self.assertEqual(history([1, 2, 4, 3], {3: 'delta'}), history([1, 2, 3, 4], {3: 'delta'}))
+
+        # a late delta holds until its own key changes next, whatever other
+        # keys do in between
+        def deltas(order, changes):
+            DateMergeModelNull.objects.all().delete()
+            for day in order:
+                merge([['k1', 'k2', 'c']] + changes[day], DateMergeModelNull, datetime.date(2000, 1, day),
+                    keys=['k1', 'k2'], snapshot='delta')
+            return rows()
+        changes = {1: [('a', None, 1)], 2: [('a', None, 2)], 3: [('b', None, 1)]}
+        self.assertEqual(deltas([1, 3, 2], changes), deltas([1, 2, 3], changes))
+        self.assertEqual(deltas([1, 3, 2], changes), [('a', None, 1, DateRange(lower=datetime.date(2000, 1, 1), upper=datetime.date(2000, 1, 2))),
+            ('a', None, 2, DateRange(lower=datetime.date(2000, 1, 2), upper=DATE_CURRENT)),
+            ('b', None, 1, DateRange(lower=datetime.date(2000, 1, 3), upper=DATE_CURRENT))])
+        import random
+        shuffle = random.Random(14)
+        # every change is to a new value, so none is lost merging in order
+        changes = dict([(day, [(k, None, day) for k in 'abcd' if shuffle.random() < 0.4]) for day in range(1, 15)])
+        expected = deltas(range(1, 15), changes)
+        for i in range(3):
+            order = range(1, 15)
+            shuffle.shuffle(order)
+            self.assertEqual(deltas(order, changes), expected)
+
+        # only the versions valid at the timestamp are split
+        history([1, 2, 4])
+        before = dict([(m.pk, m.valid) for m in DateMergeModelNull.objects.exclude(valid__contains=datetime.date(2000, 1, 3))])
+        stats = merge(datafile('daterangenull_3.csv'), DateMergeModelNull, datetime.date(2000, 1, 3), keys=['k1', 'k2'])
+        self.assertEqual((stats.unchanged, stats.terminated, stats.inserted), (3, 1, 1))
+        for pk, valid in before.items():
+            self.assertEqual(DateMergeModelNull.objects.get(pk=pk).valid, valid)
+
 class TestDateTimeMerge(TestCase):
     def runTest(self):
         